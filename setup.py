@@ -69,7 +69,7 @@ setup(
         'Programming Language :: Python :: 3.7'
     ],
     install_requires=[
-        'tinydb>=3.2.1',
+        'tinydb>=3.6.0',
         'tinydb_serialization>=1.0.4',
         'pymongo>=3.4.0'
     ],
@@ -1,4 +1,6 @@
 import os
+import re
+import sys
 import copy
 import json
 import pytest
@@ -424,6 +426,172 @@ def test_update_one_set(collection):
     assert c['countStr'] == 'three'
 
 
+def test_update_upsert(collection):
+    """
+    Testing updates inserting a document when none matches
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    c = collection['tiny']
+    result = c.update_one(
+        {'count': 1000, 'nested.name': 'a', 'countStr': {'$gt': 'x'}},
+        {'$set': {'countBool': True}, '$inc': {'hits': 1}},
+        upsert=True
+    )
+    assert result.matched_count == 0
+    assert result.modified_count == 0
+    doc = c.find_one({'_id': result.upserted_id})
+    del doc['_id']
+    assert doc == {
+        'count': 1000, 'nested': {'name': 'a'}, 'countBool': True, 'hits': 1
+    }
+
+    # a replacement keeps only the _id of the query
+    result = c.update_many({'_id': 'new', 'count': 2000}, {'count': 1}, upsert=True)
+    assert result.upserted_id == 'new'
+    assert c.find_one({'_id': 'new'}) == {'_id': 'new', 'count': 1}
+
+    # documents matching are updated, none is inserted
+    result = c.update_one({'count': 1000}, {'$inc': {'hits': 1}}, upsert=True)
+    assert result.matched_count == 1
+    assert result.upserted_id is None
+    assert c.count() == 102
+
+
+def test_update_operators(collection):
+    """
+    Testing the update operators compared with MongoDB
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    updates = [
+        ({'count': 3}, {'$inc': {'count': 1000, 'nested.hits': 2}}),
+        ({'count': 4}, {'$unset': {'countStr': ''}}),
+        ({'count': 5}, {'$push': {'countArray': 100}}),
+        ({'count': 6}, {'$push': {'countArray': {'$each': [1, 2]}}}),
+        ({'count': 7}, {'$pull': {'countArray': {'$gte': 8}}}),
+        ({'count': 8}, {'$min': {'count': 1}, '$max': {'countBool': 9}}),
+        ({'count': 9}, {'$set': {'nested.a': 1}, '$inc': {'count': 0.5}}),
+    ]
+    for query, update in updates:
+        collection['tiny'].update_one(query, update)
+        collection['mongo'].update_one(query, update)
+
+    for query, _ in updates:
+        unchanged = {'countFloat': query['count'] + 0.1}
+        tiny_doc = collection['tiny'].find_one(unchanged)
+        assert tiny_doc == collection['mongo'].find_one(unchanged)
+
+    assert collection['tiny'].find_one({'count': 1003})['nested'] == {
+        'hits': 2
+    }
+    assert collection['tiny'].find_one({'count': 9.5})['nested'] == {'a': 1}
+
+    result = collection['tiny'].update_many(
+        {'count': {'$gte': 90, '$lt': 100}}, {'$inc': {'count': 100}}
+    )
+    assert result.matched_count == 10
+    assert result.modified_count == 10
+    assert collection['tiny'].find({'count': {'$gte': 190}}).count() == 11
+
+    # update_one stops at the first match
+    result = collection['tiny'].update_one(
+        {'count': {'$gte': 190}}, {'$set': {'countStr': 'big'}}
+    )
+    assert result.matched_count == 1
+    assert collection['tiny'].find({'countStr': 'big'}).count() == 1
+
+    result = collection['tiny'].update_one(
+        {'count': 20}, {'$set': {'count': 20}}
+    )
+    assert result.matched_count == 1
+    assert result.modified_count == 0
+
+    with pytest.raises(tm.WriteError):
+        collection['tiny'].update_one({'count': 21}, {'$inc': {'countStr': 1}})
+    with pytest.raises(tm.WriteError):
+        collection['tiny'].update_one({'count': 21}, {'$rename': {'a': 'b'}})
+    with pytest.raises(ValueError):
+        collection['tiny'].update_one({'count': 21}, {'$set': {}, 'b': 2})
+
+
+def test_bulk_write(collection):
+    """
+    Testing bulk_write writes the database file once
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    storage = tiny_database.tinydb._storage.storage
+    writes = []
+    write = storage.write
+    storage.write = lambda data: writes.append(1) or write(data)
+    try:
+        result = collection['tiny'].bulk_write([
+            tm.InsertOne({'count': 100}),
+            tm.UpdateOne({'count': 0}, {'$set': {'countStr': 'zero'}}),
+            tm.UpdateMany({'count': {'$lt': 10}}, {'$inc': {'count': 1000}}),
+            tm.DeleteOne({'count': 99}),
+            tm.DeleteMany({'count': {'$gte': 1000}}),
+        ])
+        assert len(writes) == 1
+    finally:
+        del storage.write
+
+    assert result.inserted_count == 1
+    assert result.matched_count == 11
+    assert result.modified_count == 11
+    assert result.deleted_count == 11
+    assert collection['tiny'].find().count() == 90
+    assert collection['tiny'].find_one({'count': 100}) is not None
+
+    # the table is read once, the later operations see the earlier ones,
+    # through the indexes too
+    collection['tiny'].create_index('count')
+    reads = []
+    read = storage.read
+    storage.read = lambda: reads.append(1) or read()
+    try:
+        result = collection['tiny'].bulk_write([
+            tm.InsertOne({'count': 200}),
+            tm.UpdateOne({'count': 200}, {'$set': {'countStr': '200'}}),
+            tm.UpdateOne({'count': 201}, {'$set': {'n': 1}}, upsert=True),
+            tm.UpdateMany({'count': 202}, {'$inc': {'n': 1}}, upsert=True),
+            tm.UpdateMany({'count': {'$gte': 201}}, {'$inc': {'n': 1}}),
+            tm.DeleteOne({'count': 200}),
+        ])
+        assert len(reads) == 1
+    finally:
+        del storage.read
+
+    assert result.inserted_count == 1
+    assert result.upserted_count == 2
+    assert result.matched_count == 3
+    assert result.modified_count == 3
+    assert result.deleted_count == 1
+    assert result.upserted_ids == {
+        2: collection['tiny'].find_one({'count': 201})['_id'],
+        3: collection['tiny'].find_one({'count': 202})['_id'],
+    }
+    assert collection['tiny'].find_one({'count': 201})['n'] == 2
+    assert collection['tiny'].find_one({'count': 202})['n'] == 2
+    assert collection['tiny'].find_one({'count': 200}) is None
+
+    _id = collection['tiny'].find_one({'count': 50})['_id']
+    requests = [
+        tm.InsertOne({'_id': _id}),
+        tm.DeleteOne({'count': 51}),
+    ]
+    with pytest.raises(tm.BulkWriteError) as error:
+        collection['tiny'].bulk_write(requests)
+    assert error.value.details['writeErrors'][0]['index'] == 0
+    assert error.value.details['nRemoved'] == 0
+
+    with pytest.raises(tm.BulkWriteError) as error:
+        collection['tiny'].bulk_write(requests, ordered=False)
+    assert error.value.details['nRemoved'] == 1
+    assert collection['tiny'].find().count() == 91
+
+
 def test_delete_one(collection):
     """
     Testing the 'delete_one' method
@@ -466,6 +634,38 @@ def test_delete_many(collection):
     assert c.count() == 50
 
 
+def test_delete_single_write(collection):
+    """
+    Testing that deleting many documents writes the storage once
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    table = collection['tiny'].table
+    writes = []
+    write = table._write
+    table._write = lambda values: writes.append(1) or write(values)
+    try:
+        result = collection['tiny'].delete_many({'count': {'$lt': 30}})
+        assert result.deleted_count == 30
+        assert len(writes) == 1
+
+        result = collection['tiny'].remove({'countBool': True}, multi=False)
+        assert result.deleted_count == 1
+        assert len(writes) == 2
+
+        _id = collection['tiny'].find_one({'count': 99})['_id']
+        assert collection['tiny'].remove(_id).deleted_count == 1
+        assert collection['tiny'].delete_one({'count': -1}).deleted_count == 0
+        assert len(writes) == 3
+    finally:
+        del table._write
+
+    assert collection['tiny'].find().count() == 68
+    # like pymongo, removing None removes everything
+    assert collection['tiny'].remove(None).deleted_count == 68
+    assert collection['tiny'].find().count() == 0
+
+
 def test_insert_one(collection):
     """
     Testing the 'insert_one' method
@@ -519,6 +719,966 @@ def test_insert_one_with_list_input(collection):
         collection['tiny'].insert_one([{'my_object_name': 'my object value', 'count': 1000}])
 
 
+def test_insert_one_duplicate_id(collection):
+    """
+    Testing that 'insert_one' refuses an already existing '_id'
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    collection['tiny'].insert_one({'_id': 'my-id', 'count': 1000})
+    with pytest.raises(tm.DuplicateKeyError):
+        collection['tiny'].insert_one({'_id': 'my-id', 'count': 1001})
+
+    with pytest.raises(tm.DuplicateKeyError):
+        collection['tiny'].insert_many([{'_id': 'other-id'}, {'_id': 'other-id'}])
+
+    assert collection['tiny'].find({}).count() == 101
+
+
+def test_find_one_by_id(collection):
+    """
+    Testing the retrieval of a document by its '_id'
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    _id = collection['tiny'].insert_one({'count': 1000}).inserted_id
+    assert collection['tiny'].find_one({'_id': _id})['count'] == 1000
+
+    collection['tiny'].delete_one({'_id': _id})
+    assert collection['tiny'].find_one({'_id': _id}) is None
+    assert collection['tiny'].find({}).count() == 100
+
+    # the index is shared by every handle on the collection
+    tiny_database.tinyCollection.insert_one({'_id': _id, 'count': 1001})
+    assert collection['tiny'].find_one({'_id': _id})['count'] == 1001
+
+
+def test_create_index(collection):
+    """
+    Testing that queries give the same results with and without an index
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    queries = [
+        {'count': 50},
+        {'count': {'$in': [22, 44, 1000]}},
+        {'count': {'$gte': 10, '$lt': 20}},
+        {'countArray': 52},
+        {'mixedDict.countStr': {'$gt': '95'}},
+        {'$and': [{'count': {'$lte': 5}}, {'countBool': True}]},
+    ]
+    expected = [
+        [doc['_id'] for doc in collection['tiny'].find(query)]
+        for query in queries
+    ]
+
+    assert collection['tiny'].create_index('count') == 'count_1'
+    assert collection['tiny'].create_index([('countArray', -1)]) == 'countArray_-1'
+    collection['tiny'].create_index('mixedDict.countStr')
+
+    for query, ids in zip(queries, expected):
+        assert [doc['_id'] for doc in collection['tiny'].find(query)] == ids
+
+    # indexes are kept up to date by the writes
+    collection['tiny'].insert_one({'count': 1000})
+    collection['tiny'].delete_many({'count': {'$lt': 10}})
+    collection['tiny'].update_one({'count': 50}, {'$set': {'count': 2000}})
+    assert collection['tiny'].find({'count': {'$lt': 20}}).count() == 10
+    assert collection['tiny'].find({'count': {'$in': [50, 1000, 2000]}}).count() == 2
+
+    names = [index['name'] for index in collection['tiny'].list_indexes()]
+    assert sorted(names) == ['_id_', 'countArray_-1', 'count_1', 'mixedDict.countStr_1']
+
+    collection['tiny'].drop_index('count_1')
+    collection['tiny'].drop_index([('countArray', -1)])
+    collection['tiny'].drop_indexes()
+    assert list(collection['tiny'].index_information()) == ['_id_']
+    with pytest.raises(tm.OperationFailure):
+        collection['tiny'].drop_index('_id_')
+
+
+def test_index_fallbacks(collection):
+    """
+    Testing the conditions an index can not serve on its own: ranges on
+    arrays and regexes
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    c = collection['tiny']
+    c.insert_many([
+        {'tags': [1, 20], 'name': 'ab'},
+        {'tags': [7], 'name': 'ba'},
+        {'tags': 30, 'name': 'ac'},
+    ])
+    queries = [
+        {'tags': {'$gt': 5, '$lt': 10}},
+        {'tags': {'$gte': 20, '$lte': 1}},
+        {'name': re.compile('^a')},
+        {'name': {'$in': [re.compile('^a'), 'ba']}},
+    ]
+    expected = [[doc['_id'] for doc in c.find(query)] for query in queries]
+    assert [len(ids) for ids in expected] == [2, 1, 2, 3]
+
+    c.create_index('tags')
+    c.create_index('name')
+    for query, ids in zip(queries, expected):
+        assert [doc['_id'] for doc in c.find(query)] == ids
+        assert c.count_documents(query) == len(ids)
+
+
+def test_index_bool_equality(collection):
+    """
+    Testing that booleans and numbers do not equal each other, with or
+    without an index
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    c = collection['tiny']
+    c.insert_many([
+        {'flag': True},
+        {'flag': 1},
+        {'flag': [0, 2]},
+        {'flag': [False]},
+    ])
+    queries = [
+        {'flag': True},
+        {'flag': 1},
+        {'flag': {'$eq': False}},
+        {'flag': {'$in': [True, 0]}},
+        {'flag': {'$ne': 1}},
+        {'flag': {'$nin': [False]}},
+    ]
+    expected = [[doc['_id'] for doc in c.find(query)] for query in queries]
+    assert [len(ids) for ids in expected] == [1, 1, 1, 2, 103, 103]
+
+    c.create_index('flag')
+    for query, ids in zip(queries, expected):
+        assert [doc['_id'] for doc in c.find(query)] == ids
+        assert c.count_documents(query) == len(ids)
+
+
+def test_create_unique_index(collection):
+    """
+    Testing that unique indexes refuse duplicated values
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    with pytest.raises(tm.DuplicateKeyError):
+        collection['tiny'].create_index('countBool', unique=True)
+
+    collection['tiny'].create_index('countStr', unique=True)
+    with pytest.raises(tm.DuplicateKeyError):
+        collection['tiny'].insert_one({'countStr': '3'})
+    with pytest.raises(tm.DuplicateKeyError):
+        collection['tiny'].update_one({'count': 4}, {'$set': {'countStr': '3'}})
+    assert collection['tiny'].find_one({'count': 4})['countStr'] == '4'
+
+    # documents without the field count as null for non sparse indexes
+    collection['tiny'].insert_one({'count': 1000})
+    with pytest.raises(tm.DuplicateKeyError):
+        collection['tiny'].insert_one({'count': 1001})
+    collection['tiny'].drop_index('countStr_1')
+
+    # sparse unique indexes allow several documents without the field
+    collection['tiny'].create_index('username', unique=True, sparse=True)
+    collection['tiny'].insert_many([{'username': 'a'}, {'username': 'b'}])
+    with pytest.raises(tm.DuplicateKeyError):
+        collection['tiny'].insert_many([{'username': 'c'}, {'username': 'c'}])
+    assert collection['tiny'].find({}).count() == 103
+
+    collection['tiny'].drop_indexes()
+
+
+def test_explain(collection):
+    """
+    Testing that 'explain' reports the index used by a query
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    explain = collection['tiny'].find({'count': {'$gte': 90}}).explain()
+    assert explain['queryPlanner']['winningPlan']['stage'] == 'COLLSCAN'
+    assert explain['executionStats']['totalDocsExamined'] == 100
+    assert explain['executionStats']['nReturned'] == 10
+
+    # a cursor already iterated reports a single execution
+    cursor = collection['tiny'].find()
+    assert len(list(cursor)) == 100
+    explain = cursor.explain()
+    assert explain['executionStats']['totalDocsExamined'] == 100
+    assert explain['executionStats']['nReturned'] == 100
+
+    collection['tiny'].create_index('count')
+    collection['tiny'].create_index('countBool')
+
+    explain = collection['tiny'].find(
+        {'count': {'$gte': 90}, 'countBool': True}, limit=3
+    ).explain()
+    winning_plan = explain['queryPlanner']['winningPlan']
+    assert winning_plan['stage'] == 'LIMIT'
+    assert winning_plan['inputStage']['stage'] == 'FETCH'
+    assert winning_plan['inputStage']['inputStage']['indexName'] == 'count_1'
+    assert len(explain['queryPlanner']['rejectedPlans']) == 1
+    # the scan stops once the limit is reached
+    assert explain['executionStats']['totalDocsExamined'] == 6
+    assert explain['executionStats']['nReturned'] == 3
+    assert explain['executionStats']['executionTimeMillis'] >= 0
+
+    collection['tiny'].drop_indexes()
+
+
+def test_query_operators(collection):
+    """
+    Testing the query operators compared with MongoDB
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    queries = [
+        {'count': {'$nin': [1, 2, 3]}},
+        {'count': {'$eq': 7}},
+        {'countArray': {'$all': [10, 11]}},
+        {'countArray': {'$size': 5}},
+        {'countArray': {'$gt': 100}},
+        {'countDict.three': True, 'countDict.five': True},
+        {'dictArray.number': 42},
+        {'dictArray': {'$elemMatch': {'number': {'$gte': 102}}}},
+        {'countArray': {'$elemMatch': {'$gt': 50, '$lt': 52}}},
+        {'missing': {'$exists': False}},
+        {'mixedDict.countArray': {'$exists': True}},
+        {'missing': None},
+        {'$nor': [{'count': {'$lt': 90}}, {'countBool': True}]},
+        {'$or': [{'count': 5}, {'$and': [{'countStr': '6'}, {'countBool': False}]}]},
+    ]
+    for query in queries:
+        tiny_ids = [doc['_id'] for doc in collection['tiny'].find(query)]
+        mongo_ids = [doc['_id'] for doc in collection['mongo'].find(query)]
+        assert tiny_ids == mongo_ids, query
+
+    assert collection['tiny'].find({'count': {'$mod': [10, 3]}}).count() == 10
+
+    with pytest.raises(tm.OperationFailure):
+        collection['tiny'].find({'count': {'$bad': 1}})
+
+
+def test_query_cache(collection):
+    """
+    Testing that queries of the same shape share their compiled form
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    tm.query_cache.clear()
+
+    assert collection['tiny'].find({'count': {'$gte': 90}}).count() == 10
+    assert collection['tiny'].find({'count': {'$gte': 95}}).count() == 5
+    assert collection['tiny'].find({'count': {'$gte': '95'}}).count() == 0
+    info = tm.query_cache.info()
+    assert info['hits'] == 1
+    assert info['misses'] == 2
+    assert info['size'] == 2
+
+
+def test_cursor_streaming(collection):
+    """
+    Testing that the cursor pulls its documents lazily
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    c = collection['tiny'].find({'count': {'$gte': 10}}).batch_size(5)
+    assert next(c)['count'] == 10
+    assert c.next()['count'] == 11
+    # a single batch was read from the collection so far
+    assert c.plan.docs_examined == 15
+    assert c.hasNext() is True
+
+    assert [doc['count'] for doc in c][:3] == [10, 11, 12]
+    assert c.count() == 90
+    assert c.next()['count'] == 12
+
+    c = collection['tiny'].find({'count': {'$gte': 98}})
+    assert [doc['count'] for doc in c] == [98, 99]
+    assert [doc['count'] for doc in c] == [98, 99]
+    c.next()
+    c.next()
+    with pytest.raises(StopIteration):
+        c.next()
+
+    with pytest.raises(ValueError):
+        c.batch_size(-1)
+
+
+def test_skip_limit(collection):
+    """
+    Testing that skip and limit stop the scan early
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    c = collection['tiny'].find({'count': {'$gte': 0}}, skip=25, limit=10)
+    assert [doc['count'] for doc in c] == list(range(25, 35))
+    assert c.plan.docs_examined == 35
+
+    c = collection['tiny'].find({}, skip=95)
+    assert c.count() == 5
+
+    c = collection['tiny'].find().skip(7).limit(3)
+    assert [doc['count'] for doc in c] == [7, 8, 9]
+    assert c.count() == 3
+
+    assert collection['tiny'].find_one({'count': {'$gte': 42}})['count'] == 42
+    assert collection['tiny'].find_one(
+        {'count': {'$lt': 50}}, sort=[('count', -1)]
+    )['count'] == 49
+    assert collection['tiny'].find_one({'count': -1}) is None
+
+
+def test_sort_limit(collection):
+    """
+    Testing that a limited sort returns the head of the full sort
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    for sort in ([('count', -1)],
+                 [('countBool', -1), ('count', 1)],
+                 [('countStr', 1)]):
+        full = [doc['_id'] for doc in collection['tiny'].find(sort=sort)]
+        top = collection['tiny'].find(sort=sort, skip=3, limit=5)
+        assert [doc['_id'] for doc in top] == full[3:8]
+
+    c = collection['tiny'].find().sort('count', -1).limit(3)
+    assert [doc['count'] for doc in c] == [99, 98, 97]
+
+
+def test_journal_storage(tmpdir):
+    """
+    Testing the journal storage appends the writes and replays them
+    :param tmpdir: pytest fixture that returns a temporary folder
+    :return:
+    """
+    from tinymongo.storages import JournalStorage
+
+    folder = str(tmpdir)
+    client = tm.TinyMongoClient(folder, storage=JournalStorage)
+    users = client.journalDatabase.users
+    users.insert_many([{'name': 'user%d' % i, 'n': i} for i in range(20)])
+    snapshot = os.path.getsize(os.path.join(folder, 'journalDatabase.json'))
+    journal = os.path.join(folder, 'journalDatabase.json.journal')
+    size = os.path.getsize(journal)
+
+    users.update_one({'n': 3}, {'$set': {'name': 'three'}})
+    users.delete_one({'n': 4})
+    # only the journal grows, by a few records
+    assert os.path.getsize(
+        os.path.join(folder, 'journalDatabase.json')
+    ) == snapshot
+    assert 0 < os.path.getsize(journal) - size < 200
+
+    # a partially written record is dropped on open
+    with open(journal, 'a') as handle:
+        handle.write('{"set": {"users": {"99"')
+    client.close()
+
+    client = tm.TinyMongoClient(folder, storage=JournalStorage)
+    users = client.journalDatabase.users
+    assert users.find().count() == 19
+    assert users.find_one({'n': 3})['name'] == 'three'
+    assert users.find_one({'n': 4}) is None
+    assert os.path.getsize(journal) == 0
+
+    storage = users.parent.tinydb._storage.storage
+    storage.compact_threshold = 1
+    users.insert_one({'name': 'new', 'n': 20})
+    assert os.path.getsize(journal) == 0
+
+    # the stored documents are not shared with the callers
+    doc = {'name': 'nested', 'n': 21, 'tags': {'a': 1}}
+    users.insert_one(doc)
+    doc['tags']['a'] = 2
+    users.find_one({'n': 21})['tags']['a'] = 3
+    assert users.find_one({'n': 21})['tags'] == {'a': 1}
+
+    # the changes announced in a batch add up, those written straight
+    # through TinyDB are found by comparing the whole table
+    with users.parent.batch():
+        users.insert_one({'name': 'gone', 'n': 22})
+        users.update_one({'n': 21}, {'$set': {'tags': {'a': 4}}})
+        users.delete_one({'n': 22})
+    users.parent.tinydb.table('users').remove(
+        doc_ids=[users.find_one({'n': 0}).doc_id]
+    )
+    users.parent.tinydb._storage.storage.compact()
+    client.close()
+
+    client = tm.TinyMongoClient(folder)
+    assert client.journalDatabase.users.find().count() == 20
+    assert client.journalDatabase.users.find_one({'n': 0}) is None
+    assert client.journalDatabase.users.find_one({'n': 21})['tags'] == {'a': 4}
+
+
+def test_collection_layout(tmpdir):
+    """
+    Testing the layout storing each collection in its own file
+    :param tmpdir: pytest fixture that returns a temporary folder
+    :return:
+    """
+    folder = str(tmpdir)
+    client = tm.TinyMongoClient(folder, layout='collection')
+    db = client.layoutDatabase
+    users = db.users
+    users.insert_many([{'name': 'user%d' % i} for i in range(10)])
+    db.logs.insert_one({'event': 'login'})
+
+    database_folder = os.path.join(folder, 'layoutDatabase')
+    assert sorted(os.listdir(database_folder)) == ['logs.json', 'users.json']
+    assert db.collection_names() == ['logs', 'users']
+
+    assert users.drop() is True
+    assert db.collection_names() == ['logs']
+    assert users.find().count() == 0
+
+    client = tm.TinyMongoClient(folder, layout='collection')
+    assert client.layoutDatabase.logs.find_one()['event'] == 'login'
+
+    with pytest.raises(tm.ConfigurationError):
+        tm.TinyMongoClient(folder, layout='table')
+
+
+def test_client_handles(tmpdir):
+    """
+    Testing the client keeps its databases and collections open
+    :param tmpdir: pytest fixture that returns a temporary folder
+    :return:
+    """
+    with tm.TinyMongoClient(str(tmpdir)) as client:
+        db = client.handleDatabase
+        assert client['handleDatabase'] is db
+        assert db.users is db['users']
+        db.users.insert_one({'name': 'admin'})
+
+    assert not db._files
+    # closed handles open their files again when used
+    assert db.users.find_one()['name'] == 'admin'
+    assert client.handleDatabase is db
+    client.close()
+
+
+def test_batch(tmpdir):
+    """
+    Testing batched writes are written once and can be rolled back
+    :param tmpdir: pytest fixture that returns a temporary folder
+    :return:
+    """
+    with tm.TinyMongoClient(str(tmpdir)) as client:
+        db = client.batchDatabase
+        db.users.insert_one({'name': 'admin'})
+        storage = db.tinydb._storage.storage
+        writes = []
+        write = storage.write
+        storage.write = lambda data: writes.append(1) or write(data)
+
+        with client.start_session():
+            db.users.insert_one({'name': 'john'})
+            db.users.update_one({'name': 'john'}, {'$set': {'age': 30}})
+            client.otherDatabase.logs.insert_one({'event': 'signup'})
+            assert db.users.find_one({'name': 'john'})['age'] == 30
+            assert not writes
+        assert len(writes) == 1
+        assert client.otherDatabase.logs.count() == 1
+
+        with pytest.raises(ValueError):
+            with db.batch(rollback=True):
+                db.users.delete_many({})
+                db.users.insert_one({'name': 'jane'})
+                raise ValueError()
+        assert len(writes) == 1
+        assert sorted(doc['name'] for doc in db.users.find()) == [
+            'admin', 'john'
+        ]
+        assert db.users.find_one({'name': 'jane'}) is None
+        # the ids reset by delete_many are rolled back too
+        db.users.insert_one({'name': 'jack'})
+        assert db.users.count() == 3
+        db.users.delete_one({'name': 'jack'})
+
+        session = client.start_session(rollback=True)
+        db.users.insert_one({'name': 'jane'})
+        session.end_session()
+        assert session.has_ended
+        assert len(writes) == 4
+        assert db.users.find_one({'name': 'jane'})
+
+        # the documents held by a batch are not shared with the callers
+        with db.batch():
+            doc = {'name': 'joe', 'tags': ['a']}
+            db.users.insert_one(doc)
+            doc['tags'].append('b')
+            db.users.find_one({'name': 'john'})['tags'] = ['c']
+            db.users.find_one({'name': 'joe'})['tags'].append('d')
+            assert db.users.find_one({'name': 'joe'})['tags'] == ['a']
+
+    with tm.TinyMongoClient(str(tmpdir)) as client:
+        users = client.batchDatabase.users
+        assert users.find_one({'name': 'joe'})['tags'] == ['a']
+        assert 'tags' not in users.find_one({'name': 'john'})
+
+
+def test_session_threads(tmpdir):
+    """
+    Testing a session rolled back does not undo the writes of other threads
+    :param tmpdir: pytest fixture that returns a temporary folder
+    :return:
+    """
+    import threading
+
+    with tm.TinyMongoClient(str(tmpdir)) as client:
+        users = client.sessionDatabase.users
+        users.insert_one({'name': 'admin'})
+        started = threading.Event()
+        inserted = []
+
+        def work():
+            started.wait()
+            users.insert_one({'name': 'john'})
+            inserted.append(True)
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        with pytest.raises(ValueError):
+            with client.start_session(rollback=True):
+                users.insert_one({'name': 'jane'})
+                started.set()
+                # the other thread waits for the session to end
+                thread.join(0.2)
+                assert not inserted
+                raise ValueError()
+        thread.join()
+
+        assert inserted
+        assert sorted(doc['name'] for doc in users.find()) == [
+            'admin', 'john'
+        ]
+
+
+def test_threads(tmpdir):
+    """
+    Testing concurrent writes and finds on a collection
+    :param tmpdir: pytest fixture that returns a temporary folder
+    :return:
+    """
+    import threading
+
+    with tm.TinyMongoClient(str(tmpdir)) as client:
+        db = client.threadDatabase
+        errors = []
+
+        def work(worker):
+            try:
+                for count in range(20):
+                    db.users.insert_one({'worker': worker, 'count': count})
+                    assert db.users.find({'worker': worker}).count() == (
+                        count + 1
+                    )
+            except Exception as error:
+                errors.append(error)
+
+        threads = [
+            threading.Thread(target=work, args=(worker,))
+            for worker in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors
+        assert db.users.count() == 80
+        info = db.lock_info()
+        assert info['writes'] >= 80
+        assert info['read_wait_time'] >= 0
+
+
+def test_multiprocess(tmpdir):
+    """
+    Testing clients sharing a folder see each other's writes
+    :param tmpdir: pytest fixture that returns a temporary folder
+    :return:
+    """
+    # each client stands for a process, with its own lock file handle
+    first = tm.TinyMongoClient(str(tmpdir), multiprocess=True)
+    second = tm.TinyMongoClient(str(tmpdir), multiprocess=True)
+    first.db.users.create_index('name')
+    first.db.users.insert_one({'name': 'admin'})
+    assert second.db.users.find_one({'name': 'admin'})
+
+    second.db.users.insert_one({'name': 'john'})
+    second.db.users.update_one({'name': 'admin'}, {'$set': {'age': 30}})
+    assert first.db.users.find_one({'name': 'admin'})['age'] == 30
+    assert first.db.users.find_one({'name': 'john'})
+    first.db.users.insert_one({'name': 'jane'})
+    assert second.db.users.count() == 3
+
+    # nothing is read again while no other process writes
+    reloads = second.db.lock_info()['reloads']
+    for _ in range(3):
+        assert second.db.users.count() == 3
+    assert second.db.lock_info()['reloads'] == reloads
+
+    # the documents found are copies of the cached ones
+    found = second.db.users.find_one({'name': 'admin'})
+    found['tags'] = ['changed']
+    found = list(second.db.users.find({'name': 'john'}))[0]
+    found['name'] = 'changed'
+    assert 'tags' not in second.db.users.find_one({'name': 'admin'})
+    assert second.db.users.find_one({'name': 'john'})
+    assert second.db.lock_info()['reloads'] == reloads
+
+    first.close()
+    second.close()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason='needs asyncio')
+def test_async_client(tmpdir):
+    """
+    Testing the asyncio client
+    :param tmpdir: pytest fixture that returns a temporary folder
+    :return:
+    """
+    import asyncio
+    import threading
+    from tinydb.storages import JSONStorage
+
+    # threads the storage was used from
+    threads = set()
+
+    class RecordingStorage(JSONStorage):
+        def read(self):
+            threads.add(threading.current_thread())
+            return super(RecordingStorage, self).read()
+
+        def write(self, data):
+            threads.add(threading.current_thread())
+            super(RecordingStorage, self).write(data)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    run = loop.run_until_complete
+    client = tm.AsyncTinyMongoClient(
+        str(tmpdir), max_workers=2, storage=RecordingStorage
+    )
+    try:
+        users = client.asyncDatabase.users
+        run(asyncio.gather(*[
+            users.insert_one({'count': count}) for count in range(10)
+        ]))
+        assert run(users.count()) == 10
+
+        result = run(users.update_one({'count': 3}, {'$set': {'odd': True}}))
+        assert result.modified_count == 1
+        assert run(users.find_one({'count': 3}))['odd'] is True
+
+        cursor = users.find({'count': {'$gte': 5}}).sort('count').batch_size(2)
+        assert run(cursor.__anext__())['count'] == 5
+        assert [doc['count'] for doc in run(cursor.to_list())] == [6, 7, 8, 9]
+
+        assert run(users.delete_many({'count': {'$lt': 5}})).deleted_count == 5
+        assert len(run(users.find().to_list())) == 5
+
+        # nothing blocks the event loop
+        assert run(client.otherDatabase.items.find().to_list()) == []
+        assert threads
+        assert threading.current_thread() not in threads
+    finally:
+        client.close()
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 2), reason='needs futures')
+def test_parallel_scan(tmpdir):
+    """
+    Testing scans split across a pool give the results of a plain scan
+    :param tmpdir: pytest fixture that returns a temporary folder
+    :return:
+    """
+    from tinymongo.parallel import ParallelScan
+
+    scan = ParallelScan(processes=False, max_workers=3, threshold=50)
+    with tm.TinyMongoClient(str(tmpdir), parallel_scan=scan) as client:
+        numbers = client.parallelDatabase.numbers
+        numbers.insert_many([
+            {'count': count, 'name': 'n{0}'.format(count)}
+            for count in range(100)
+        ])
+        query = {
+            '$or': [{'count': {'$lt': 10}}, {'name': {'$regex': 'n.5$'}}]
+        }
+
+        docs = numbers.find(query)
+        assert [doc['count'] for doc in docs] == (
+            list(range(10)) + list(range(15, 100, 10))
+        )
+        assert scan._executor is not None
+        explain = numbers.find(query).explain()
+        assert explain['executionStats']['totalDocsExamined'] == 100
+        assert numbers.find(query).count() == 19
+        assert [
+            doc['count'] for doc in numbers.find(query).sort('count', -1)
+        ][:3] == [95, 85, 75]
+
+        # a limited scan stops at the limit instead
+        docs = numbers.find(query, limit=2)
+        assert [doc['count'] for doc in docs] == [0, 1]
+        explain = numbers.find(query, limit=2).explain()
+        assert explain['executionStats']['totalDocsExamined'] == 2
+
+    processes = ParallelScan(max_workers=2, threshold=50)
+    with tm.TinyMongoClient(str(tmpdir), parallel_scan=processes) as client:
+        assert client.parallelDatabase.numbers.find(query).count() == 19
+
+
+def test_aggregate(collection):
+    """
+    Testing the aggregation pipeline stages
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    c = collection['tiny']
+    docs = list(c.aggregate([
+        {'$match': {'count': {'$lt': 10}}},
+        {'$group': {
+            '_id': '$countBool',
+            'total': {'$sum': '$count'},
+            'docs': {'$sum': 1},
+            'average': {'$avg': '$count'},
+            'lowest': {'$min': '$count'},
+            'highest': {'$max': '$count'},
+            'counts': {'$push': '$count'},
+        }},
+        {'$sort': {'_id': 1}},
+    ]))
+    assert docs == [
+        {'_id': False, 'total': 20, 'docs': 5, 'average': 4.0,
+         'lowest': 0, 'highest': 8, 'counts': [0, 2, 4, 6, 8]},
+        {'_id': True, 'total': 25, 'docs': 5, 'average': 5.0,
+         'lowest': 1, 'highest': 9, 'counts': [1, 3, 5, 7, 9]},
+    ]
+
+    docs = list(c.aggregate([
+        {'$sort': {'count': -1}},
+        {'$skip': 1},
+        {'$limit': 2},
+        {'$project': {'_id': 0, 'count': 1, 'countDict.odd': 1,
+                      'first': '$countArray'}},
+        {'$unwind': '$first'},
+        {'$match': {'first': {'$gte': 101}}},
+        {'$count': 'total'},
+    ]))
+    assert docs == [{'total': 3}]
+
+    docs = list(c.aggregate([
+        {'$match': {'count': 3}},
+        {'$project': {'mixedDict': 0, 'countDict.three': 0}},
+    ]))
+    assert 'mixedDict' not in docs[0]
+    assert docs[0]['countDict'] == {'odd': True, 'even': False, 'five': False}
+    # the stored documents are left untouched
+    assert 'three' in c.find_one({'count': 3})['countDict']
+
+    with pytest.raises(tm.OperationFailure):
+        c.aggregate([{'$out': 'other'}])
+
+
+def test_count_documents(collection):
+    """
+    Testing counts from the indexes and from scans
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    c = collection['tiny']
+    assert c.estimated_document_count() == 100
+    assert c.count() == 100
+    assert c.count_documents({}) == 100
+    assert c.count_documents({'countBool': True}) == 50
+    assert c.count_documents({'count': {'$gte': 90}}) == 10
+    assert c.count_documents({'count': {'$gte': 90}}, skip=3) == 7
+    assert c.count_documents({'count': {'$gte': 90}}, skip=3, limit=5) == 5
+    assert c.count_documents({}, skip=98, limit=5) == 2
+
+    c.create_index('countStr')
+    assert c.count_documents({'countStr': '42'}) == 1
+    assert c.count_documents({'countArray': 4}) == 5
+    c.delete_many({'count': {'$lt': 10}})
+    c.insert_one({'countStr': '42'})
+    assert c.estimated_document_count() == 91
+    assert c.count_documents({'countStr': '42'}) == 2
+    assert c.count_documents({'countStr': '5'}) == 0
+
+
+def test_distinct(collection):
+    """
+    Testing the distinct values of fields, from scans and indexes
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    c = collection['tiny']
+    assert sorted(c.distinct('countBool')) == [False, True]
+    assert sorted(c.distinct('countDict.five')) == [False, True]
+    # arrays are flattened
+    assert sorted(c.distinct('countArray', {'count': {'$lt': 2}})) == [
+        0, 1, 2, 3, 4, 5
+    ]
+    assert sorted(c.distinct('dictArray.number', {'count': 0})) == [
+        0, 1, 2, 3, 4
+    ]
+    assert c.distinct('missing') == []
+
+    c.create_index('countStr')
+    assert len(c.distinct('countStr')) == 100
+    assert c.distinct('countStr', {'count': {'$in': [7, 8]}}) == ['7', '8']
+
+    # values are copies of the stored ones
+    c.distinct('countDict', {'count': 0})[0]['odd'] = 'changed'
+    assert c.find_one({'count': 0})['countDict']['odd'] is False
+
+
+def test_column_cache(collection):
+    """
+    Testing the queries filtering the columns of numeric fields
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    pytest.importorskip('numpy')
+    c = collection['tiny']
+    c.insert_many([
+        {'count': [1, 200]},
+        {'count': True},
+        {'count': 'five'},
+        {'count': 2 ** 60},
+        {'other': 1},
+    ])
+    queries = [
+        {'count': {'$gte': 10, '$lt': 20}},
+        {'count': {'$gt': 150}},
+        {'count': 1},
+        {'count': True},
+        {'count': {'$in': [3, 2 ** 60, False]}},
+        {'count': {'$lt': 5}, 'countBool': False},
+        {'$and': [{'count': {'$lte': 40}}, {'count': {'$ne': 30}}]},
+    ]
+    expected = [list(c.find(query)) for query in queries]
+
+    c.create_column_cache(['count', 'countBool'])
+    explain = c.find({'count': {'$gt': 95}}).explain()
+    winning = explain['queryPlanner']['winningPlan']
+    assert winning['inputStage']['stage'] == 'COLUMNSCAN'
+    assert explain['executionStats']['totalDocsExamined'] == 6
+    assert [list(c.find(query)) for query in queries] == expected
+    # True is not a candidate of 1, nor 1 of True, the unknown values
+    # [1, 200] and 2 ** 60 are candidates of both
+    for query in ({'count': True}, {'count': {'$in': [1]}}):
+        explain = c.find(query).explain()
+        assert explain['executionStats']['totalDocsExamined'] == 3
+
+    # writes patch the columns
+    c.update_one({'count': 12}, {'$set': {'count': 300}})
+    c.delete_many({'count': {'$lt': 10}})
+    c.insert_one({'count': 15})
+    found = c.find({'count': {'$gte': 10, '$lt': 20}})
+    assert [doc['count'] for doc in found] == [
+        10, 11, 13, 14, 15, 16, 17, 18, 19, 15
+    ]
+    # [1, 200] was deleted
+    assert c.count_documents({'count': {'$gt': 150}}) == 2
+
+    c.drop_column_cache()
+    explain = c.find({'count': {'$gt': 95}}).explain()
+    assert explain['queryPlanner']['winningPlan']['stage'] == 'COLLSCAN'
+
+
+def test_result_cache(collection):
+    """
+    Testing the cache of query results and its invalidation by writes
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    c = collection['tiny']
+    assert c.result_cache_info() is None
+    c.create_result_cache(max_entries=2)
+
+    query = {'count': {'$gte': 95}}
+    first = list(c.find(query, sort=[('count', -1)]))
+    assert [doc['count'] for doc in first] == [99, 98, 97, 96, 95]
+    # changing the results does not change the cached ones
+    first[0]['count'] = 'changed'
+    assert c.find(query).sort('count', -1)[0]['count'] == 99
+    assert c.find_one(query)['count'] == 95
+    assert c.find(query, limit=2, skip=1).count() == 2
+    assert c.count_documents(query) == 5
+    info = c.result_cache_info()
+    assert info['hits'] == 1
+    assert info['misses'] == 4
+    assert info['evictions'] == 2
+    assert info['size'] == 2
+    # without max_bytes the results are not measured
+    assert info['max_bytes'] is None
+    assert info['bytes'] == 0
+    assert c.count_documents(query) == 5
+    assert c.result_cache_info()['hit_ratio'] == 2 / 6.0
+
+    # every write invalidates the cached results
+    c.insert_one({'count': 100})
+    assert c.count_documents(query) == 6
+    c.update_one({'count': 100}, {'$set': {'count': 0}})
+    assert c.count_documents(query) == 5
+    c.delete_many({'count': {'$gte': 98}})
+    assert c.count_documents(query) == 3
+    assert [doc['count'] for doc in c.find(query)] == [95, 96, 97]
+    with pytest.raises(ValueError):
+        with c.parent.batch(rollback=True):
+            c.delete_many({})
+            assert c.find_one(query) is None
+            raise ValueError()
+    assert c.find_one(query)['count'] == 95
+
+    # results larger than the cache are not kept
+    c.create_result_cache(max_bytes=100)
+    assert len(list(c.find())) == 99
+    assert len(list(c.find())) == 99
+    assert c.result_cache_info()['hits'] == 0
+    assert c.count_documents({'count': 95}) == 1
+    assert 0 < c.result_cache_info()['bytes'] <= 100
+
+    c.drop_result_cache()
+    assert c.result_cache_info() is None
+
+
+def test_drop_keeps_caches(collection):
+    """
+    Testing dropping a collection drops its secondary indexes and empties
+    its caches, but keeps them
+    :param collection: pytest fixture that returns the collection
+    :return:
+    """
+    pytest.importorskip('numpy')
+    c = collection['tiny']
+    c.create_index('count')
+    c.create_column_cache(['countFloat'])
+    c.create_result_cache()
+    assert c.count_documents({'count': {'$gte': 95}}) == 5
+    try:
+        assert c.drop() is True
+        assert [index['name'] for index in c.list_indexes()] == ['_id_']
+        info = c.result_cache_info()
+        assert info['size'] == 0
+
+        c.insert_many([{'count': 96, 'countFloat': 1.5}, {'count': 1}])
+        assert c.count_documents({'count': {'$gte': 95}}) == 1
+        explain = c.find({'countFloat': {'$gt': 1}}).explain()
+        winning = explain['queryPlanner']['winningPlan']
+        assert winning['inputStage']['stage'] == 'COLUMNSCAN'
+        assert explain['executionStats']['nReturned'] == 1
+    finally:
+        c.drop_column_cache()
+        c.drop_result_cache()
+
+
 def test_and(collection):
     """
     Testing the '$and' query
@@ -2,3 +2,14 @@ try:
     from tinymongo.tinymongo import *  # noqa
 except ImportError:
     from tinymongo import *  # noqa
+
+try:
+    from tinymongo.aio import (  # noqa
+        AsyncTinyMongoClient,
+        AsyncTinyMongoCollection,
+        AsyncTinyMongoCursor,
+        AsyncTinyMongoDatabase
+    )
+except SyntaxError:
+    # asyncio needs Python 3.5+
+    pass
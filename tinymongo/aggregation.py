@@ -0,0 +1,516 @@
+"""Runs mongo aggregation pipelines over the documents of a collection"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from itertools import islice
+
+from .errors import OperationFailure
+from .filters import NUMBER_CLASSES, query_cache
+from .indexes import index_key
+from .updates import MISSING, _less
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def compile_pipeline(pipeline):
+    """
+    Validates a pipeline and builds its stages
+
+    The `$match`, `$sort`, `$skip` and `$limit` stages heading the pipeline
+    are turned into the arguments of a `find`, so they run through the
+    query planner, the indexes and the top-k sort of the cursors.
+
+    :param pipeline: list of stages, each a dict with a single key
+    :return: (find keyword arguments, list of stages), each stage being a
+             function taking an iterable of documents and returning an
+             iterator over its output documents
+    """
+    if not isinstance(pipeline, list):
+        raise TypeError(u'pipeline must be a list')
+
+    specs = list()
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise OperationFailure(
+                u'A pipeline stage specification object must contain '
+                u'exactly one field.'
+            )
+        name, spec = list(stage.items())[0]
+        if name not in STAGES:
+            raise OperationFailure(
+                u'Unrecognized pipeline stage name: {0!r}'.format(name)
+            )
+        specs.append((name, spec))
+
+    find_args = {}
+    position = 0
+    if position < len(specs) and specs[position][0] == u'$match':
+        find_args[u'filter'] = _check_match(specs[position][1])
+        position += 1
+    if position < len(specs) and specs[position][0] == u'$sort':
+        find_args[u'sort'] = _sort_spec(specs[position][1])
+        position += 1
+    while position < len(specs):
+        name, spec = specs[position]
+        if name == u'$skip' and not (u'skip' in find_args or
+                                     u'limit' in find_args):
+            find_args[u'skip'] = _check_count(name, spec, 0)
+        elif name == u'$limit' and u'limit' not in find_args:
+            find_args[u'limit'] = _check_count(name, spec, 1)
+        else:
+            break
+        position += 1
+
+    stages = list()
+    while position < len(specs):
+        name, spec = specs[position]
+        position += 1
+        if name == u'$sort' and position < len(specs) and \
+                specs[position][0] == u'$limit':
+            # only the first documents are kept while sorting
+            limit = _check_count(u'$limit', specs[position][1], 1)
+            stages.append(_sort_stage(spec, limit))
+            position += 1
+        else:
+            stages.append(STAGES[name](spec))
+    return find_args, stages
+
+
+def run_pipeline(docs, stages):
+    """
+    Streams documents through stages
+
+    :param docs: iterable of the input documents
+    :param stages: stages built by `compile_pipeline`
+    :return: iterator over the output documents
+    """
+    docs = iter(docs)
+    for stage in stages:
+        docs = stage(docs)
+    return docs
+
+
+def compile_expression(expression):
+    """
+    Builds a function computing an aggregation expression on a document
+
+    Supported expressions are field paths (`'$field.sub'`), `$literal`,
+    dicts and lists of expressions, and constants.
+
+    :param expression: the expression
+    :return: function taking a document and returning the value, MISSING
+             for a missing field
+    """
+    if isinstance(expression, basestring) and expression.startswith(u'$'):
+        parts = expression[1:].split(u'.')
+        return lambda doc: _resolve(doc, parts)
+
+    if isinstance(expression, dict):
+        keys = list(expression)
+        if len(keys) == 1 and keys[0].startswith(u'$'):
+            if keys[0] != u'$literal':
+                raise OperationFailure(
+                    u'Unrecognized expression {0!r}'.format(keys[0])
+                )
+            value = expression[keys[0]]
+            return lambda doc: value
+        fields = [
+            (key, compile_expression(value))
+            for key, value in expression.items()
+        ]
+
+        def make_dict(doc):
+            result = dict()
+            for key, compute in fields:
+                value = compute(doc)
+                if value is not MISSING:
+                    result[key] = value
+            return result
+        return make_dict
+
+    if isinstance(expression, list):
+        items = [compile_expression(item) for item in expression]
+
+        def make_list(doc):
+            values = [compute(doc) for compute in items]
+            return [None if value is MISSING else value for value in values]
+        return make_list
+
+    return lambda doc: expression
+
+
+def _resolve(value, parts):
+    """
+    Reads a dotted path, arrays met along it give the arrays of the values
+    of their documents
+
+    :return: the value, MISSING if absent
+    """
+    for position, part in enumerate(parts):
+        if isinstance(value, list):
+            rest = parts[position:]
+            values = [
+                _resolve(item, rest) for item in value
+                if isinstance(item, dict)
+            ]
+            return [item for item in values if item is not MISSING]
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def _with_value(doc, parts, value):
+    """
+    Copy of a document with the value at a dotted path replaced, sharing
+    the untouched parts with the original
+
+    :param doc: the document, left untouched
+    :return: the new document
+    """
+    new_doc = dict(doc)
+    container = new_doc
+    for part in parts[:-1]:
+        child = container.get(part)
+        child = dict(child) if isinstance(child, dict) else {}
+        container[part] = child
+        container = child
+    container[parts[-1]] = value
+    return new_doc
+
+
+def _check_match(spec):
+    """Validates the filter of a $match stage"""
+    if not isinstance(spec, dict):
+        raise OperationFailure(u'the match filter must be an expression in '
+                               u'an object')
+    return spec
+
+
+def _check_count(name, spec, minimum):
+    """Validates the number of a $skip or $limit stage"""
+    if isinstance(spec, bool) or not isinstance(spec, NUMBER_CLASSES) or \
+            int(spec) != spec or spec < minimum:
+        raise OperationFailure(
+            u'invalid argument to {0} stage: {1!r}'.format(name, spec)
+        )
+    return int(spec)
+
+
+def _sort_spec(spec):
+    """Turns the dict of a $sort stage into a cursor sort list"""
+    if not isinstance(spec, dict) or not spec:
+        raise OperationFailure(u'the $sort key specification must be an '
+                               u'object')
+    for direction in spec.values():
+        if direction not in (1, -1):
+            raise OperationFailure(
+                u'$sort key ordering must be 1 (for ascending) or -1 (for '
+                u'descending)'
+            )
+    return list(spec.items())
+
+
+def _match_stage(spec):
+    """$match: keeps the documents matching a query"""
+    matches = query_cache.compile(_check_match(spec))
+
+    def match(docs):
+        return (doc for doc in docs if matches(doc))
+    return match
+
+
+def _sort_stage(spec, limit=None):
+    """$sort: sorts the documents, keeping only the first `limit`"""
+    # the cursors know how to sort documents like MongoDB
+    from .tinymongo import TinyMongoCursor
+    sort = _sort_spec(spec)
+
+    def sort_docs(docs):
+        cursor = TinyMongoCursor(lambda: docs, sort=sort, limit=limit)
+        return iter(cursor)
+    return sort_docs
+
+
+def _skip_stage(spec):
+    """$skip: drops the first documents"""
+    skip = _check_count(u'$skip', spec, 0)
+    return lambda docs: islice(docs, skip, None)
+
+
+def _limit_stage(spec):
+    """$limit: keeps the first documents"""
+    limit = _check_count(u'$limit', spec, 1)
+    return lambda docs: islice(docs, limit)
+
+
+def _project_stage(spec):
+    """$project: keeps, removes or computes fields"""
+    if not isinstance(spec, dict) or not spec:
+        raise OperationFailure(u'$project specification must be an object')
+
+    id_spec = spec.get(u'_id', True)
+    include_id = id_spec is not False and id_spec != 0
+    compute_id = None
+    if not isinstance(id_spec, (bool, int)):
+        compute_id = compile_expression(id_spec)
+
+    excluded, included, computed = list(), list(), list()
+    for field, value in spec.items():
+        if field == u'_id':
+            continue
+        parts = field.split(u'.')
+        if value is False or (not isinstance(value, bool) and value == 0):
+            excluded.append(parts)
+        elif value is True or (not isinstance(value, bool) and value == 1):
+            included.append(parts)
+        else:
+            computed.append((parts, compile_expression(value)))
+
+    if excluded and (included or computed):
+        raise OperationFailure(
+            u'Cannot do exclusion on field {0} in inclusion '
+            u'projection'.format(u'.'.join(excluded[0]))
+        )
+
+    if excluded or not (included or computed):
+        def exclude(doc):
+            new_doc = dict(doc)
+            for parts in excluded:
+                _remove(new_doc, parts)
+            if not include_id:
+                new_doc.pop(u'_id', None)
+            return new_doc
+        return lambda docs: (exclude(doc) for doc in docs)
+
+    def include(doc):
+        new_doc = dict()
+        if compute_id is not None:
+            value = compute_id(doc)
+            if value is not MISSING:
+                new_doc[u'_id'] = value
+        elif include_id and u'_id' in doc:
+            new_doc[u'_id'] = doc[u'_id']
+        for parts in included:
+            _include(doc, new_doc, parts)
+        for parts, compute in computed:
+            value = compute(doc)
+            if value is not MISSING:
+                new_doc = _with_value(new_doc, parts, value)
+        return new_doc
+    return lambda docs: (include(doc) for doc in docs)
+
+
+def _include(source, target, parts):
+    """Copies a dotted path of `source` into `target`, projecting the
+    documents of the arrays met along the way"""
+    key = parts[0]
+    if key not in source:
+        return
+    value = source[key]
+    if len(parts) == 1:
+        target[key] = value
+    elif isinstance(value, dict):
+        _include(value, target.setdefault(key, {}), parts[1:])
+    elif isinstance(value, list):
+        items = [item for item in value if isinstance(item, dict)]
+        projected = target.setdefault(key, [{} for _ in items])
+        for item, projected_item in zip(items, projected):
+            _include(item, projected_item, parts[1:])
+
+
+def _remove(doc, parts):
+    """Removes a dotted path from a copied document, copying the nested
+    dicts and arrays it changes"""
+    key = parts[0]
+    if len(parts) == 1:
+        doc.pop(key, None)
+        return
+    child = doc.get(key)
+    if isinstance(child, dict):
+        child = dict(child)
+        _remove(child, parts[1:])
+        doc[key] = child
+    elif isinstance(child, list):
+        items = list()
+        for item in child:
+            if isinstance(item, dict):
+                item = dict(item)
+                _remove(item, parts[1:])
+            items.append(item)
+        doc[key] = items
+
+
+def _unwind_stage(spec):
+    """$unwind: outputs a document per item of an array field"""
+    if isinstance(spec, dict):
+        path = spec.get(u'path')
+        index_field = spec.get(u'includeArrayIndex')
+        preserve = spec.get(u'preserveNullAndEmptyArrays', False)
+    else:
+        path, index_field, preserve = spec, None, False
+    if not isinstance(path, basestring) or not path.startswith(u'$'):
+        raise OperationFailure(
+            u'path option to $unwind stage should be prefixed with a '
+            u"'$': {0!r}".format(path)
+        )
+    parts = path[1:].split(u'.')
+
+    def unwind(docs):
+        for doc in docs:
+            value = _resolve(doc, parts)
+            if isinstance(value, list) and value:
+                for position, item in enumerate(value):
+                    new_doc = _with_value(doc, parts, item)
+                    if index_field:
+                        new_doc[index_field] = position
+                    yield new_doc
+            elif value is MISSING or value is None or value == []:
+                if preserve:
+                    if index_field:
+                        doc = dict(doc)
+                        doc[index_field] = None
+                    yield doc
+            else:
+                # a single value unwinds like a one item array
+                if index_field:
+                    doc = dict(doc)
+                    doc[index_field] = None
+                yield doc
+    return unwind
+
+
+def _sum_add(state, value):
+    if isinstance(value, NUMBER_CLASSES) and not isinstance(value, bool):
+        state[0] += value
+
+
+def _avg_add(state, value):
+    if isinstance(value, NUMBER_CLASSES) and not isinstance(value, bool):
+        state[0] += value
+        state[1] += 1
+
+
+def _avg_result(state):
+    return state[0] / float(state[1]) if state[1] else None
+
+
+def _min_add(state, value):
+    if value is not MISSING and value is not None and (
+            state[0] is MISSING or _less(value, state[0])):
+        state[0] = value
+
+
+def _max_add(state, value):
+    if value is not MISSING and value is not None and (
+            state[0] is MISSING or _less(state[0], value)):
+        state[0] = value
+
+
+def _extremum_result(state):
+    return None if state[0] is MISSING else state[0]
+
+
+def _push_add(state, value):
+    if value is not MISSING:
+        state[0].append(value)
+
+
+# accumulator: (new state, add a value to a state, result of a state)
+ACCUMULATORS = {
+    u'$sum': (lambda: [0], _sum_add, lambda state: state[0]),
+    u'$avg': (lambda: [0, 0], _avg_add, _avg_result),
+    u'$min': (lambda: [MISSING], _min_add, _extremum_result),
+    u'$max': (lambda: [MISSING], _max_add, _extremum_result),
+    u'$push': (lambda: [list()], _push_add, lambda state: state[0]),
+}
+
+
+def _group_stage(spec):
+    """$group: outputs a document per distinct `_id`, with accumulated
+    fields"""
+    if not isinstance(spec, dict) or u'_id' not in spec:
+        raise OperationFailure(
+            u"a group specification must include an _id"
+        )
+    compute_id = compile_expression(spec[u'_id'])
+
+    fields = list()
+    for field, accumulator in spec.items():
+        if field == u'_id':
+            continue
+        if u'.' in field:
+            raise OperationFailure(
+                u"the group aggregate field name '{0}' cannot be used "
+                u"because $group's field names cannot contain "
+                u"'.'".format(field)
+            )
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise OperationFailure(
+                u"the group aggregate field '{0}' must be defined as an "
+                u"expression inside an object".format(field)
+            )
+        name, expression = list(accumulator.items())[0]
+        if name not in ACCUMULATORS:
+            raise OperationFailure(
+                u"unknown group operator '{0}'".format(name)
+            )
+        fields.append(
+            (field, ACCUMULATORS[name], compile_expression(expression))
+        )
+
+    def group(docs):
+        groups = OrderedDict()
+        for doc in docs:
+            _id = compute_id(doc)
+            if _id is MISSING:
+                _id = None
+            key = index_key(_id)
+            entry = groups.get(key)
+            if entry is None:
+                entry = groups[key] = (
+                    _id, [accumulator[0]() for _, accumulator, _ in fields]
+                )
+            for (_, accumulator, compute), state in zip(fields, entry[1]):
+                accumulator[1](state, compute(doc))
+
+        for _id, states in groups.values():
+            result = {u'_id': _id}
+            for (field, accumulator, _), state in zip(fields, states):
+                result[field] = accumulator[2](state)
+            yield result
+    return group
+
+
+def _count_stage(spec):
+    """$count: outputs the number of documents, nothing if there are
+    none"""
+    if not isinstance(spec, basestring) or not spec or \
+            spec.startswith(u'$') or u'.' in spec:
+        raise OperationFailure(
+            u'the count field must be a non-empty string, not start with '
+            u"'$' and not contain '.'"
+        )
+
+    def count(docs):
+        total = sum(1 for _ in docs)
+        if total:
+            yield {spec: total}
+    return count
+
+
+STAGES = {
+    u'$match': _match_stage,
+    u'$project': _project_stage,
+    u'$group': _group_stage,
+    u'$sort': _sort_stage,
+    u'$skip': _skip_stage,
+    u'$limit': _limit_stage,
+    u'$unwind': _unwind_stage,
+    u'$count': _count_stage,
+}
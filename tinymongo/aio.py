@@ -0,0 +1,378 @@
+"""Asyncio flavour of the TinyMongo client, needs Python 3.5+"""
+# coding: utf-8
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+from .tinymongo import TinyMongoClient
+
+
+class AsyncTinyMongoClient(object):
+    """
+    Asyncio client to TinyDB, with the API of `TinyMongoClient`
+
+    The blocking work, opening the files, planning, scans and file I/O,
+    runs on a bounded pool of threads so the event loop never waits on it:
+
+        client = AsyncTinyMongoClient('/path/to/folder')
+        users = client.my_tiny_database.users
+        await users.insert_one({'name': 'John'})
+        async for user in users.find({'name': 'John'}):
+            print(user)
+    """
+
+    def __init__(self, foldername=u"tinydb", max_workers=4, executor=None,
+                 **kwargs):
+        """
+        Initialize the client
+
+        :param foldername: folder of the database files
+        :param max_workers: number of threads running the blocking work
+        :param executor: concurrent.futures executor to use instead of a
+                         pool of `max_workers` threads, left open on close
+        :param kwargs: arguments of `TinyMongoClient`
+        """
+        self.delegate = TinyMongoClient(foldername, **kwargs)
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._executor = executor
+        self._databases = {}
+
+    def _run(self, function, *args, **kwargs):
+        """
+        Runs a blocking function on the executor
+
+        :return: future of the function result
+        """
+        return asyncio.get_event_loop().run_in_executor(
+            self._executor, partial(function, *args, **kwargs)
+        )
+
+    def __getitem__(self, key):
+        """Gets a new or existing database based in key"""
+        database = self._databases.get(key)
+        if database is None:
+            database = self._databases.setdefault(
+                key, AsyncTinyMongoDatabase(self, key)
+            )
+        return database
+
+    def __getattr__(self, name):
+        """Gets a new or existing database based in attribute"""
+        if name.startswith(u'_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def close(self):
+        """Closes the database files and stops the threads of the client"""
+        self.delegate.close()
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+
+
+class AsyncTinyMongoDatabase(object):
+    """
+    Asyncio representation of a database, the database is opened on the
+    executor by its first operation
+    """
+
+    def __init__(self, client, name):
+        """
+        :param client: the AsyncTinyMongoClient
+        :param name: the database name
+        """
+        self.client = client
+        self.name = name
+        self._delegate = None
+        self._collections = {}
+        self._write_lock = None
+
+    @property
+    def delegate(self):
+        """The TinyMongoDatabase, opening it blocks"""
+        if self._delegate is None:
+            self._delegate = self.client.delegate[self.name]
+        return self._delegate
+
+    @property
+    def write_lock(self):
+        """
+        asyncio lock letting one write of the database at a time on the
+        executor, so queued writes do not hold threads that finds need
+        """
+        if self._write_lock is None:
+            # created here, to belong to the running event loop
+            self._write_lock = asyncio.Lock()
+        return self._write_lock
+
+    def __getitem__(self, name):
+        """Gets a new or existing collection"""
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections.setdefault(
+                name, AsyncTinyMongoCollection(self, name)
+            )
+        return collection
+
+    def __getattr__(self, name):
+        """Gets a new or existing collection"""
+        if name.startswith(u'_'):
+            raise AttributeError(name)
+        return self[name]
+
+    async def collection_names(self):
+        """Get a list of all the collection names in this database"""
+        return await self.client._run(
+            lambda: self.delegate.collection_names()
+        )
+
+
+class AsyncTinyMongoCollection(object):
+    """
+    Asyncio representation of a collection, the collection is opened on
+    the executor by its first operation
+    """
+
+    def __init__(self, database, name):
+        """
+        :param database: the AsyncTinyMongoDatabase
+        :param name: the collection name
+        """
+        self.database = database
+        self.name = name
+        self._delegate = None
+
+    def __repr__(self):
+        """Return collection name"""
+        return self.name
+
+    @property
+    def delegate(self):
+        """The TinyMongoCollection, opening it blocks"""
+        if self._delegate is None:
+            collection = self.database.delegate[self.name]
+            if collection.table is None:
+                collection.build_table()
+            self._delegate = collection
+        return self._delegate
+
+    def _call(self, method, *args, **kwargs):
+        """Calls a method of the TinyMongoCollection, blocking"""
+        return getattr(self.delegate, method)(*args, **kwargs)
+
+    async def _read(self, function, *args, **kwargs):
+        """Runs a blocking read on the executor"""
+        return await self.database.client._run(function, *args, **kwargs)
+
+    async def _write(self, function, *args, **kwargs):
+        """Runs a blocking write on the executor, one per database"""
+        async with self.database.write_lock:
+            return await self.database.client._run(function, *args, **kwargs)
+
+    def find(self, filter=None, *args, **kwargs):
+        """
+        Finds all matching results, nothing runs before the cursor is
+        iterated
+
+        :param filter: dictionary representing the mongo query
+        :return: AsyncTinyMongoCursor
+        """
+        return AsyncTinyMongoCursor(self, filter, *args, **kwargs)
+
+    async def find_one(self, filter=None, *args, **kwargs):
+        """
+        Finds one matching query element
+
+        :param filter: dictionary representing the mongo query
+        :return: the resulting document (if found)
+        """
+        return await self._read(self._call, u'find_one', filter,
+                                *args, **kwargs)
+
+    async def count(self):
+        """Counts the documents in the collection"""
+        return await self._read(self._call, u'count')
+
+    async def insert_one(self, doc, *args, **kwargs):
+        """
+        Inserts one document into the collection
+
+        :param doc: the document
+        :return: InsertOneResult
+        """
+        return await self._write(self._call, u'insert_one', doc,
+                                 *args, **kwargs)
+
+    async def insert_many(self, docs, *args, **kwargs):
+        """
+        Inserts several documents into the collection
+
+        :param docs: a list of documents
+        :return: InsertManyResult
+        """
+        return await self._write(self._call, u'insert_many', docs,
+                                 *args, **kwargs)
+
+    async def update_one(self, query, doc, *args, **kwargs):
+        """
+        Updates one element of the collection
+
+        :param query: dictionary representing the mongo query
+        :param doc: dictionary of update operators
+        :return: UpdateResult
+        """
+        return await self._write(self._call, u'update_one', query, doc,
+                                 *args, **kwargs)
+
+    async def update_many(self, query, doc, *args, **kwargs):
+        """
+        Updates all the elements of the collection matching the query
+
+        :param query: dictionary representing the mongo query
+        :param doc: dictionary of update operators
+        :return: UpdateResult
+        """
+        return await self._write(self._call, u'update_many', query, doc,
+                                 *args, **kwargs)
+
+    async def delete_one(self, query):
+        """
+        Deletes one document from the collection
+
+        :param query: dictionary representing the mongo query
+        :return: DeleteResult
+        """
+        return await self._write(self._call, u'delete_one', query)
+
+    async def delete_many(self, query):
+        """
+        Removes all items matching the mongo query
+
+        :param query: dictionary representing the mongo query
+        :return: DeleteResult
+        """
+        return await self._write(self._call, u'delete_many', query)
+
+    async def bulk_write(self, requests, ordered=True, *args, **kwargs):
+        """
+        Runs a batch of write operations
+
+        :param requests: list of write operations
+        :return: BulkWriteResult
+        """
+        return await self._write(self._call, u'bulk_write', requests,
+                                 ordered, *args, **kwargs)
+
+    async def drop(self, **kwargs):
+        """Removes the collection from the database"""
+        return await self._write(self._call, u'drop', **kwargs)
+
+
+class AsyncTinyMongoCursor(object):
+    """
+    Asyncio iterable cursor, the query is planned and the documents are
+    fetched on the executor by batches
+    """
+
+    #: Number of documents fetched at once
+    BATCH_SIZE = 100
+
+    def __init__(self, collection, filter=None, *args, **kwargs):
+        """
+        :param collection: the AsyncTinyMongoCollection
+        :param filter: dictionary representing the mongo query
+        :param args: arguments of `TinyMongoCollection.find`
+        """
+        self.collection = collection
+        self.delegate = None
+        self._find_args = (filter,) + args, kwargs
+        # cursor methods called before the cursor is created
+        self._options = list()
+        self._iterator = None
+        self._buffer = []
+        self._batch_size = self.BATCH_SIZE
+
+    def _option(self, method, *args):
+        """Calls a method of the TinyMongoCursor, once it is created"""
+        if self.delegate is None:
+            self._options.append((method, args))
+        else:
+            getattr(self.delegate, method)(*args)
+        return self
+
+    def sort(self, key_or_list, direction=None):
+        """Sorts the cursor, see `TinyMongoCursor.sort`"""
+        return self._option(u'sort', key_or_list, direction)
+
+    def skip(self, skip):
+        """Skips documents, see `TinyMongoCursor.skip`"""
+        return self._option(u'skip', skip)
+
+    def limit(self, limit):
+        """Limits the documents, see `TinyMongoCursor.limit`"""
+        return self._option(u'limit', limit)
+
+    def batch_size(self, batch_size):
+        """
+        Sets the number of documents fetched from the executor at once
+
+        :param batch_size: positive number of documents
+        """
+        self._option(u'batch_size', batch_size)
+        self._batch_size = batch_size or self.BATCH_SIZE
+        return self
+
+    def _open(self):
+        """Creates the TinyMongoCursor, blocking"""
+        if self.delegate is None:
+            args, kwargs = self._find_args
+            cursor = self.collection.delegate.find(*args, **kwargs)
+            for method, option_args in self._options:
+                getattr(cursor, method)(*option_args)
+            self.delegate = cursor
+        return self.delegate
+
+    def _fetch(self, length):
+        """Pulls the next documents of the search, blocking"""
+        if self._iterator is None:
+            self._iterator = iter(self._open())
+        return list(islice(self._iterator, length))
+
+    def _count(self):
+        """Counts the documents of the search, blocking"""
+        return self._open().count()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._buffer:
+            self._buffer = await self.collection._read(
+                self._fetch, self._batch_size
+            )
+            self._buffer.reverse()
+        if not self._buffer:
+            raise StopAsyncIteration
+        return self._buffer.pop()
+
+    async def to_list(self, length=None):
+        """
+        Gets the remaining documents
+
+        :param length: maximum number of documents, all if None
+        :return: list of documents
+        """
+        docs = list()
+        while length is None or len(docs) < length:
+            try:
+                docs.append(await self.__anext__())
+            except StopAsyncIteration:
+                break
+        return docs
+
+    async def count(self):
+        """Counts the documents the cursor matches"""
+        return await self.collection._read(self._count)
@@ -0,0 +1,133 @@
+"""Cache of query results, invalidated by writes"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import copy
+import json
+import threading
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    """
+    Bounded LRU cache of the results of the queries of a collection
+
+    Each entry is tagged with the write generation of the collection it was
+    computed at. Every write bumps the generation, so the first lookup
+    after a write finds the entries stale and drops them all at once.
+
+    The results are copied in and out of the cache, changing them does not
+    change the cached ones.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=None):
+        """
+        Initialize an empty cache
+
+        :param max_entries: number of results to keep
+        :param max_bytes: total size of the results to keep, measured as
+                          JSON, larger results are not cached; None keeps
+                          the results whatever their size, without the
+                          cost of measuring them
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._generation = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Number of results in the cache"""
+        return len(self._entries)
+
+    @staticmethod
+    def key(*parts):
+        """
+        Returns a hashable key for parts of a query, like its filter
+
+        :param parts: JSON like values, other values are keyed by repr
+        """
+        return json.dumps(parts, sort_keys=True, default=repr)
+
+    def _expire(self, generation):
+        """Drops every entry if the collection was written to since"""
+        if generation != self._generation:
+            self._entries.clear()
+            self._bytes = 0
+            self._generation = generation
+
+    def get(self, key, generation):
+        """
+        Looks a result up
+
+        :param key: the key of the query, see `key`
+        :param generation: the current write generation of the collection
+        :return: (True, copy of the result) on a hit, (False, None) on a
+                 miss
+        """
+        with self._lock:
+            self._expire(generation)
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self._entries[key] = entry
+        return True, copy.deepcopy(entry[0])
+
+    def put(self, key, generation, value):
+        """
+        Stores a result, evicting the least recently used ones to make room
+
+        :param key: the key of the query, see `key`
+        :param generation: the write generation of the collection when the
+                           result started being computed
+        :param value: the result
+        """
+        size = 0
+        if self.max_bytes is not None:
+            size = len(self.key(value))
+            if size > self.max_bytes:
+                return
+        value = copy.deepcopy(value)
+        with self._lock:
+            if generation != self._generation:
+                # written to meanwhile, the result may be stale already
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or \
+                    self.max_bytes is not None and \
+                    self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def info(self):
+        """Statistics of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            u'hits': self.hits,
+            u'misses': self.misses,
+            u'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            u'evictions': self.evictions,
+            u'size': len(self._entries),
+            u'bytes': self._bytes,
+            u'max_entries': self.max_entries,
+            u'max_bytes': self.max_bytes,
+        }
+
+    def clear(self):
+        """Empties the cache and resets its statistics"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = 0
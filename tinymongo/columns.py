@@ -0,0 +1,257 @@
+"""Columnar cache of numeric fields, filtered with NumPy"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    # optional dependency
+    numpy = None
+
+from .errors import ConfigurationError
+from .filters import NUMBER_CLASSES, make_getter
+
+# kind of the value of a field in a row
+MISSING = 0
+NUMBER = 1
+BOOLEAN = 2
+# arrays, huge integers, NaN: only the document predicate can tell
+UNKNOWN = 3
+
+# integers above this lose precision as floats
+_MAX_EXACT = 2 ** 53
+
+_COMPARISONS = {
+    u'$gt': lambda values, target: values > target,
+    u'$gte': lambda values, target: values >= target,
+    u'$lt': lambda values, target: values < target,
+    u'$lte': lambda values, target: values <= target,
+}
+
+
+def _classify(values):
+    """
+    Turns the values found at a field path into a (kind, number) pair
+
+    :param values: list of values, as returned by the getters of
+                   `make_getter`
+    """
+    if not values:
+        return MISSING, 0.0
+    if len(values) > 1:
+        return UNKNOWN, 0.0
+    value = values[0]
+    if isinstance(value, bool):
+        return BOOLEAN, float(value)
+    if isinstance(value, NUMBER_CLASSES):
+        if value != value or abs(value) > _MAX_EXACT:
+            return UNKNOWN, 0.0
+        return NUMBER, float(value)
+    if isinstance(value, (list, dict)):
+        return UNKNOWN, 0.0
+    # strings, None... never match a number or a boolean
+    return MISSING, 0.0
+
+
+def _is_number(value):
+    """True for numbers exactly represented as floats"""
+    return isinstance(value, NUMBER_CLASSES) and \
+        not isinstance(value, bool) and value == value and \
+        abs(value) <= _MAX_EXACT
+
+
+def _is_scalar(value):
+    """True for the values equalities on the columns support"""
+    return isinstance(value, bool) or _is_number(value)
+
+
+def _kind_of(value):
+    """Kind of a value `_is_scalar` accepts"""
+    return BOOLEAN if isinstance(value, bool) else NUMBER
+
+
+class ColumnCache(object):
+    """
+    Numeric and boolean fields of a collection kept as NumPy arrays
+
+    Each row holds a document id, and for each field the kind of its value
+    (missing or not a number, number, boolean, or unknown) and its value as
+    a float. Range comparisons with numbers, and equalities and `$in` with
+    numbers and booleans, are evaluated on whole columns at once, giving
+    the ids of the documents that may match. Documents whose value the
+    columns can not represent, like arrays, are always candidates, the
+    query itself is still checked on every candidate.
+
+    The rows are appended on inserts and flagged on deletes, so writes
+    patch the columns instead of rebuilding them.
+    """
+
+    def __init__(self, fields):
+        """
+        Initialize empty columns
+
+        :param fields: list of the dotted paths of the fields to keep
+        """
+        if numpy is None:
+            raise ConfigurationError(u'column caches need the numpy module')
+        self.fields = list(fields)
+        self._getters = [make_getter(field) for field in self.fields]
+        self.clear()
+
+    def clear(self):
+        """Removes every row"""
+        self._size = 0
+        self._capacity = 0
+        self._deleted = 0
+        self._rows = {}
+        self._doc_ids = numpy.zeros(0, dtype=numpy.int64)
+        self._alive = numpy.zeros(0, dtype=bool)
+        self._kinds = [numpy.zeros(0, dtype=numpy.int8) for _ in self.fields]
+        self._numbers = [numpy.zeros(0) for _ in self.fields]
+
+    def __len__(self):
+        """Number of documents in the columns"""
+        return self._size - self._deleted
+
+    def build(self, data):
+        """
+        Fills the columns from the documents of a collection
+
+        :param data: dict of the documents by doc id
+        """
+        self.clear()
+        self._grow(len(data))
+        for doc_id, doc in data.items():
+            self.add(doc_id, doc)
+
+    def _grow(self, needed):
+        """Makes room for `needed` more rows"""
+        if self._size + needed <= self._capacity:
+            return
+        capacity = max(self._size + needed, 2 * self._capacity, 64)
+
+        def resize(array):
+            grown = numpy.zeros(capacity, dtype=array.dtype)
+            grown[:self._size] = array[:self._size]
+            return grown
+        self._doc_ids = resize(self._doc_ids)
+        self._alive = resize(self._alive)
+        self._kinds = [resize(kinds) for kinds in self._kinds]
+        self._numbers = [resize(numbers) for numbers in self._numbers]
+        self._capacity = capacity
+
+    def add(self, doc_id, doc):
+        """Appends the row of a newly written document"""
+        self._grow(1)
+        row = self._size
+        self._size += 1
+        self._rows[doc_id] = row
+        self._doc_ids[row] = doc_id
+        self._alive[row] = True
+        for position, getter in enumerate(self._getters):
+            kind, number = _classify(getter(doc))
+            self._kinds[position][row] = kind
+            self._numbers[position][row] = number
+
+    def remove(self, doc_id, doc=None):
+        """Flags the row of a deleted document"""
+        row = self._rows.pop(doc_id, None)
+        if row is None:
+            return
+        self._alive[row] = False
+        self._deleted += 1
+        if self._deleted > 1024 and self._deleted * 2 > self._size:
+            self._compact()
+
+    def _compact(self):
+        """Drops the rows of the deleted documents"""
+        alive = self._alive[:self._size]
+        self._doc_ids = self._doc_ids[:self._size][alive]
+        self._kinds = [kinds[:self._size][alive] for kinds in self._kinds]
+        self._numbers = [
+            numbers[:self._size][alive] for numbers in self._numbers
+        ]
+        self._size = self._capacity = len(self._doc_ids)
+        self._alive = numpy.ones(self._size, dtype=bool)
+        self._deleted = 0
+        self._rows = dict(
+            (int(doc_id), row) for row, doc_id in enumerate(self._doc_ids)
+        )
+
+    def covers(self, field, condition):
+        """True if the columns can filter on the condition of a field"""
+        return field in self.fields and self._mask_of(
+            None, None, condition) is not None
+
+    def candidates(self, conditions):
+        """
+        Gets the documents that may match conditions ANDed together
+
+        :param conditions: list of (field, condition) pairs, those the
+                           columns can not evaluate are left out
+        :return: set of doc ids, None if no condition could be evaluated
+        """
+        size = self._size
+        mask = None
+        for field, condition in conditions:
+            if field not in self.fields:
+                continue
+            position = self.fields.index(field)
+            kinds = self._kinds[position][:size]
+            numbers = self._numbers[position][:size]
+            field_mask = self._mask_of(kinds, numbers, condition)
+            if field_mask is None:
+                continue
+            field_mask |= kinds == UNKNOWN
+            mask = field_mask if mask is None else mask & field_mask
+
+        if mask is None:
+            return None
+        mask &= self._alive[:size]
+        return set(self._doc_ids[:size][mask].tolist())
+
+    def _mask_of(self, kinds, numbers, condition):
+        """
+        Evaluates a condition on a column
+
+        Called with `kinds` None, only tells whether the condition can be
+        evaluated.
+
+        :return: boolean array of the rows whose value matches, None if
+                 the condition is not supported
+        """
+        if not isinstance(condition, dict) or not condition or not all(
+                key.startswith(u'$') for key in condition):
+            condition = {u'$eq': condition}
+
+        # each step ORs (kind, compare, target) tests, a value only equals
+        # the targets of its own kind, like in the queries True is not 1
+        steps = list()
+        for op, target in condition.items():
+            if op == u'$eq' and _is_scalar(target):
+                step = [(_kind_of(target), numpy.equal, float(target))]
+            elif op == u'$in' and isinstance(target, list) and \
+                    all(_is_scalar(item) for item in target):
+                step = [
+                    (kind, numpy.isin, [
+                        float(item) for item in target
+                        if _kind_of(item) == kind
+                    ])
+                    for kind in (NUMBER, BOOLEAN)
+                ]
+            elif op in _COMPARISONS and _is_number(target):
+                step = [(NUMBER, _COMPARISONS[op], float(target))]
+            else:
+                return None
+            steps.append(step)
+
+        if kinds is None:
+            return True
+        mask = numpy.ones(len(kinds), dtype=bool)
+        for step in steps:
+            step_mask = numpy.zeros(len(kinds), dtype=bool)
+            for kind, compare, target in step:
+                step_mask |= (kinds == kind) & compare(numbers, target)
+            mask &= step_mask
+        return mask
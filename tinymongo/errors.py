@@ -57,5 +57,10 @@ class DuplicateKeyError(WriteError):
     """Raised when an insert or update fails due to a duplicate key error."""
 
 
+class BulkWriteError(OperationFailure):
+    """Raised when a bulk write fails, `details` holds the write errors and
+    the counts of the operations that were applied."""
+
+
 class InvalidOperation(TinyMongoError):
     """Raised when a client attempts to perform an invalid operation."""
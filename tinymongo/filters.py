@@ -0,0 +1,698 @@
+"""Compiles mongo query dicts into Python predicates"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import operator
+import re
+import threading
+from collections import OrderedDict
+
+from .errors import OperationFailure
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+# order of the value types that compare with each other in a range
+NUMBER_TYPE = 1
+STRING_TYPE = 2
+
+REGEX_TYPE = type(re.compile(u''))
+
+REGEX_FLAGS = {
+    u'i': re.IGNORECASE,
+    u'm': re.MULTILINE,
+    u's': re.DOTALL,
+    u'x': re.VERBOSE,
+}
+
+try:
+    NUMBER_CLASSES = (int, long, float)
+except NameError:
+    NUMBER_CLASSES = (int, float)
+
+# markers of the parts of a query shape
+QUERY = u'$query'
+OPERATORS = u'$operators'
+SLOT = u'$slot'
+
+LOGICAL_OPERATORS = (u'$and', u'$or', u'$nor')
+
+LEAF_OPERATORS = (
+    u'$eq', u'$ne', u'$gt', u'$gte', u'$lt', u'$lte', u'$in', u'$nin',
+    u'$all', u'$exists', u'$regex', u'$size', u'$mod'
+)
+
+COMPARISONS = {
+    u'$gt': operator.gt,
+    u'$gte': operator.ge,
+    u'$lt': operator.lt,
+    u'$lte': operator.le,
+}
+
+
+def index_key(value):
+    """Returns a hashable representation of a document value
+
+    Lists and dicts are frozen into tagged tuples and booleans are tagged so
+    that `True` and `1` do not collide, as they would in a plain dict.
+    """
+    if isinstance(value, bool):
+        return (u'$bool', value)
+    elif isinstance(value, dict):
+        return (u'$dict', tuple(
+            (key, index_key(val)) for key, val in value.items()
+        ))
+    elif isinstance(value, list):
+        return (u'$list', tuple(index_key(val) for val in value))
+    return value
+
+
+def range_type(value):
+    """Returns the type order of a value usable in a range, or None"""
+    if isinstance(value, bool):
+        return None
+    elif isinstance(value, (int, float)):
+        return NUMBER_TYPE
+    elif isinstance(value, basestring):
+        return STRING_TYPE
+    return None
+
+
+def make_getter(path):
+    """
+    Builds a function reading the values at a dotted path of a document
+
+    Like MongoDB, arrays met along the path are traversed, so the getter of
+    `'a.b'` returns `[1, 2]` for `{'a': [{'b': 1}, {'b': 2}]}`, and numeric
+    path components also index into arrays.
+
+    :param path: dotted path of the field
+    :return: function taking a document and returning the list of the
+             values found, empty if the field is missing. Getters of
+             top-level fields have a `key` attribute so that predicates
+             can read the field directly.
+    """
+    parts = tuple(path.split(u'.'))
+
+    if len(parts) == 1:
+        key = parts[0]
+
+        def getter(doc):
+            if key in doc:
+                return [doc[key]]
+            return []
+        getter.key = key
+        return getter
+
+    positions = tuple(
+        int(part) if part.isdigit() else None for part in parts
+    )
+
+    def getter(doc):
+        # walk down nested dicts directly, arrays need the slower traversal
+        value = doc
+        for part in parts:
+            if not isinstance(value, dict):
+                return traverse(doc)
+            if part not in value:
+                return []
+            value = value[part]
+        return [value]
+
+    def traverse(doc):
+        values = [doc]
+        for part, position in zip(parts, positions):
+            found = list()
+            for value in values:
+                if isinstance(value, dict):
+                    if part in value:
+                        found.append(value[part])
+                elif isinstance(value, list):
+                    if position is not None and position < len(value):
+                        found.append(value[position])
+                    for item in value:
+                        if isinstance(item, dict) and part in item:
+                            found.append(item[part])
+            if not found:
+                return found
+            values = found
+        return values
+    return getter
+
+
+class QueryCache(object):
+    """
+    LRU cache of compiled queries, keyed by the shape of the query
+
+    Queries differing only by their values (`{'age': {'$gt': 20}}` and
+    `{'age': {'$gt': 30}}`) share a shape, so a hit skips the parsing and
+    validation of the query: only the values are bound into a new
+    predicate.
+    """
+
+    def __init__(self, maxsize=256):
+        """
+        Initialize an empty cache
+
+        :param maxsize: number of query shapes to keep
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Number of query shapes in the cache"""
+        return len(self._templates)
+
+    def compile(self, query):
+        """
+        Compiles a mongo query into a single predicate
+
+        :param query: dictionary representing the mongo query
+        :return: function taking a document and returning True if it matches
+        """
+        shape, params = query_shape(query)
+        with self._lock:
+            template = self._templates.pop(shape, None)
+            if template is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._templates[shape] = template
+
+        if template is None:
+            template = _build_query(shape)
+            with self._lock:
+                self._templates[shape] = template
+                while len(self._templates) > self.maxsize:
+                    self._templates.popitem(last=False)
+
+        return template(params)
+
+    def info(self):
+        """Statistics of the cache"""
+        return {
+            u'hits': self.hits,
+            u'misses': self.misses,
+            u'size': len(self._templates),
+            u'maxsize': self.maxsize,
+        }
+
+    def clear(self):
+        """Empties the cache and resets its statistics"""
+        with self._lock:
+            self._templates.clear()
+            self.hits = self.misses = 0
+
+
+query_cache = QueryCache()
+
+
+def compile_query(query):
+    """
+    Compiles a mongo query into a single predicate, without caching
+
+    Dotted paths are split, `$in` sets built and regexes compiled once, so
+    checking a document only runs the specialized closures.
+
+    :param query: dictionary representing the mongo query
+    :return: function taking a document and returning True if it matches
+    """
+    shape, params = query_shape(query)
+    return _build_query(shape)(params)
+
+
+def query_shape(query):
+    """
+    Splits a query into its shape and its values
+
+    The shape keeps the fields, the operators and the type of each value,
+    the values are replaced by numbered slots and returned apart.
+
+    :param query: dictionary representing the mongo query
+    :return: (shape, params) tuple, the shape is hashable
+    """
+    params = list()
+    return _query_shape(query, params), params
+
+
+def _query_shape(query, params):
+    """Shape of a query dict, its values are appended to `params`"""
+    items = list()
+    for key, value in (query or {}).items():
+        if key in LOGICAL_OPERATORS:
+            if not isinstance(value, list) or not value:
+                raise OperationFailure(key + u' must be a nonempty array')
+            items.append(
+                (key, tuple(_query_shape(spec, params) for spec in value))
+            )
+        elif key.startswith(u'$'):
+            raise OperationFailure(u'unknown top level operator: ' + key)
+        elif _is_operator_dict(value):
+            items.append((key, _operators_shape(value, params)))
+        else:
+            items.append((key, _slot(value, params)))
+    return (QUERY, tuple(items))
+
+
+def _operators_shape(condition, params):
+    """Shape of a dict of operators"""
+    items = list()
+    for op, value in condition.items():
+        if op == u'$not' and isinstance(value, dict):
+            items.append((op, _operators_shape(value, params)))
+        elif op == u'$elemMatch':
+            if not isinstance(value, dict):
+                raise OperationFailure(u'$elemMatch needs an Object')
+            if _is_operator_dict(value) and not any(
+                    key in LOGICAL_OPERATORS for key in value):
+                # conditions on the elements themselves
+                items.append((op, _operators_shape(value, params)))
+            else:
+                items.append((op, _query_shape(value, params)))
+        else:
+            items.append((op, _slot(value, params)))
+    return (OPERATORS, tuple(items))
+
+
+def _slot(value, params):
+    """Shape of a value: the slot it is put in and its type"""
+    params.append(value)
+    return (SLOT, len(params) - 1, _type_name(value))
+
+
+def _type_name(value):
+    """Name of the type of a query value"""
+    if value is None:
+        return u'null'
+    elif isinstance(value, bool):
+        return u'bool'
+    elif isinstance(value, NUMBER_CLASSES):
+        return u'number'
+    elif isinstance(value, basestring):
+        return u'string'
+    elif isinstance(value, REGEX_TYPE):
+        return u'regex'
+    elif isinstance(value, list):
+        return u'array'
+    elif isinstance(value, dict):
+        return u'object'
+    return type(value).__name__
+
+
+def _is_operator_dict(value):
+    """True if `value` is a dict of query operators"""
+    return isinstance(value, dict) and any(
+        key.startswith(u'$') for key in value
+    )
+
+
+def _build_query(shape):
+    """
+    Builds the template of a query from its shape
+
+    :return: function binding the values of the query into a predicate
+    """
+    binders = list()
+    for key, sub_shape in shape[1]:
+        if key in LOGICAL_OPERATORS:
+            binders.append(_logical_binder(
+                key, [_build_query(spec) for spec in sub_shape]
+            ))
+        elif sub_shape[0] == SLOT:
+            binders.append(_equals_binder(make_getter(key), sub_shape[1]))
+        else:
+            binders.append(_build_operators(make_getter(key), sub_shape))
+
+    if not binders:
+        return lambda params: _match_all
+    return _all_binder(binders)
+
+
+def _build_operators(getter, shape):
+    """Builds the template of a dict of operators applied to a field"""
+    options = None
+    for op, sub_shape in shape[1]:
+        if op == u'$options':
+            options = sub_shape[1]
+
+    binders = list()
+    for op, sub_shape in shape[1]:
+        if op == u'$options':
+            continue
+        elif op == u'$not':
+            binders.append(_build_not(getter, sub_shape))
+        elif op == u'$elemMatch':
+            binders.append(_build_elem_match(getter, sub_shape))
+        elif op in LEAF_OPERATORS:
+            binders.append(
+                _operator_binder(getter, op, sub_shape[1], options)
+            )
+        else:
+            raise OperationFailure(u'unknown operator: ' + op)
+    return _all_binder(binders)
+
+
+def _build_not(getter, shape):
+    """Builds the template of the $not operator"""
+    if shape[0] == SLOT:
+        slot = shape[1]
+
+        def bind(params):
+            value = params[slot]
+            if isinstance(value, REGEX_TYPE):
+                return _negate(_regex(getter, value))
+            return _negate(_equals(getter, value))
+        return bind
+
+    # every operator is negated on its own, {'$not': {'$gte': 90,
+    # '$lt': 10}} keeps the documents from 10 to 90
+    options = tuple(item for item in shape[1] if item[0] == u'$options')
+    return _all_binder([
+        _negate_binder(
+            _build_operators(getter, (OPERATORS, ((op, sub_shape),) + options))
+        )
+        for op, sub_shape in shape[1] if op != u'$options'
+    ])
+
+
+def _build_elem_match(getter, shape):
+    """Builds the template of the $elemMatch operator"""
+    if shape[0] == QUERY:
+        query_binder = _build_query(shape)
+
+        def bind(params):
+            query_test = query_binder(params)
+            return _elem_match(
+                getter, lambda item: isinstance(item, dict) and query_test(item)
+            )
+        return bind
+
+    item_binder = _build_operators(lambda item: [item], shape)
+    return lambda params: _elem_match(getter, item_binder(params))
+
+
+def _all_binder(binders):
+    """Template of the conjunction of templates"""
+    if len(binders) == 1:
+        return binders[0]
+    return lambda params: _all([binder(params) for binder in binders])
+
+
+def _negate_binder(binder):
+    """Template of the negation of a template"""
+    return lambda params: _negate(binder(params))
+
+
+def _logical_binder(key, binders):
+    """Template of $and, $or or $nor over the templates of queries"""
+    if key == u'$and':
+        return _all_binder(binders)
+    elif key == u'$or':
+        return lambda params: _any([binder(params) for binder in binders])
+    return lambda params: _negate(
+        _any([binder(params) for binder in binders])
+    )
+
+
+def _equals_binder(getter, slot):
+    """Template of the equality of a field with a value"""
+    return lambda params: _equals(getter, params[slot])
+
+
+def _operator_binder(getter, op, slot, options):
+    """Template of an operator applied to a field"""
+    if options is None:
+        return lambda params: _compile_operator(getter, op, params[slot])
+    return lambda params: _compile_operator(
+        getter, op, params[slot], params[options]
+    )
+
+
+def _match_all(doc):
+    """Predicate of the empty query"""
+    return True
+
+
+def _all(tests):
+    """Predicate true when all the tests are"""
+    if len(tests) == 1:
+        return tests[0]
+    tests = tuple(tests)
+
+    def test(doc):
+        for one in tests:
+            if not one(doc):
+                return False
+        return True
+    return test
+
+
+def _any(tests):
+    """Predicate true when one of the tests is"""
+    tests = tuple(tests)
+
+    def test(doc):
+        for one in tests:
+            if one(doc):
+                return True
+        return False
+    return test
+
+
+def _negate(test):
+    """Predicate true when `test` is not"""
+    return lambda doc: not test(doc)
+
+
+def _lift(getter, check):
+    """
+    Lifts a check on a single value to a predicate on the values of a
+    field, arrays match when one of their elements does
+    """
+    key = getattr(getter, 'key', None)
+
+    if key is not None:
+        def test(doc):
+            if key in doc:
+                value = doc[key]
+                if check(value):
+                    return True
+                if isinstance(value, list):
+                    for item in value:
+                        if check(item):
+                            return True
+            return False
+        return test
+
+    def test(doc):
+        for value in getter(doc):
+            if check(value):
+                return True
+            if isinstance(value, list):
+                for item in value:
+                    if check(item):
+                        return True
+        return False
+    return test
+
+
+def _equals(getter, target):
+    """Predicate of the equality of a field with `target`"""
+    if isinstance(target, REGEX_TYPE):
+        return _regex(getter, target)
+
+    if target is None:
+        def test(doc):
+            values = getter(doc)
+            if not values:
+                return True
+            for value in values:
+                if value is None:
+                    return True
+                if isinstance(value, list) and None in value:
+                    return True
+            return False
+        return test
+
+    # == alone would match True with 1, as the indexes do not
+    target_key = index_key(target)
+
+    def same(value):
+        return value == target and index_key(value) == target_key
+
+    def check(value):
+        if same(value):
+            return True
+        if isinstance(value, list) and target in value:
+            for item in value:
+                if same(item):
+                    return True
+        return False
+
+    key = getattr(getter, 'key', None)
+
+    if key is not None:
+        def test(doc):
+            return key in doc and check(doc[key])
+        return test
+
+    def test(doc):
+        for value in getter(doc):
+            if check(value):
+                return True
+        return False
+    return test
+
+
+def _comparison(getter, compare, target):
+    """Predicate of a range operator, only comparing values of one type"""
+    target_type = range_type(target)
+
+    if target_type == NUMBER_TYPE:
+        def check(value):
+            return value.__class__ in NUMBER_CLASSES and compare(value, target)
+    elif target_type == STRING_TYPE:
+        def check(value):
+            return isinstance(value, basestring) and compare(value, target)
+    else:
+        def check(value):
+            try:
+                return compare(value, target)
+            except TypeError:
+                return False
+
+    return _lift(getter, check)
+
+
+def _in(getter, targets):
+    """Predicate of the $in operator"""
+    if not isinstance(targets, list):
+        raise OperationFailure(u'$in needs an array')
+
+    hashable = set()
+    others = list()
+    patterns = list()
+    for target in targets:
+        if isinstance(target, REGEX_TYPE):
+            patterns.append(target)
+            continue
+        try:
+            hashable.add(index_key(target))
+        except TypeError:
+            others.append(index_key(target))
+    match_missing = None in hashable
+
+    def check(value):
+        key = index_key(value)
+        try:
+            if key in hashable:
+                return True
+        except TypeError:
+            pass
+        for other in others:
+            if key == other:
+                return True
+        if isinstance(value, basestring):
+            for pattern in patterns:
+                if pattern.match(value):
+                    return True
+        return False
+
+    matches = _lift(getter, check)
+    if not match_missing:
+        return matches
+    return lambda doc: not getter(doc) or matches(doc)
+
+
+def _unescape_regex(pattern):
+    """
+    Undoes the escaping of backslashes found in regexes coming from
+    query strings: double backslashes stand for one, single ones are
+    dropped
+    """
+    pattern = pattern.replace(u'\\\\\\', u'|||')
+    pattern = pattern.replace(u'\\\\', u'|||')
+    pattern = pattern.replace(u'\\', u'')
+    return pattern.replace(u'|||', u'\\')
+
+
+def _regex(getter, pattern, options=u''):
+    """Predicate of the $regex operator, matching from the start"""
+    if not isinstance(pattern, REGEX_TYPE):
+        flags = 0
+        for option in options or u'':
+            flags |= REGEX_FLAGS.get(option, 0)
+        pattern = re.compile(_unescape_regex(pattern), flags)
+
+    def check(value):
+        return isinstance(value, basestring) and \
+            pattern.match(value) is not None
+
+    return _lift(getter, check)
+
+
+def _elem_match(getter, check):
+    """Predicate of the $elemMatch operator, `check` tests an element"""
+    def test(doc):
+        for value in getter(doc):
+            if isinstance(value, list):
+                for item in value:
+                    if check(item):
+                        return True
+        return False
+    return test
+
+
+def _compile_operator(getter, op, value, options=None):
+    """
+    Compiles a single operator applied to a field
+
+    :param getter: function reading the values of the field
+    :param op: the operator, e.g. `$gte`
+    :param value: the operand
+    :param options: the `$options` of a `$regex`
+    :return: predicate
+    """
+    if op == u'$eq':
+        return _equals(getter, value)
+    elif op == u'$ne':
+        return _negate(_equals(getter, value))
+    elif op in COMPARISONS:
+        return _comparison(getter, COMPARISONS[op], value)
+    elif op == u'$in':
+        return _in(getter, value)
+    elif op == u'$nin':
+        return _negate(_in(getter, value))
+    elif op == u'$all':
+        if not isinstance(value, list):
+            raise OperationFailure(u'$all needs an array')
+        if not value:
+            return lambda doc: False
+        return _all([_equals(getter, target) for target in value])
+    elif op == u'$exists':
+        if value:
+            return lambda doc: len(getter(doc)) > 0
+        return lambda doc: len(getter(doc)) == 0
+    elif op == u'$regex':
+        return _regex(getter, value, options)
+    elif op == u'$size':
+        return lambda doc: any(
+            isinstance(item, list) and len(item) == value
+            for item in getter(doc)
+        )
+    elif op == u'$mod':
+        divisor, remainder = value
+
+        def check(item):
+            return range_type(item) == NUMBER_TYPE and \
+                item % divisor == remainder
+        return _lift(getter, check)
+
+    raise OperationFailure(u'unknown operator: ' + op)
@@ -0,0 +1,354 @@
+"""In-memory indexes kept by TinyMongo collections"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+from .errors import DuplicateKeyError, OperationFailure
+from .filters import index_key, make_getter, range_type
+
+
+def index_value_of(key):
+    """Returns the document value of an index key, see `index_key`"""
+    if isinstance(key, tuple):
+        tag, frozen = key
+        if tag == u'$bool':
+            return frozen
+        elif tag == u'$dict':
+            return dict((name, index_value_of(val)) for name, val in frozen)
+        elif tag == u'$list':
+            return [index_value_of(val) for val in frozen]
+    return key
+
+
+class Index(object):
+    """
+    Index mapping the values of a (dotted) field to TinyDB document ids
+
+    Equality lookups go through a hash of the values, range lookups through
+    a sorted list of the distinct numbers and strings. Arrays are indexed
+    both as a whole and element by element, the index is then multikey.
+    """
+
+    def __init__(self, field, name=None, direction=1, unique=False,
+                 sparse=False):
+        """
+        Initialize an empty index on `field`
+
+        :param field: dotted path of the field to index
+        :param name: the index name
+        :param direction: sort direction of the index, 1 or -1
+        :param unique: refuse two documents with the same value
+        :param sparse: skip documents that lack the field
+        """
+        self.field = field
+        self.name = name or u'{0}_{1}'.format(field, direction)
+        self.direction = direction
+        self.unique = unique
+        self.sparse = sparse
+        self._values = make_getter(field)
+        self._entries = {}
+        self._ordered = list()
+        self.multikey = False
+
+    def __len__(self):
+        """Number of distinct keys in the index"""
+        return len(self._entries)
+
+    @property
+    def info(self):
+        """Description of the index as listed by `list_indexes`"""
+        info = {
+            u'v': 2,
+            u'key': {self.field: self.direction},
+            u'name': self.name,
+        }
+        if self.unique:
+            info[u'unique'] = True
+        if self.sparse:
+            info[u'sparse'] = True
+        return info
+
+    def keys(self, doc):
+        """Returns the set of index keys of a document"""
+        values = self._values(doc)
+        if not values:
+            return set() if self.sparse else set([None])
+        keys = set()
+        for value in values:
+            keys.add(index_key(value))
+            if isinstance(value, list):
+                keys.update(index_key(item) for item in value)
+        return keys
+
+    def _is_multikey(self, doc):
+        """True if the field of the document holds an array"""
+        return any(isinstance(value, list) for value in self._values(doc))
+
+    def clear(self):
+        """Removes every entry of the index"""
+        self._entries = {}
+        self._ordered = list()
+        self.multikey = False
+
+    def check(self, doc_id, doc, batch=None):
+        """
+        Raises DuplicateKeyError if `doc` violates a unique index
+
+        :param doc_id: the document id `doc` is (or will be) stored under
+        :param doc: the document
+        :param batch: dict of keys already claimed by other documents of the
+                      same write, it is updated with the keys of `doc`
+        """
+        if not self.unique:
+            return
+        for key in self.keys(doc):
+            doc_ids = self._entries.get(key, ())
+            if any(other != doc_id for other in doc_ids) or (
+                    batch is not None and batch.get(key, doc_id) != doc_id):
+                value = self._values(doc)
+                raise DuplicateKeyError(
+                    u'{0}:{1} already exists in index:{2}'.format(
+                        self.field, value[0] if value else None, self.name
+                    )
+                )
+            if batch is not None:
+                batch[key] = doc_id
+
+    def add(self, doc_id, doc):
+        """Adds the document `doc` stored under `doc_id` to the index"""
+        if not self.multikey and self._is_multikey(doc):
+            self.multikey = True
+        for key in self.keys(doc):
+            doc_ids = self._entries.get(key)
+            if doc_ids is None:
+                doc_ids = self._entries[key] = set()
+                if range_type(key) is not None:
+                    insort(self._ordered, (range_type(key), key))
+            doc_ids.add(doc_id)
+
+    def remove(self, doc_id, doc):
+        """Removes the document `doc` stored under `doc_id` from the index"""
+        for key in self.keys(doc):
+            doc_ids = self._entries.get(key)
+            if doc_ids is None:
+                continue
+            doc_ids.discard(doc_id)
+            if not doc_ids:
+                del self._entries[key]
+                if range_type(key) is not None:
+                    pos = bisect_left(self._ordered, (range_type(key), key))
+                    del self._ordered[pos]
+
+    def distinct_keys(self):
+        """Returns the list of the distinct keys of the index"""
+        return list(self._entries)
+
+    def lookup(self, value):
+        """Returns the set of document ids whose field equals `value`"""
+        return self._entries.get(index_key(value), set())
+
+    def range_keys(self, bounds):
+        """
+        Returns the keys of the index that are within bounds
+
+        :param bounds: dict of range operators ($gt, $gte, $lt, $lte) to
+                       values of the same type
+        :return: list of keys, in ascending order
+        """
+        types = set(range_type(value) for value in bounds.values())
+        if len(types) != 1 or None in types:
+            raise ValueError(u'range bounds must be of one sortable type')
+        type_ = types.pop()
+
+        start = bisect_left(self._ordered, (type_,))
+        end = bisect_left(self._ordered, (type_ + 1,))
+        for op, value in bounds.items():
+            if op == u'$gt':
+                start = max(start, bisect_right(self._ordered, (type_, value)))
+            elif op == u'$gte':
+                start = max(start, bisect_left(self._ordered, (type_, value)))
+            elif op == u'$lt':
+                end = min(end, bisect_left(self._ordered, (type_, value)))
+            elif op == u'$lte':
+                end = min(end, bisect_right(self._ordered, (type_, value)))
+
+        return [key for _, key in self._ordered[start:end]]
+
+    def count_keys(self, keys):
+        """Returns the number of entries stored under the given keys"""
+        return sum(len(self._entries.get(key, ())) for key in keys)
+
+    def lookup_keys(self, keys):
+        """Returns the set of document ids stored under the given keys"""
+        doc_ids = set()
+        for key in keys:
+            doc_ids.update(self._entries.get(key, ()))
+        return doc_ids
+
+    def __contains__(self, value):
+        """True if at least one document has `value` in the field"""
+        return index_key(value) in self._entries
+
+
+class IndexManager(object):
+    """
+    Holds the indexes of a single collection
+
+    Indexes are built lazily from the table the first time they are needed
+    and are kept in sync by the collection write paths afterwards. Any write
+    path that cannot cheaply tell what changed calls `reset` and the indexes
+    are rebuilt on next access.
+
+    The manager also holds the ColumnCache of the collection, if any, kept
+    in sync the same way, and its write generation: a counter every write
+    path bumps through `add`, `remove` or `reset`, telling the ResultCache
+    of the collection, if any, when its results are stale.
+    """
+
+    def __init__(self):
+        """Initialize the manager with the mandatory `_id` index"""
+        self.id_index = Index(u'_id', name=u'_id_', unique=True)
+        self._indexes = {self.id_index.name: self.id_index}
+        self._built = False
+        self._doc_count = 0
+        self.columns = None
+        self.results = None
+        self.generation = 0
+        # concurrent readers may all ask for the indexes to be built
+        self._build_lock = threading.Lock()
+
+    @property
+    def indexes(self):
+        """All indexes of the collection"""
+        return list(self._indexes.values())
+
+    @property
+    def doc_count(self):
+        """Number of documents in the collection, None until built"""
+        return self._doc_count if self._built else None
+
+    def get(self, name):
+        """Returns the index called `name`, or None"""
+        return self._indexes.get(name)
+
+    def create(self, table, index):
+        """
+        Adds an index, building it right away
+
+        :param table: the TinyDB table of the collection
+        :param index: the new Index
+        :return: the name of the index
+        """
+        existing = self._indexes.get(index.name)
+        if existing is not None:
+            if existing.info != index.info:
+                raise OperationFailure(
+                    u'Index with name: {0} already exists with different '
+                    u'options'.format(index.name)
+                )
+            return existing.name
+
+        self.ensure_built(table)
+        batch = {}
+        for doc_id, doc in table._read().items():
+            index.check(doc_id, doc, batch)
+            index.add(doc_id, doc)
+        self._indexes[index.name] = index
+        return index.name
+
+    def drop(self, name):
+        """Removes the index called `name`"""
+        if name == self.id_index.name:
+            raise OperationFailure(u'cannot drop _id index')
+        if name not in self._indexes:
+            raise OperationFailure(
+                u'index not found with name [{0}]'.format(name)
+            )
+        del self._indexes[name]
+
+    def cache_columns(self, table, columns):
+        """
+        Sets the ColumnCache of the collection, building it right away
+
+        :param table: the TinyDB table of the collection
+        :param columns: the new ColumnCache, None to drop the current one
+        """
+        self.ensure_built(table)
+        if columns is not None:
+            columns.build(table._read())
+        self.columns = columns
+
+    def ensure_built(self, table):
+        """Builds the indexes from the table data if needed"""
+        if self._built:
+            return
+        with self._build_lock:
+            if self._built:
+                return
+            data = table._read()
+            for index in self.indexes:
+                index.clear()
+                for doc_id, doc in data.items():
+                    index.add(doc_id, doc)
+            if self.columns is not None:
+                self.columns.build(data)
+            self._doc_count = len(data)
+            self._built = True
+
+    def reset(self):
+        """Drops the indexed data, to be rebuilt on next access"""
+        self.generation += 1
+        self._built = False
+        for index in self.indexes:
+            index.clear()
+        if self.columns is not None:
+            self.columns.clear()
+
+    def clear(self):
+        """
+        Empties the manager of a dropped collection: the secondary indexes
+        are dropped, like MongoDB does, while the column and result caches
+        are kept, empty
+        """
+        self._indexes = {self.id_index.name: self.id_index}
+        self.reset()
+        if self.results is not None:
+            self.results.clear()
+
+    def check(self, doc_id, doc, batch=None):
+        """
+        Raises DuplicateKeyError if `doc` violates a unique index
+
+        :param batch: dict holding the keys claimed by the documents of the
+                      same write, per index name
+        """
+        for index in self.indexes:
+            index_batch = None
+            if batch is not None:
+                index_batch = batch.setdefault(index.name, {})
+            index.check(doc_id, doc, index_batch)
+
+    def add(self, doc_id, doc):
+        """Indexes a newly written document"""
+        self.generation += 1
+        if not self._built:
+            return
+        self._doc_count += 1
+        for index in self.indexes:
+            index.add(doc_id, doc)
+        if self.columns is not None:
+            self.columns.add(doc_id, doc)
+
+    def remove(self, doc_id, doc):
+        """Removes a deleted document from the indexes"""
+        self.generation += 1
+        if not self._built:
+            return
+        self._doc_count -= 1
+        for index in self.indexes:
+            index.remove(doc_id, doc)
+        if self.columns is not None:
+            self.columns.remove(doc_id, doc)
@@ -0,0 +1,241 @@
+"""Locks guarding the TinyMongo databases shared between threads and
+processes"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # not available on Windows
+    fcntl = None
+
+
+class ReadWriteLock(object):
+    """
+    Lets many threads read at once, or a single one write
+
+    Waiting writers block new readers, so a steady flow of reads can not
+    starve the writes. Both sides are reentrant and a thread holding the
+    write lock may also read, which write paths built on read paths need.
+    A thread holding only the read lock must not ask for the write lock.
+
+    The time spent waiting for the lock is recorded, see `info`.
+
+    Given a FileLock, the lock also guards the database against the other
+    processes: the file is locked shared while threads read and exclusive
+    while one writes.
+    """
+
+    def __init__(self, file_lock=None):
+        """
+        Initialize an unlocked lock
+
+        :param file_lock: FileLock shared with the other processes
+        """
+        self.file_lock = file_lock
+        self._cond = threading.Condition(threading.Lock())
+        # read lock depth by thread ident
+        self._readers = {}
+        self._writer = None
+        self._write_depth = 0
+        self._waiting_writers = 0
+
+        self.reads = 0
+        self.writes = 0
+        self.read_waits = 0
+        self.write_waits = 0
+        self.read_wait_time = 0.0
+        self.write_wait_time = 0.0
+
+    def acquire_read(self):
+        """Takes the lock for reading, blocking while a writer holds it
+        or waits for it"""
+        me = threading.current_thread().ident
+        with self._cond:
+            self.reads += 1
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+            if self._writer is not None or self._waiting_writers:
+                started = time.time()
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+                self.read_waits += 1
+                self.read_wait_time += time.time() - started
+            if not self._readers and self.file_lock is not None:
+                self.file_lock.acquire(shared=True)
+            self._readers[me] = 1
+
+    def release_read(self):
+        """Releases the lock taken by `acquire_read`"""
+        me = threading.current_thread().ident
+        with self._cond:
+            depth = self._readers[me] - 1
+            if depth:
+                self._readers[me] = depth
+                return
+            del self._readers[me]
+            if not self._readers and self._writer is None:
+                if self.file_lock is not None:
+                    self.file_lock.release()
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        """Takes the lock for writing, blocking while any other thread
+        holds it"""
+        me = threading.current_thread().ident
+        with self._cond:
+            self.writes += 1
+            if self._writer == me:
+                self._write_depth += 1
+                return
+            if self._writer is not None or self._readers:
+                started = time.time()
+                self._waiting_writers += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._waiting_writers -= 1
+                self.write_waits += 1
+                self.write_wait_time += time.time() - started
+            if self.file_lock is not None:
+                self.file_lock.acquire(shared=False)
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self):
+        """Releases the lock taken by `acquire_write`"""
+        with self._cond:
+            self._write_depth -= 1
+            if not self._write_depth:
+                if self.file_lock is not None:
+                    self.file_lock.release()
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        """Holds the lock for reading during the block"""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        """Holds the lock for writing during the block"""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    def info(self):
+        """Statistics of the lock, wait times are in seconds"""
+        info = {
+            u'reads': self.reads,
+            u'writes': self.writes,
+            u'read_waits': self.read_waits,
+            u'write_waits': self.write_waits,
+            u'read_wait_time': self.read_wait_time,
+            u'write_wait_time': self.write_wait_time,
+        }
+        if self.file_lock is not None:
+            info.update(self.file_lock.info())
+        return info
+
+
+class FileLock(object):
+    """
+    POSIX advisory lock on a file shared by the processes of a database
+
+    The file also holds the generation of the database, a number each
+    process bumps when it releases the lock after a write. A process
+    comparing it to the last generation it saw knows, at the cost of a
+    small read, whether the database was changed by another process and
+    its in-memory state must be loaded again.
+    """
+
+    def __init__(self, path, on_change=None):
+        """
+        Opens the lock file, creating it if needed
+
+        :param path: path of the lock file
+        :param on_change: function called, with the file locked, when the
+                          generation changed since the last lock
+        """
+        if fcntl is None:
+            raise RuntimeError(u'file locks need the fcntl module')
+        self.path = path
+        self.on_change = on_change
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._generation = None
+        self._changed = False
+
+        self.wait_time = 0.0
+        self.reloads = 0
+
+    def acquire(self, shared=False):
+        """
+        Locks the file, then checks the generation of the database
+
+        :param shared: lock for reading, else for writing
+        """
+        started = time.time()
+        fcntl.flock(self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        self.wait_time += time.time() - started
+
+        generation = self._read_generation()
+        if generation != self._generation:
+            self._generation = generation
+            self.reloads += 1
+            if self.on_change is not None:
+                self.on_change()
+
+    def release(self):
+        """Bumps the generation if the database changed, and unlocks"""
+        if self._changed:
+            self._changed = False
+            self._generation = (self._generation or 0) + 1
+            self._write_generation(self._generation)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def changed(self):
+        """Records that the database was written to"""
+        self._changed = True
+
+    def _read_generation(self):
+        """Reads the generation from the file, 0 when empty"""
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        content = os.read(self._fd, 64)
+        try:
+            return int(content or 0)
+        except ValueError:
+            # unreadable, assume the database changed
+            return -1
+
+    def _write_generation(self, generation):
+        """Writes the generation to the file"""
+        content = u'{0}'.format(generation).encode(u'ascii')
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, content)
+        os.ftruncate(self._fd, len(content))
+
+    def info(self):
+        """Statistics of the lock, the wait time is in seconds"""
+        return {
+            u'file_wait_time': self.wait_time,
+            u'reloads': self.reloads,
+        }
+
+    def close(self):
+        """Closes the lock file"""
+        os.close(self._fd)
@@ -0,0 +1,215 @@
+"""TinyDB middlewares used by TinyMongo databases"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import threading
+
+from tinydb.middlewares import Middleware
+from tinydb.storages import JSONStorage
+
+# marker of a batch opened without a savepoint
+NO_SAVEPOINT = object()
+
+
+class WriteBatchMiddleware(Middleware):
+    """
+    Holds the writes to the storage in memory while a batch is open
+
+    Every TinyMongo database wraps its storage with this middleware. Out of
+    a batch, reads and writes go straight to the storage. Within a batch,
+    the data is read from the storage once, every write replaces the data
+    kept in memory, and the last state is written to the storage once,
+    when the outermost batch ends. A batch opened with a savepoint can be
+    rolled back instead, restoring the data as it was when it was opened.
+
+    The data kept in memory, within a batch or with `cache_reads`, is read
+    and written by reference: TinyDB replaces the table it writes, it never
+    changes one in place, so a read only copies the dict of the tables. The
+    documents are then shared with the callers, see `shares_data`. Calls to
+    the storage are serialized, storages like JSONStorage share a single
+    file handle between reads and writes.
+    """
+
+    def __init__(self, storage_cls, cache_reads=False, on_write=None):
+        """
+        :param storage_cls: the storage class, or middleware, to wrap
+        :param cache_reads: keep the data read out of a batch in memory,
+                            until `invalidate` is called
+        :param on_write: function called after each write to the storage
+        """
+        super(WriteBatchMiddleware, self).__init__(storage_cls)
+        self.cache_reads = cache_reads
+        self.on_write = on_write
+        self._depth = 0
+        self._data = None
+        self._modified = False
+        self._savepoints = list()
+        # doc ids announced for the next write, and those of the batch by
+        # table, None for a table written without announcing them
+        self._pending = None
+        self._changed = {}
+        self._io_lock = threading.Lock()
+
+    @property
+    def in_batch(self):
+        """True while a batch is open"""
+        return self._depth > 0
+
+    @property
+    def shares_data(self):
+        """
+        True if the documents read may be the ones kept in memory, by this
+        middleware or by the storage, the callers must then copy those they
+        hand out or take in
+        """
+        return self._depth > 0 or self.cache_reads or \
+            not isinstance(self.storage, JSONStorage)
+
+    def begin(self, savepoint=False):
+        """
+        Opens a batch, batches can be nested
+
+        :param savepoint: keep a copy of the data to be able to roll back
+        """
+        self._depth += 1
+        snapshot = NO_SAVEPOINT
+        if savepoint:
+            # the documents are never changed in place, copying the tables
+            # is enough
+            snapshot = dict(
+                (table, dict(docs))
+                for table, docs in (self.read() or {}).items()
+            )
+        self._savepoints.append(snapshot)
+
+    def commit(self):
+        """
+        Closes a batch, the data is written to the storage when the
+        outermost one is closed
+        """
+        if not self._depth:
+            return
+        self._savepoints.pop()
+        self._depth -= 1
+        if not self._depth:
+            self.flush()
+
+    def rollback(self):
+        """
+        Closes a batch, restoring the data as it was when it was opened
+
+        A batch opened without a savepoint is committed instead.
+        """
+        if not self._depth:
+            return
+        if self._savepoints[-1] is NO_SAVEPOINT:
+            self.commit()
+            return
+        snapshot = self._savepoints.pop()
+        self._depth -= 1
+        if self._depth:
+            self._data = snapshot
+        else:
+            # nothing was written to the storage since the savepoint
+            self._data = None
+            self._modified = False
+            self._changed = {}
+
+    def flush(self):
+        """Writes the data held in memory to the storage"""
+        data, modified = self._data, self._modified
+        changed, self._changed = self._changed, {}
+        self._data = None
+        self._modified = False
+        if not modified:
+            return
+        for table, doc_ids in changed.items():
+            if doc_ids is not None:
+                self._mark_changed(table, doc_ids)
+        self._write(data)
+
+    def mark_changed(self, table, doc_ids):
+        """
+        Announces the documents the next write of a table changes
+
+        Storages keeping a journal, like JournalStorage, then only compare
+        those documents instead of the whole table. Within a batch the
+        announced documents add up until the batch is written.
+
+        :param table: the table name
+        :param doc_ids: ids of the documents added, changed or removed
+        """
+        self._pending = (table, doc_ids)
+
+    def _mark_changed(self, table, doc_ids):
+        """Announces changed documents to the storage, if it takes them"""
+        mark_changed = getattr(self.storage, u'mark_changed', None)
+        if mark_changed is not None:
+            mark_changed(table, doc_ids)
+
+    def invalidate(self):
+        """
+        Drops the data kept in memory out of a batch, for the storage was
+        changed by someone else
+        """
+        if self._depth:
+            return
+        self._data = None
+        with self._io_lock:
+            reload = getattr(self.storage, u'reload', None)
+            if reload is not None:
+                reload()
+
+    def _write(self, data):
+        """Writes to the storage, keeping the data if reads are cached"""
+        try:
+            with self._io_lock:
+                self.storage.write(data)
+        except Exception:
+            self._data = None
+            raise
+        if self.cache_reads:
+            self._data = data
+        if self.on_write is not None:
+            self.on_write()
+
+    def read(self):
+        cached = self._depth or self.cache_reads
+        if not cached or self._data is None:
+            with self._io_lock:
+                data = self.storage.read()
+            if not cached:
+                return data
+            self._data = data
+        if self._data is None:
+            return None
+        # TinyDB adds and removes tables in the dict it reads
+        return dict(self._data)
+
+    def write(self, data):
+        pending, self._pending = self._pending, None
+        if not self._depth:
+            if pending is not None:
+                self._mark_changed(*pending)
+            self._write(data)
+            return
+        previous = self._data or {}
+        for table in set(previous) | set(data):
+            docs = data.get(table)
+            if docs is previous.get(table):
+                continue
+            announced = pending is not None and pending[0] == table
+            if announced and self._changed.get(table, ()) is not None:
+                self._changed.setdefault(table, set()).update(pending[1])
+            else:
+                self._changed[table] = None
+        self._data = data
+        self._modified = True
+
+    def close(self):
+        self._depth = 0
+        self._savepoints = list()
+        self.flush()
+        with self._io_lock:
+            self.storage.close()
@@ -0,0 +1,113 @@
+"""Write operations for :meth:`~tinymongo.TinyMongoCollection.bulk_write`"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+from .updates import compile_update
+
+
+class _WriteOp(object):
+    """Base class for the write operations"""
+
+    def _execute(self, collection, data, changed, result, index):
+        """
+        Runs the operation on the table data of a collection, see
+        `TinyMongoCollection._writing`
+
+        :param collection: the TinyMongoCollection
+        :param data: the table data
+        :param changed: list of the changed doc ids
+        :param result: the bulk API result dict, its counts are updated
+        :param index: position of the operation in the bulk
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return u'{0}({1})'.format(
+            self.__class__.__name__,
+            u', '.join(repr(arg) for arg in self._args)
+        )
+
+
+class InsertOne(_WriteOp):
+    """Represents an insert_one operation"""
+
+    def __init__(self, document):
+        """
+        :param document: the document to insert
+        """
+        if not isinstance(document, dict):
+            raise ValueError(u'"document" must be a dict')
+        self._doc = document
+        self._args = (document,)
+
+    def _execute(self, collection, data, changed, result, index):
+        collection._insert_docs(data, changed, [self._doc])
+        result[u'nInserted'] += 1
+
+
+class _UpdateOp(_WriteOp):
+    """Base class for the update operations"""
+
+    #: number of documents updated, None for all
+    _limit = None
+
+    def __init__(self, filter, update, upsert=False):
+        """
+        :param filter: dictionary representing the mongo query
+        :param update: dictionary of update operators
+        :param upsert: insert a document if none matches the query
+        """
+        # validates the update right away, like pymongo does
+        compile_update(update)
+        self._filter = filter
+        self._update = update
+        self._upsert = upsert
+        self._args = (filter, update, upsert)
+
+    def _execute(self, collection, data, changed, result, index):
+        matched, modified, upserted_id = collection._update_docs(
+            data, changed, self._filter, self._update, self._limit,
+            self._upsert
+        )
+        result[u'nMatched'] += len(matched)
+        result[u'nModified'] += modified
+        if upserted_id is not None:
+            result[u'nUpserted'] += 1
+            result[u'upserted'].append({u'index': index, u'_id': upserted_id})
+
+
+class UpdateOne(_UpdateOp):
+    """Represents an update_one operation"""
+
+    _limit = 1
+
+
+class UpdateMany(_UpdateOp):
+    """Represents an update_many operation"""
+
+
+class DeleteOne(_WriteOp):
+    """Represents a delete_one operation"""
+
+    def __init__(self, filter):
+        """
+        :param filter: dictionary representing the mongo query
+        """
+        self._filter = filter
+        self._args = (filter,)
+
+    #: number of documents deleted, None for all
+    _limit = 1
+
+    def _execute(self, collection, data, changed, result, index):
+        removed = collection._delete_docs(
+            data, changed, self._filter, self._limit
+        )
+        result[u'nRemoved'] += len(removed)
+
+
+class DeleteMany(DeleteOne):
+    """Represents a delete_many operation"""
+
+    _limit = None
@@ -0,0 +1,142 @@
+"""Parallel scans of large collections"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import multiprocessing
+import threading
+
+try:
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    # python 2 needs the `futures` backport
+    ProcessPoolExecutor = ThreadPoolExecutor = None
+
+from .errors import ConfigurationError
+from .filters import query_cache
+
+
+def _match_positions(query, docs):
+    """
+    Checks a partition of the documents in a worker process
+
+    :param query: dictionary representing the mongo query, compiled in
+                  the worker as predicates can not be pickled
+    :param docs: the documents of the partition
+    :return: list of the positions of the matching documents
+    """
+    predicate = query_cache.compile(query)
+    return [position for position, doc in enumerate(docs) if predicate(doc)]
+
+
+def _match_docs(predicate, docs):
+    """
+    Checks a partition of the documents in a worker thread
+
+    :param predicate: the compiled query
+    :param docs: the documents of the partition
+    :return: list of the matching documents
+    """
+    return [doc for doc in docs if predicate(doc)]
+
+
+class ParallelScan(object):
+    """
+    Checks the documents of large collection scans in parallel
+
+    The documents are split in contiguous partitions checked by the
+    workers of a `concurrent.futures` pool, and the matches are put back
+    in insertion order. Only scans of at least `threshold` documents that
+    must run to the end, like those of a count, are split, and only their
+    filter: a sorted find still sorts its matches in the calling thread:
+
+        client = TinyMongoClient('db', parallel_scan=ParallelScan())
+
+    Processes run the filters on several cores, but the documents have to
+    be pickled to them; threads share the documents but, with the GIL,
+    only help filters that release it.
+    """
+
+    #: Default minimum number of documents of a parallel scan
+    THRESHOLD = 10000
+
+    def __init__(self, processes=True, max_workers=None, threshold=None,
+                 executor=None):
+        """
+        Initialize the scan, the pool is started on first use
+
+        :param processes: use a pool of processes, else of threads
+        :param max_workers: size of the pool, the number of CPUs by default
+        :param threshold: minimum number of documents to check for a scan
+                          to be split
+        :param executor: concurrent.futures executor to use instead of a
+                         new pool, left open by `close`
+        """
+        if executor is None and ProcessPoolExecutor is None:
+            raise ConfigurationError(
+                u'parallel scans need the concurrent.futures module'
+            )
+        if threshold is None:
+            threshold = self.THRESHOLD
+        self.processes = processes
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.threshold = threshold
+        self._executor = executor
+        self._own_executor = executor is None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """The pool of workers"""
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    pool = ProcessPoolExecutor if self.processes \
+                        else ThreadPoolExecutor
+                    self._executor = pool(max_workers=self.max_workers)
+        return self._executor
+
+    def filter(self, query, predicate, docs):
+        """
+        Gets the documents matching a query
+
+        :param query: dictionary representing the mongo query
+        :param predicate: the compiled query, as returned by `parse_query`
+        :param docs: list of the documents to check
+        :return: list of the matching documents, in the order of `docs`
+        """
+        size = -(-len(docs) // self.max_workers)
+        partitions = [
+            docs[start:start + size] for start in range(0, len(docs), size)
+        ]
+
+        executor = self.executor
+        if self.processes:
+            futures = [
+                executor.submit(_match_positions, query, partition)
+                for partition in partitions
+            ]
+        else:
+            futures = [
+                executor.submit(_match_docs, predicate, partition)
+                for partition in partitions
+            ]
+
+        matches = list()
+        for partition, future in zip(partitions, futures):
+            if self.processes:
+                matches.extend(
+                    partition[position] for position in future.result()
+                )
+            else:
+                matches.extend(future.result())
+        return matches
+
+    def close(self):
+        """Stops the pool of workers, it is started again if needed"""
+        if not self._own_executor:
+            return
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,334 @@
+"""Query planning over the in-memory indexes of a collection"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import json
+
+from .filters import REGEX_TYPE
+from .indexes import index_key
+
+RANGE_OPERATORS = (u'$gt', u'$gte', u'$lt', u'$lte')
+
+
+class QueryPlan(object):
+    """
+    Access path chosen for a query, either a collection scan or a scan of
+    some keys of an index, along with the statistics of its execution
+    """
+
+    def __init__(self, query, index=None, keys=None, key_range=None,
+                 bounds=None):
+        """
+        Initialize the plan
+
+        :param query: dictionary representing the mongo query
+        :param index: the Index to scan, None for a collection scan
+        :param keys: the keys of the index to read
+        :param key_range: range operators selecting the keys of the index
+                          to read, instead of `keys`
+        :param bounds: human readable bounds of the index scan
+        """
+        self.query = query
+        self.index = index
+        self._keys = keys
+        self.key_range = key_range
+        self.bounds = bounds
+        self.rejected = list()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Forgets the statistics of the previous execution"""
+        self.keys_examined = 0
+        self.docs_examined = 0
+        self.n_returned = 0
+        self.execution_millis = 0.0
+
+    @property
+    def stage(self):
+        """Name of the access stage of the plan"""
+        return u'COLLSCAN' if self.index is None else u'IXSCAN'
+
+    @property
+    def reads_indexes(self):
+        """True if the plan reads the in-memory data of the indexes"""
+        return self.index is not None
+
+    @property
+    def keys(self):
+        """The keys of the index to read, as of now"""
+        if self.key_range is not None:
+            return self.index.range_keys(
+                _scan_bounds(self.index, self.key_range)
+            )
+        return self._keys
+
+    @property
+    def estimate(self):
+        """Number of index entries the plan reads, None for a scan"""
+        if self.index is None:
+            return None
+        return self.index.count_keys(self.keys)
+
+    def doc_ids(self):
+        """
+        Reads the ids of the documents to examine from the index
+        :return: set of document ids, None for a collection scan
+        """
+        if self.index is None:
+            return None
+        keys = self.keys
+        self.keys_examined += self.index.count_keys(keys)
+        return self.index.lookup_keys(keys)
+
+    def describe(self):
+        """Describes the plan like the `winningPlan` of MongoDB"""
+        if self.index is None:
+            return {
+                u'stage': u'COLLSCAN',
+                u'filter': self.query or {},
+                u'direction': u'forward',
+            }
+        return {
+            u'stage': u'FETCH',
+            u'filter': self.query,
+            u'inputStage': {
+                u'stage': u'IXSCAN',
+                u'keyPattern': {self.index.field: self.index.direction},
+                u'indexName': self.index.name,
+                u'isUnique': self.index.unique,
+                u'isSparse': self.index.sparse,
+                u'indexBounds': {self.index.field: self.bounds},
+            },
+        }
+
+    @property
+    def execution_stats(self):
+        """Statistics of the execution like the `executionStats` of MongoDB"""
+        return {
+            u'nReturned': self.n_returned,
+            u'executionTimeMillis': int(round(self.execution_millis)),
+            u'totalKeysExamined': self.keys_examined,
+            u'totalDocsExamined': self.docs_examined,
+        }
+
+
+class ColumnPlan(QueryPlan):
+    """
+    Plan filtering the ColumnCache of a collection for the documents to
+    examine, instead of scanning them all
+    """
+
+    def __init__(self, query, columns, conditions):
+        """
+        Initialize the plan
+
+        :param query: dictionary representing the mongo query
+        :param columns: the ColumnCache to filter
+        :param conditions: the (field, condition) pairs the columns can
+                           evaluate
+        """
+        super(ColumnPlan, self).__init__(query)
+        self.columns = columns
+        self.conditions = conditions
+
+    @property
+    def stage(self):
+        """Name of the access stage of the plan"""
+        return u'COLUMNSCAN'
+
+    @property
+    def reads_indexes(self):
+        """True if the plan reads the in-memory data of the indexes"""
+        return True
+
+    def doc_ids(self):
+        """
+        Filters the columns for the ids of the documents to examine
+        :return: set of document ids
+        """
+        return self.columns.candidates(self.conditions)
+
+    def describe(self):
+        """Describes the plan like the `winningPlan` of MongoDB"""
+        return {
+            u'stage': u'FETCH',
+            u'filter': self.query,
+            u'inputStage': {
+                u'stage': u'COLUMNSCAN',
+                u'fields': [field for field, _ in self.conditions],
+            },
+        }
+
+
+def plan_query(indexes, table, query):
+    """
+    Picks the way to run a query on a collection
+
+    Every index on a field with a top-level equality, `$in` or range
+    condition (also inside a top-level `$and`) is considered, and the one
+    reading the fewest entries wins. Without any, the column cache filters
+    the documents if it can evaluate one of the conditions, else the whole
+    collection is scanned. The documents the plan yields must still be
+    checked against the query.
+
+    :param indexes: the IndexManager of the collection
+    :param table: the TinyDB table of the collection
+    :param query: dictionary representing the mongo query
+    :return: the winning QueryPlan, the others are in its `rejected` list
+    """
+    by_field = {}
+    for index in indexes.indexes:
+        by_field.setdefault(index.field, list()).append(index)
+
+    conditions = [
+        (field, condition) for field, condition in _conditions(query)
+        if field in by_field
+    ]
+    if not conditions:
+        return _column_plan(indexes, table, query)
+
+    indexes.ensure_built(table)
+    plans = list()
+    for field, condition in conditions:
+        for index in by_field[field]:
+            plan = _index_plan(query, index, condition)
+            if plan is not None:
+                plans.append(plan)
+
+    if not plans:
+        return _column_plan(indexes, table, query)
+
+    plans.sort(key=lambda plan: plan.estimate)
+    winning = plans[0]
+    winning.rejected = plans[1:]
+    return winning
+
+
+def _column_plan(indexes, table, query):
+    """
+    Builds the plan filtering the column cache of the collection
+
+    :return: ColumnPlan, or a collection scan QueryPlan if the columns can
+             not serve any condition of the query
+    """
+    columns = indexes.columns
+    if columns is None:
+        return QueryPlan(query)
+    conditions = [
+        (field, condition) for field, condition in _conditions(query)
+        if columns.covers(field, condition)
+    ]
+    if not conditions:
+        return QueryPlan(query)
+    indexes.ensure_built(table)
+    return ColumnPlan(query, columns, conditions)
+
+
+def _conditions(query):
+    """Yields the (field, condition) pairs ANDed at the top of a query"""
+    if not isinstance(query, dict):
+        return
+    for key, value in query.items():
+        if key == u'$and' and isinstance(value, list):
+            for spec in value:
+                for condition in _conditions(spec):
+                    yield condition
+        elif not key.startswith(u'$'):
+            yield key, value
+
+
+def _is_operator_dict(value):
+    """True if `value` is a dict of query operators"""
+    return isinstance(value, dict) and any(
+        key.startswith(u'$') for key in value
+    )
+
+
+def _format(value):
+    """Formats a bound value the way MongoDB prints it"""
+    try:
+        return json.dumps(value)
+    except (TypeError, ValueError):
+        return repr(value)
+
+
+def _scan_bounds(index, bounds):
+    """
+    Gets the range bounds an index scan can apply
+
+    A multikey index holds each element of an array as its own key, and
+    each bound may be met by a different element of the same array, so a
+    single bound is applied, the query checks the others.
+
+    :param index: the Index to scan
+    :param bounds: dict of range operators to values
+    :return: dict of range operators to values
+    """
+    if not index.multikey or len(bounds) < 2:
+        return bounds
+    for op in RANGE_OPERATORS:
+        if op in bounds:
+            return {op: bounds[op]}
+
+
+def _index_plan(query, index, condition):
+    """
+    Builds the plan reading `index` for a single field condition
+
+    :return: QueryPlan, or None if the index can not serve the condition
+    """
+    if not _is_operator_dict(condition):
+        if condition is None and index.sparse:
+            return None
+        if isinstance(condition, REGEX_TYPE):
+            # matches values, not a key of the index
+            return None
+        return QueryPlan(
+            query, index,
+            keys=[index_key(condition)],
+            bounds=[u'[{0}, {0}]'.format(_format(condition))]
+        )
+
+    if u'$eq' in condition:
+        return _index_plan(query, index, condition[u'$eq'])
+
+    if u'$in' in condition and isinstance(condition[u'$in'], list):
+        values = condition[u'$in']
+        if any(isinstance(value, (dict, REGEX_TYPE)) for value in values):
+            return None
+        if index.sparse and None in values:
+            return None
+        return QueryPlan(
+            query, index,
+            keys=[index_key(value) for value in values],
+            bounds=[u'[{0}, {0}]'.format(_format(value)) for value in values]
+        )
+
+    bounds = dict(
+        (op, value) for op, value in condition.items()
+        if op in RANGE_OPERATORS
+    )
+    if bounds:
+        try:
+            index.range_keys(bounds)
+        except ValueError:
+            return None
+        bounds = _scan_bounds(index, bounds)
+        lower = u'[MinKey'
+        if u'$gt' in bounds:
+            lower = u'({0}'.format(_format(bounds[u'$gt']))
+        elif u'$gte' in bounds:
+            lower = u'[{0}'.format(_format(bounds[u'$gte']))
+        upper = u'MaxKey]'
+        if u'$lt' in bounds:
+            upper = u'{0})'.format(_format(bounds[u'$lt']))
+        elif u'$lte' in bounds:
+            upper = u'{0}]'.format(_format(bounds[u'$lte']))
+        return QueryPlan(
+            query, index,
+            key_range=bounds,
+            bounds=[u'{0}, {1}'.format(lower, upper)]
+        )
+
+    return None
@@ -58,10 +58,14 @@ class UpdateResult(_WriteResult):
     :meth:`~tinymongo.TinyMongoCollection.replace_one`.
     """
 
-    __slots__ = ("__raw_result", "__acknowledged")
+    __slots__ = ("__raw_result", "__acknowledged", "__modified_count",
+                 "__upserted_id")
 
-    def __init__(self, raw_result, acknowledged=True):
+    def __init__(self, raw_result, acknowledged=True, modified_count=None,
+                 upserted_id=None):
         self.__raw_result = raw_result
+        self.__modified_count = modified_count
+        self.__upserted_id = upserted_id
         super(UpdateResult, self).__init__(acknowledged)
 
     @property
@@ -72,20 +76,25 @@ class UpdateResult(_WriteResult):
     @property
     def matched_count(self):
         """The number of documents matched for this update."""
-        # TODO: Implement this
+        if isinstance(self.raw_result, list):
+            return len(self.raw_result)
+        else:
+            return self.raw_result
 
     @property
     def modified_count(self):
         """The number of documents modified.
         """
-        # TODO: Implement this
+        if self.__modified_count is None:
+            return self.matched_count
+        return self.__modified_count
 
     @property
     def upserted_id(self):
         """The _id of the inserted document if an upsert took place. Otherwise
         ``None``.
         """
-        # TODO: Implement this
+        return self.__upserted_id
 
 
 class DeleteResult(_WriteResult):
@@ -110,3 +119,52 @@ class DeleteResult(_WriteResult):
             return len(self.raw_result)
         else:
             return self.raw_result
+
+
+class BulkWriteResult(_WriteResult):
+    """The return type for :meth:`~tinymongo.TinyMongoCollection.bulk_write`.
+    """
+
+    __slots__ = ("__bulk_api_result", "__acknowledged")
+
+    def __init__(self, bulk_api_result, acknowledged=True):
+        self.__bulk_api_result = bulk_api_result
+        super(BulkWriteResult, self).__init__(acknowledged)
+
+    @property
+    def bulk_api_result(self):
+        """The raw bulk API result."""
+        return self.__bulk_api_result
+
+    @property
+    def inserted_count(self):
+        """The number of documents inserted."""
+        return self.__bulk_api_result.get("nInserted")
+
+    @property
+    def matched_count(self):
+        """The number of documents matched for an update."""
+        return self.__bulk_api_result.get("nMatched")
+
+    @property
+    def modified_count(self):
+        """The number of documents modified."""
+        return self.__bulk_api_result.get("nModified")
+
+    @property
+    def deleted_count(self):
+        """The number of documents deleted."""
+        return self.__bulk_api_result.get("nRemoved")
+
+    @property
+    def upserted_count(self):
+        """The number of documents upserted."""
+        return self.__bulk_api_result.get("nUpserted")
+
+    @property
+    def upserted_ids(self):
+        """A map of operation index to the _id of the upserted document."""
+        return dict(
+            (upsert["index"], upsert["_id"])
+            for upsert in self.__bulk_api_result.get("upserted", [])
+        )
@@ -0,0 +1,225 @@
+"""TinyDB storages provided by TinyMongo"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import codecs
+import json
+import os
+
+from tinydb.storages import Storage, touch
+
+# os.replace is atomic over an existing file, python 2 only has rename
+_replace = getattr(os, 'replace', os.rename)
+
+
+class JournalStorage(Storage):
+    """
+    Store the data in a JSON snapshot and a journal of the writes
+
+    The snapshot has the format of TinyDB's JSONStorage. Each write appends
+    a single line to the `<path>.journal` file, holding only the documents
+    that changed, so its cost depends on the size of the change and not on
+    the size of the database. The journal is replayed over the snapshot on
+    open, and is folded into a new snapshot once it grows over
+    `compact_threshold` bytes. The data is also kept in memory, so a file
+    must not be opened by two storages at the same time.
+
+    The tables read are shared with TinyDB, which replaces the tables it
+    writes instead of changing them, and they are kept as written. To find
+    the documents a write changed, only those announced by `mark_changed`
+    are looked at, when the write of a table was not announced every
+    document of the table is compared.
+
+    To set another threshold, subclass it or bind the argument::
+
+        TinyMongoClient('db', storage=partial(JournalStorage,
+                                              compact_threshold=2 ** 20))
+    """
+
+    #: Default size of the journal, in bytes, that triggers a compaction
+    COMPACT_THRESHOLD = 16 * 1024 * 1024
+
+    def __init__(self, path, create_dirs=False, encoding=None,
+                 compact_threshold=None, **kwargs):
+        """
+        Create a new instance, loading the snapshot and replaying the journal
+
+        :param path: where to store the JSON snapshot
+        :param encoding: encoding of the files
+        :param compact_threshold: size of the journal, in bytes, that
+                                  triggers a compaction
+        :param kwargs: arguments of `json.dumps` for the snapshot
+        """
+        super(JournalStorage, self).__init__()
+        touch(path, create_dirs=create_dirs)
+        self.path = path
+        self.journal_path = path + u'.journal'
+        self.encoding = encoding
+        self.kwargs = kwargs
+        if compact_threshold is None:
+            compact_threshold = self.COMPACT_THRESHOLD
+        self.compact_threshold = compact_threshold
+
+        self._journal = None
+        self._journal_size = 0
+        self._tables = {}
+        self._changed = {}
+
+        self._torn = self._load()
+        self._journal = codecs.open(
+            self.journal_path, 'a', encoding=encoding
+        )
+        if self._torn:
+            self.compact()
+
+    def _load(self):
+        """
+        Loads the snapshot and replays the journal over it
+
+        :return: True if the journal ends with a partially written record
+        """
+        with codecs.open(self.path, 'r', encoding=self.encoding) as handle:
+            content = handle.read()
+        self._tables = json.loads(content) if content else {}
+
+        if not os.path.exists(self.journal_path):
+            return False
+
+        with codecs.open(self.journal_path, 'r',
+                         encoding=self.encoding) as handle:
+            for line in handle:
+                if not line.endswith(u'\n'):
+                    return True
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    return True
+                self._replay(record)
+                self._journal_size += len(line)
+        return False
+
+    def _replay(self, record):
+        """Applies a journal record to the tables"""
+        for table in record.get(u'drop', ()):
+            self._tables.pop(table, None)
+        for table, docs in record.get(u'set', {}).items():
+            self._tables.setdefault(table, {}).update(docs)
+        for table, doc_ids in record.get(u'del', {}).items():
+            docs = self._tables.get(table, {})
+            for doc_id in doc_ids:
+                docs.pop(doc_id, None)
+
+    def reload(self):
+        """Loads the files again, after another process wrote to them"""
+        self._tables = {}
+        self._changed = {}
+        self._journal_size = 0
+        self._torn = self._load()
+
+    def read(self):
+        # TinyDB adds and removes tables in the dict it reads
+        return dict(self._tables)
+
+    def mark_changed(self, table, doc_ids):
+        """
+        Announces the documents the next write of a table changes
+
+        :param table: the table name
+        :param doc_ids: ids of the documents added, changed or removed
+        """
+        self._changed.setdefault(table, set()).update(doc_ids)
+
+    def write(self, data):
+        changed, self._changed = self._changed, {}
+        record = self._diff(data, changed)
+        if not record:
+            return
+        if self._torn:
+            # do not append after a partially written record
+            self.compact()
+
+        line = json.dumps(record) + u'\n'
+        self._journal.write(line)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal_size += len(line)
+        self._tables = dict(data)
+
+        if self._journal_size >= self.compact_threshold:
+            self.compact()
+
+    def _diff(self, data, changed_ids):
+        """
+        Compares the data written by TinyDB with the tables
+
+        :param data: the data written
+        :param changed_ids: ids of the changed documents by table, see
+                            `mark_changed`
+        :return: the journal record of the changes, empty if none
+        """
+        record = {}
+        for table in self._tables:
+            if table not in data:
+                record.setdefault(u'drop', []).append(table)
+
+        for table, docs in data.items():
+            old_docs = self._tables.get(table)
+            if docs is old_docs:
+                # the table was not written since it was read
+                continue
+
+            # the keys are strings once loaded from JSON, numbers once
+            # written by TinyDB
+            if old_docs is None:
+                changed = _by_key(docs)
+                deleted = []
+            elif table in changed_ids:
+                changed = {}
+                deleted = []
+                for doc_id in changed_ids[table]:
+                    key = u'{0}'.format(doc_id)
+                    doc = docs.get(doc_id, docs.get(key))
+                    if doc is None:
+                        deleted.append(key)
+                    else:
+                        changed[key] = doc
+            else:
+                new_docs = _by_key(docs)
+                old_docs = _by_key(old_docs)
+                changed = dict(
+                    (key, doc) for key, doc in new_docs.items()
+                    if old_docs.get(key) != doc
+                )
+                deleted = [key for key in old_docs if key not in new_docs]
+
+            if changed or old_docs is None:
+                record.setdefault(u'set', {})[table] = changed
+            if deleted:
+                record.setdefault(u'del', {})[table] = deleted
+
+        return record
+
+    def compact(self):
+        """Writes a new snapshot of the data and empties the journal"""
+        temp_path = self.path + u'.tmp'
+        with codecs.open(temp_path, 'w', encoding=self.encoding) as handle:
+            handle.write(json.dumps(self._tables, **self.kwargs))
+            handle.flush()
+            os.fsync(handle.fileno())
+        _replace(temp_path, self.path)
+
+        # replaying the old records over the new snapshot is harmless, a
+        # crash before the truncation loses nothing
+        self._journal.truncate(0)
+        self._journal_size = 0
+        self._torn = False
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+
+
+def _by_key(docs):
+    """Keys the documents of a table by their id as a string"""
+    return dict((u'{0}'.format(doc_id), doc) for doc_id, doc in docs.items())
@@ -4,21 +4,50 @@
 from __future__ import absolute_import
 
 import copy
-from functools import reduce
+import heapq
 import logging
 import os
-from math import ceil
-from operator import itemgetter
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import partial, wraps
+from itertools import islice
 from uuid import uuid1
 
-from tinydb import Query, TinyDB, where
+from tinydb import TinyDB
+from tinydb.database import Document
 from .results import (
     InsertOneResult,
     InsertManyResult,
     UpdateResult,
-    DeleteResult
+    DeleteResult,
+    BulkWriteResult
 )
-from .errors import DuplicateKeyError
+from .aggregation import compile_pipeline, run_pipeline
+from .caches import ResultCache
+from .columns import ColumnCache
+from .errors import (
+    BulkWriteError,
+    ConfigurationError,
+    InvalidOperation,
+    OperationFailure,
+    WriteError
+)
+from .errors import DuplicateKeyError  # noqa: F401, re-exported by the package
+from .filters import NUMBER_CLASSES, REGEX_TYPE, make_getter, query_cache
+from .indexes import Index, IndexManager, index_key, index_value_of
+from .locks import FileLock, ReadWriteLock, fcntl
+from .middlewares import WriteBatchMiddleware
+from .operations import (  # noqa: F401, re-exported by the package
+    InsertOne,
+    UpdateOne,
+    UpdateMany,
+    DeleteOne,
+    DeleteMany
+)
+from .planner import QueryPlan, plan_query
+from .updates import compile_update
 
 try:
   basestring
@@ -28,16 +57,67 @@ except NameError:
 
 logger = logging.getLogger(__name__)
 
+# storage layouts: one file per database, or one file per collection
+DATABASE_LAYOUT = u'database'
+COLLECTION_LAYOUT = u'collection'
+LAYOUTS = (DATABASE_LAYOUT, COLLECTION_LAYOUT)
+
 
-def Q(query, key):
-    return reduce(lambda partial_query, field: partial_query[field], key.split('.'), query)
+def _read_locked(method):
+    """Runs a collection method holding its database lock for reading"""
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.parent._lock.read():
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def _write_locked(method):
+    """Runs a collection method holding its database lock for writing"""
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.parent._lock.write():
+            return method(self, *args, **kwargs)
+    return locked
 
 
 class TinyMongoClient(object):
     """Represents the Tiny `db` client"""
-    def __init__(self, foldername=u"tinydb", **kwargs):
-        """Initialize container folder"""
+    def __init__(self, foldername=u"tinydb", storage=None,
+                 layout=DATABASE_LAYOUT, multiprocess=False,
+                 parallel_scan=None, **kwargs):
+        """
+        Initialize container folder
+
+        :param foldername: folder of the database files
+        :param storage: TinyDB storage class of the databases, like
+                        `tinymongo.storages.JournalStorage`, defaults to
+                        `TinyDB.DEFAULT_STORAGE`
+        :param layout: 'database' to store each database in a file of the
+                       folder, 'collection' to store each collection in a
+                       file of a subfolder named after its database
+        :param multiprocess: lock the databases against the other
+                             processes opening the folder this way, with
+                             POSIX file locks
+        :param parallel_scan: `tinymongo.parallel.ParallelScan` checking
+                              the documents of large scans in parallel
+        """
+        if layout not in LAYOUTS:
+            raise ConfigurationError(
+                u'layout must be one of {0}'.format(u', '.join(LAYOUTS))
+            )
+        if multiprocess and fcntl is None:
+            raise ConfigurationError(
+                u'multiprocess needs POSIX file locks (fcntl)'
+            )
         self._foldername = foldername
+        self._storage_cls = storage
+        self._layout = layout
+        self._multiprocess = multiprocess
+        self._parallel_scan = parallel_scan
+        self._databases = {}
+        self._sessions = []
+        self._lock = threading.Lock()
         try:
             os.mkdir(foldername)
         except OSError as x:
@@ -53,6 +133,12 @@ class TinyMongoClient(object):
                 def _storage(self):
                     return CachingMiddleware(OtherMiddleware(JSONMiddleware))
 
+        A storage class given to the client as `storage` is returned
+        instead of the default one:
+
+            from tinymongo.storages import JournalStorage
+            client = TinyMongoClient(storage=JournalStorage)
+
         This property is also useful to define Serializers using required
         `tinydb-serialization` module.
 
@@ -68,43 +154,398 @@ class TinyMongoClient(object):
                     return serialization
 
         """
-        return TinyDB.DEFAULT_STORAGE
+        return self._storage_cls or TinyDB.DEFAULT_STORAGE
 
     def __getitem__(self, key):
-        """Gets a new or existing database based in key"""
-        return TinyMongoDatabase(key, self._foldername, self._storage)
+        """Gets a new or existing database based in key
+
+        Databases are opened once and kept open until `close`.
+        """
+        database = self._databases.get(key)
+        if database is None:
+            with self._lock:
+                database = self._databases.get(key)
+                if database is None:
+                    database = self._databases[key] = TinyMongoDatabase(
+                        key, self._foldername, self._storage,
+                        layout=self._layout, client=self,
+                        multiprocess=self._multiprocess
+                    )
+                    thread = threading.current_thread()
+                    for session in self._sessions:
+                        if session.thread is thread:
+                            session._join(database)
+        return database
+
+    def start_session(self, rollback=False):
+        """
+        Starts a session holding the writes to all the databases of the
+        client until it ends, each file is then written once
+
+            with client.start_session():
+                client.db.users.insert_one({'name': 'John'})
+                client.db.logs.insert_one({'event': 'signup'})
+
+        The session belongs to the thread starting it, which must end it:
+        it holds the write lock of the databases until it ends, the other
+        threads wait for it instead of having their writes caught in the
+        session, and undone by its rollback.
+
+        :param rollback: if the `with` block raises, undo the writes of
+                         the session instead of writing them
+        :return: TinyMongoSession, to end with `end_session` or a `with`
+                 block
+        """
+        return TinyMongoSession(self, rollback=rollback)
 
     def close(self):
-        """Do nothing"""
-        pass
+        """Closes the files of the databases, they are opened again on
+        next use"""
+        with self._lock:
+            databases = list(self._databases.values())
+        for database in databases:
+            database.close()
+        if self._parallel_scan is not None:
+            self._parallel_scan.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __getattr__(self, name):
         """Gets a new or existing database based in attribute"""
-        return TinyMongoDatabase(name, self._foldername, self._storage)
+        return self[name]
+
+
+class TinyMongoSession(object):
+    """
+    Batch of writes over the databases of a client, see
+    :meth:`TinyMongoClient.start_session`
+    """
+    def __init__(self, client, rollback=False):
+        """
+        Starts the session, opening a batch on the databases of the client
+
+        :param client: the TinyMongoClient
+        :param rollback: undo the writes if the `with` block raises
+        """
+        self.client = client
+        self.rollback = rollback
+        self.thread = threading.current_thread()
+        self._databases = []
+        with client._lock:
+            client._sessions.append(self)
+            databases = list(client._databases.values())
+        for database in databases:
+            self._join(database)
+
+    @property
+    def has_ended(self):
+        """True once the session has ended"""
+        return self not in self.client._sessions
+
+    def _join(self, database):
+        """Opens the batch of the session on a database"""
+        database._begin(self.rollback)
+        self._databases.append(database)
+
+    def end_session(self, rollback=False):
+        """
+        Ends the session, writing the changes made during it
+
+        :param rollback: undo the changes instead, if the session was
+                         started with `rollback=True`
+        """
+        with self.client._lock:
+            if self.has_ended:
+                return
+            self.client._sessions.remove(self)
+            databases, self._databases = self._databases, []
+        for database in reversed(databases):
+            database._end(rollback and self.rollback)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end_session(rollback=exc_type is not None)
 
 
 class TinyMongoDatabase(object):
     """Representation of a Pymongo database"""
-    def __init__(self, database, foldername, storage):
+    def __init__(self, database, foldername, storage,
+                 layout=DATABASE_LAYOUT, client=None, multiprocess=False):
         """Initialize a TinyDB file named as the db name in the given folder
+
+        With the 'collection' layout, each collection gets its own TinyDB
+        file, named as the collection in a subfolder named as the db.
+
+        :param storage: the TinyDB storage of the file(s)
+        :param layout: 'database' or 'collection'
+        :param client: the TinyMongoClient, asked for a new storage for
+                       each file opened after the first one
+        :param multiprocess: share the database with other processes,
+                             through the `<database>.lock` file
         """
+        self._name = database
         self._foldername = foldername
-        self.tinydb = TinyDB(
-            os.path.join(foldername, database + u".json"),
-            storage=storage
-        )
+        self._storage = storage
+        self._pending_storage = storage
+        self._layout = layout
+        self._client = client
+        self._indexes = {}
+        self._collections = {}
+        # open TinyDB by collection name, by None for the database file
+        self._files = {}
+        # savepoint flag of each open batch, outermost first
+        self._batches = []
+        # finds run in parallel, writes one at a time
+        self._file_lock = None
+        if multiprocess:
+            self._file_lock = FileLock(
+                os.path.join(foldername, database + u'.lock'),
+                on_change=self._reload
+            )
+        self._lock = ReadWriteLock(file_lock=self._file_lock)
+        self._open_lock = threading.Lock()
+
+        if layout == COLLECTION_LAYOUT:
+            self._folder = os.path.join(foldername, database)
+            if not os.path.isdir(self._folder):
+                os.makedirs(self._folder)
+        else:
+            self._tinydb(None)
+
+    @property
+    def tinydb(self):
+        """The TinyDB of the database file, None with the 'collection'
+        layout"""
+        if self._layout == COLLECTION_LAYOUT:
+            return None
+        return self._tinydb(None)
+
+    def _tinydb(self, name):
+        """
+        Gets the TinyDB holding a collection, opening it if needed
+
+        :param name: the collection name
+        :return: TinyDB
+        """
+        if self._layout != COLLECTION_LAYOUT:
+            name = None
+
+        tinydb = self._files.get(name)
+        if tinydb is None:
+            # TinyDB reads the file when opened
+            with self._lock.read(), self._open_lock:
+                tinydb = self._files.get(name)
+                if tinydb is None:
+                    tinydb = self._open(name)
+        return tinydb
+
+    def _open(self, name):
+        """Opens the TinyDB holding a collection"""
+        middleware = WriteBatchMiddleware(self._new_storage())
+        if self._file_lock is not None:
+            # the data is read again only if another process changed it
+            middleware.cache_reads = True
+            middleware.on_write = self._file_lock.changed
+        tinydb = TinyDB(self._path(name), storage=middleware)
+        for savepoint in self._batches:
+            tinydb._storage.begin(savepoint)
+        self._files[name] = tinydb
+        return tinydb
+
+    def _reload(self):
+        """
+        Drops the in-memory state of the database after another process
+        changed its files
+        """
+        for indexes in self._indexes.values():
+            indexes.reset()
+        for tinydb in list(self._files.values()):
+            tinydb._storage.invalidate()
+        self._reset_tables()
+
+    def _reset_tables(self):
+        """
+        Drops the TinyDB query caches and recomputes the next document ids
+        of the tables, after their data changed under them
+        """
+        for tinydb in list(self._files.values()):
+            for table in tinydb._table_cache.values():
+                table.clear_cache()
+                data = table._read()
+                table._last_id = max(data) if data else 0
+
+    @property
+    def _parallel_scan(self):
+        """The ParallelScan of the client, None if scans are not split"""
+        if self._client is None:
+            return None
+        return self._client._parallel_scan
+
+    def _new_storage(self):
+        """Returns the storage for a TinyDB about to be opened"""
+        storage, self._pending_storage = self._pending_storage, None
+        if storage is not None:
+            return storage
+        if self._client is not None:
+            # a middleware instance can not be shared between files
+            return self._client._storage
+        return self._storage
+
+    def _path(self, name):
+        """Path of the file holding a collection"""
+        if self._layout == COLLECTION_LAYOUT:
+            return os.path.join(self._folder, name + u'.json')
+        return os.path.join(self._foldername, self._name + u'.json')
+
+    def _drop_collection(self, name):
+        """
+        Removes a collection and its data
+
+        :param name: the collection name
+        """
+        indexes = self._indexes.get(name)
+        if indexes is not None:
+            indexes.clear()
+        if self._layout != COLLECTION_LAYOUT:
+            self.tinydb.purge_table(name)
+            return
+
+        tinydb = self._files.pop(name, None)
+        if tinydb is not None:
+            tinydb.close()
+        path = self._path(name)
+        prefix = os.path.basename(path) + u'.'
+        for filename in os.listdir(self._folder):
+            if filename.startswith(prefix):
+                # files kept by the storage next to the collection file
+                os.remove(os.path.join(self._folder, filename))
+        if os.path.exists(path):
+            os.remove(path)
+
+    @contextmanager
+    def batch(self, rollback=False):
+        """
+        Holds the writes to the database file(s) until the block is done,
+        each file is then written once
+
+            with db.batch():
+                db.users.insert_one({'name': 'John'})
+                db.users.update_many({}, {'$inc': {'visits': 1}})
+
+        Reads within the block see the writes made so far. Batches can be
+        nested, the files are written when the outermost one is done.
+
+        :param rollback: if the block raises, undo its writes instead of
+                         writing them; a collection dropped in the block
+                         is not restored with the 'collection' layout
+        """
+        self._begin(rollback)
+        try:
+            yield self
+        except BaseException:
+            self._end(rollback)
+            raise
+        self._end()
+
+    def _begin(self, savepoint=False):
+        """
+        Opens a batch on the database file(s), `_end` closes it
+
+        The batch holds the write lock until it ends: the other threads,
+        and processes, wait for it, so a rollback can only undo the writes
+        of the batch.
+
+        :param savepoint: keep what is needed to roll the batch back
+        """
+        self._lock.acquire_write()
+        try:
+            self._batches.append(savepoint)
+            for tinydb in list(self._files.values()):
+                tinydb._storage.begin(savepoint)
+        except BaseException:
+            self._lock.release_write()
+            raise
+
+    def _end(self, rollback=False):
+        """
+        Closes the innermost batch, on the thread that opened it
+
+        :param rollback: undo the writes of the batch instead of keeping
+                         them
+        """
+        try:
+            self._batches.pop()
+            for tinydb in list(self._files.values()):
+                if rollback:
+                    tinydb._storage.rollback()
+                else:
+                    tinydb._storage.commit()
+            if rollback:
+                # the indexes and TinyDB tables saw the undone writes
+                for indexes in self._indexes.values():
+                    indexes.reset()
+                self._reset_tables()
+        finally:
+            # taken by `_begin`
+            self._lock.release_write()
 
     def __getattr__(self, name):
         """Gets a new or existing collection"""
-        return TinyMongoCollection(name, self)
+        return self[name]
 
     def __getitem__(self, name):
         """Gets a new or existing collection"""
-        return TinyMongoCollection(name, self)
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections.setdefault(
+                name, TinyMongoCollection(name, self)
+            )
+        return collection
+
+    def close(self):
+        """
+        Closes the database file(s)
+
+        The database and its collections can still be used, the files are
+        opened again when needed.
+        """
+        with self._lock.write():
+            for collection in self._collections.values():
+                collection.table = None
+            for indexes in self._indexes.values():
+                indexes.reset()
+            files, self._files = self._files, {}
+            for tinydb in files.values():
+                tinydb.close()
+
+    def lock_info(self):
+        """
+        Statistics of the lock shared by the collections of the database,
+        to watch the contention between threads
+
+        Many finds run at once, while writes run one at a time. The time
+        spent waiting for the lock is given in seconds.
+
+        :return: dict of the lock counters
+        """
+        return self._lock.info()
 
     def collection_names(self):
         """Get a list of all the collection names in this database"""
-        return list(self.tinydb.tables())
+        if self._layout != COLLECTION_LAYOUT:
+            with self._lock.read():
+                return list(self.tinydb.tables())
+        return sorted(
+            filename[:-len(u'.json')]
+            for filename in os.listdir(self._folder)
+            if filename.endswith(u'.json')
+        )
 
 
 class TinyMongoCollection(object):
@@ -140,20 +581,494 @@ class TinyMongoCollection(object):
             self.build_table()
         return self
 
+    @_read_locked
     def build_table(self):
         """
         Builds a new tinydb table at the parent database
         :return:
         """
-        self.table = self.parent.tinydb.table(self.tablename)
+        self.table = self.parent._tinydb(self.tablename).table(self.tablename)
+
+    @property
+    def _indexes(self):
+        """
+        The indexes of this collection, shared by every handle on it
+        :return: IndexManager
+        """
+        if self.table is None:
+            self.build_table()
+        indexes = self.parent._indexes.get(self.tablename)
+        if indexes is None:
+            indexes = self.parent._indexes[self.tablename] = IndexManager()
+        return indexes
+
+    @property
+    def _shares_data(self):
+        """
+        True if the documents read are shared with the storage, see
+        `WriteBatchMiddleware.shares_data`
+        """
+        return self.parent._tinydb(self.tablename)._storage.shares_data
+
+    def _handed_out(self, docs):
+        """
+        Copies the documents found when they are shared with the storage,
+        so that changing them does not change the stored ones
+
+        :param docs: iterable of the documents
+        :return: iterable of the documents to hand out
+        """
+        if not self._shares_data:
+            return docs
+        return (_copy_document(doc) for doc in docs)
+
+    def _write_table(self, data, doc_ids):
+        """
+        Writes the data of the table back, announcing the documents that
+        changed so that the storage does not compare the others, see
+        `WriteBatchMiddleware.mark_changed`
+
+        :param data: the table data, as read by `table._read()`
+        :param doc_ids: ids of the documents added, changed or removed
+        """
+        storage = self.parent._tinydb(self.tablename)._storage
+        storage.mark_changed(self.tablename, doc_ids)
+        self.table._write(data)
+
+    @_read_locked
+    def _find_by_id(self, _id):
+        """
+        Gets a document by its `_id` through the `_id` index
+
+        :param _id: the `_id` value to look for
+        :return: the document or None
+        """
+        indexes = self._indexes
+        indexes.ensure_built(self.table)
+        for doc_id in indexes.id_index.lookup(_id):
+            doc = self.table.get(doc_id=doc_id)
+            if doc is None or doc.get(u'_id') != _id:
+                # the table was modified without going through the
+                # collection, the index can not be trusted anymore
+                indexes.reset()
+                return self.table.get(self.parse_query({u'_id': _id}))
+            return doc
+        return None
+
+    @_read_locked
+    def _plan(self, filter):
+        """
+        Picks the index (or the collection scan) to run a query with
+
+        :param filter: dictionary representing the mongo query
+        :return: QueryPlan
+        """
+        return plan_query(self._indexes, self.table, filter)
+
+    def _iter_search(self, allcond, plan, data=None, parallel=False):
+        """
+        Yields the documents matching a compiled query, in insertion order
+
+        The candidates are read from an index when the plan has one,
+        otherwise every document of the table is checked. Documents are
+        checked as they are pulled, so a consumer that stops early does not
+        pay for the rest of the collection.
+
+        :param allcond: the compiled query, as returned by `parse_query`
+        :param plan: QueryPlan to run and record statistics in
+        :param data: the table data to search, read from the table when
+                     not given
+        :param parallel: the search runs to the end, the documents can be
+                         checked by the parallel scan of the client
+        """
+        # a cursor runs its query again when rewound, count once
+        plan.reset_stats()
+        started = time.time()
+        with self.parent._lock.read():
+            if self.table is None:
+                self.build_table()
+            if plan.reads_indexes:
+                # reset since planned, by a rollback or another process
+                self._indexes.ensure_built(self.table)
+            # a snapshot, the documents are checked out of the lock
+            doc_ids = plan.doc_ids()
+            if data is None:
+                data = self.table._read()
+        if doc_ids is None:
+            docs = data.values()
+        else:
+            docs = (
+                data[doc_id] for doc_id in sorted(doc_ids) if doc_id in data
+            )
+
+        scan = self.parent._parallel_scan
+        if parallel and scan is not None and plan.query:
+            docs = list(docs)
+            if len(docs) >= scan.threshold:
+                matches = scan.filter(plan.query, allcond, docs)
+                plan.docs_examined += len(docs)
+                plan.n_returned += len(matches)
+                plan.execution_millis += (time.time() - started) * 1000
+                for doc in matches:
+                    yield doc
+                return
+
+        for doc in docs:
+            plan.docs_examined += 1
+            if allcond(doc):
+                plan.n_returned += 1
+                plan.execution_millis += (time.time() - started) * 1000
+                yield doc
+                started = time.time()
+
+        plan.execution_millis += (time.time() - started) * 1000
+
+    def _search(self, filter, limit=None, plan=None):
+        """
+        Gets the documents matching a query, in insertion order
+
+        :param filter: dictionary representing the mongo query
+        :param limit: stop after this many matching documents
+        :param plan: QueryPlan to run and record statistics in, planned
+                     from `filter` when not given
+        :return: list of the matching documents
+        """
+        if plan is None:
+            plan = self._plan(filter)
+        allcond = self.parse_query(filter)
+        return list(islice(self._iter_search(allcond, plan), limit or None))
+
+    @_write_locked
+    def create_index(self, keys, unique=False, sparse=False, name=None,
+                     **kwargs):
+        """
+        Creates an index on a field of the collection
+
+        Indexes are kept in memory: they are built from the documents when
+        created and kept up to date by every write to the collection.
+        Queries use them for equality, `$in` and range conditions.
+
+        :param keys: a field name, or a list with one (field, direction)
+                     pair, the field can be a dotted path
+        :param unique: refuse documents whose value is already indexed
+        :param sparse: skip documents that lack the field
+        :param name: custom name for the index
+        :return: the name of the index
+        """
+        field, direction = _index_spec(keys)
+        if field == u'_id':
+            return self._indexes.id_index.name
+
+        index = Index(
+            field,
+            name=name,
+            direction=direction,
+            unique=unique,
+            sparse=sparse
+        )
+        return self._indexes.create(self.table, index)
+
+    def ensure_index(self, keys, **kwargs):
+        """Backwards compatibility with ensure_index"""
+        return self.create_index(keys, **kwargs)
+
+    @_write_locked
+    def drop_index(self, index_or_name):
+        """
+        Drops an index of the collection
+
+        :param index_or_name: the index name or the keys it was created with
+        """
+        name = index_or_name
+        if not isinstance(name, basestring):
+            name = u'{0}_{1}'.format(*_index_spec(index_or_name))
+        self._indexes.drop(name)
+
+    @_write_locked
+    def drop_indexes(self):
+        """Drops all the indexes of the collection but the `_id` one"""
+        indexes = self._indexes
+        for index in indexes.indexes:
+            if index is not indexes.id_index:
+                indexes.drop(index.name)
+
+    def list_indexes(self):
+        """
+        Lists the indexes of the collection
+        :return: cursor over a document describing each index
+        """
+        return TinyMongoCursor(
+            [index.info for index in self._indexes.indexes]
+        )
+
+    def index_information(self):
+        """
+        Gets information on the indexes of the collection
+        :return: dict mapping each index name to its description
+        """
+        information = {}
+        for index in self._indexes.indexes:
+            info = dict(index.info)
+            info[u'key'] = [(index.field, index.direction)]
+            del info[u'name']
+            information[index.name] = info
+        return information
+
+    @_write_locked
+    def create_column_cache(self, fields):
+        """
+        Keeps numeric and boolean fields of the collection in NumPy arrays
+
+        Queries with no index to use and a range, equality or `$in`
+        condition on one of the fields then filter the arrays for the
+        documents to check, instead of checking them all. Like the
+        indexes, the columns are kept in memory and patched by every write.
+        Needs numpy.
+
+        :param fields: list of the (dotted) fields to keep, replacing the
+                       current column cache if any
+        """
+        if isinstance(fields, basestring):
+            fields = [fields]
+        self._indexes.cache_columns(self.table, ColumnCache(fields))
+
+    @_write_locked
+    def drop_column_cache(self):
+        """Drops the column cache of the collection"""
+        self._indexes.cache_columns(self.table, None)
+
+    @_write_locked
+    def create_result_cache(self, max_entries=256, max_bytes=None):
+        """
+        Caches the results of the finds and counts of the collection
+
+        Repeated queries, with the same filter, sort, skip and limit, are
+        then answered from memory until the collection is written to.
+        Dropping the collection empties the cache but keeps it, like the
+        column cache.
+
+        :param max_entries: number of results to keep
+        :param max_bytes: total size of the results to keep, measured as
+                          JSON, None to not measure them
+        """
+        self._indexes.results = ResultCache(max_entries, max_bytes)
+
+    @_write_locked
+    def drop_result_cache(self):
+        """Drops the result cache of the collection"""
+        self._indexes.results = None
+
+    def result_cache_info(self):
+        """
+        Statistics of the result cache of the collection
+        :return: dict of the hits, misses, hit ratio, evictions and size of
+                 the cache, None without a cache
+        """
+        cache = self._indexes.results
+        return None if cache is None else cache.info()
+
+    def _cached(self, kind, filter, options, compute):
+        """
+        Gets the result of a query from the result cache, computing and
+        caching it on a miss
+
+        :param kind: name of the query type
+        :param filter: dictionary representing the mongo query
+        :param options: the other parameters of the query, like its sort
+        :param compute: function computing the result
+        :return: the result
+        """
+        indexes = self._indexes
+        cache = indexes.results
+        if cache is None:
+            return compute()
+        with self.parent._lock.read():
+            # checks for writes of other processes too
+            generation = indexes.generation
+        key = cache.key(kind, filter, options)
+        found, result = cache.get(key, generation)
+        if not found:
+            result = compute()
+            cache.put(key, generation, result)
+        return result
 
     def count(self):
         """
         Counts the documents in the collection.
         :return: Integer representing the number of documents in the collection.
         """
-        return self.find().count()
+        return self.estimated_document_count()
+
+    @_read_locked
+    def estimated_document_count(self, **kwargs):
+        """
+        Counts the documents in the collection
+
+        The count is kept by the indexes of the collection, it is only
+        computed from the documents when the indexes are (re)built.
+
+        :return: the number of documents
+        """
+        if self.table is None:
+            self.build_table()
+        indexes = self._indexes
+        indexes.ensure_built(self.table)
+        return indexes.doc_count
+
+    def count_documents(self, filter, skip=None, limit=None, **kwargs):
+        """
+        Counts the documents matching a query
+
+        Queries with no condition, or a single equality on an indexed
+        field, are counted from the indexes. Other queries check the
+        documents as stored, without copying them or keeping the matches.
+
+        :param filter: dictionary representing the mongo query
+        :param skip: number of matching documents not to count
+        :param limit: maximum number of documents to count
+        :return: the number of matching documents
+        """
+        skip = skip or 0
+        count = self._index_count(filter)
+        if count is None:
+            stop = skip + limit if limit else None
+            count = self._cached(
+                u'count', filter, stop,
+                lambda: self._scan_count(filter, stop)
+            )
+        count = max(count - skip, 0)
+        if limit:
+            count = min(count, limit)
+        return count
+
+    @_read_locked
+    def _index_count(self, filter):
+        """
+        Counts the documents matching a query from the indexes alone
+
+        :param filter: dictionary representing the mongo query
+        :return: the number of documents, None if the indexes can not
+                 tell it
+        """
+        if not filter:
+            return self.estimated_document_count()
+        if len(filter) != 1:
+            return None
+        field, value = list(filter.items())[0]
+        if isinstance(value, bool) or \
+                not isinstance(value, NUMBER_CLASSES + (basestring,)):
+            return None
+        for index in self._indexes.indexes:
+            if index.field == field:
+                self._indexes.ensure_built(self.table)
+                return len(index.lookup(value))
+        return None
+
+    def _scan_count(self, filter, stop=None):
+        """
+        Counts the documents matching a query, reading the candidates from
+        an index when possible
 
+        :param filter: dictionary representing the mongo query
+        :param stop: stop counting at this many matches
+        :return: the number of matching documents
+        """
+        allcond, candidates = self._stored_candidates(filter)
+        scan = self.parent._parallel_scan
+        if stop is None and scan is not None and filter and \
+                len(candidates) >= scan.threshold:
+            return len(scan.filter(filter, allcond, list(candidates)))
+        matches = (doc for doc in candidates if allcond(doc))
+        return sum(1 for _ in islice(matches, stop))
+
+    def _stored_candidates(self, filter):
+        """
+        Gets the documents a query has to check, from an index when
+        possible, as stored: they are not copied like `table._read()` does,
+        so they must not be changed
+
+        :param filter: dictionary representing the mongo query
+        :return: (the compiled query, collection of the documents)
+        """
+        plan = self._plan(filter)
+        allcond = self.parse_query(filter)
+        with self.parent._lock.read():
+            if self.table is None:
+                self.build_table()
+            if plan.reads_indexes:
+                self._indexes.ensure_built(self.table)
+            doc_ids = plan.doc_ids()
+            # the documents as stored, TinyDB copies them in table._read()
+            data = self.parent._tinydb(self.tablename)._storage.read() or {}
+            docs = data.get(self.tablename, {})
+
+        if doc_ids is None:
+            candidates = docs.values()
+        else:
+            # the keys are strings once loaded from JSON
+            candidates = (
+                docs.get(u'{0}'.format(doc_id), docs.get(doc_id))
+                for doc_id in doc_ids
+            )
+            candidates = [doc for doc in candidates if doc is not None]
+        return allcond, candidates
+
+    def distinct(self, key, filter=None, **kwargs):
+        """
+        Gets the distinct values of a field
+
+        Like MongoDB, the items of array values are taken one by one.
+        Without a filter, the values are read from an index on the field
+        when there is one, else the documents are checked as stored.
+
+        :param key: dotted path of the field
+        :param filter: dictionary representing the mongo query
+        :return: list of the distinct values
+        """
+        if not isinstance(key, basestring):
+            raise TypeError(u'key must be a string')
+
+        values = None
+        if not filter:
+            values = self._index_distinct(key)
+        if values is None:
+            getter = make_getter(key)
+            allcond, candidates = self._stored_candidates(filter)
+            values = _distinct_values(
+                getter(doc) for doc in candidates if allcond(doc)
+            )
+        # the values are shared with the storage
+        return [copy.deepcopy(value) for value in values]
+
+    @_read_locked
+    def _index_distinct(self, key):
+        """
+        Gets the distinct values of a field from the keys of an index
+
+        :param key: dotted path of the field
+        :return: list of the values, None if no index can tell them
+        """
+        indexes = self._indexes
+        for index in indexes.indexes:
+            if index.field == key:
+                break
+        else:
+            return None
+
+        indexes.ensure_built(self.table)
+        values = list()
+        for index_value in index.distinct_keys():
+            if isinstance(index_value, tuple) and index_value[0] == u'$list':
+                # whole arrays and array items of arrays look alike
+                return None
+            if index_value is None and not index.sparse:
+                # missing fields are indexed as None too
+                return None
+            values.append(index_value_of(index_value))
+        return values
+
+    @_write_locked
+    @_write_locked
     def drop(self, **kwargs):
         """
         Removes a collection from the database.
@@ -162,7 +1077,8 @@ class TinyMongoCollection(object):
         exist.
         """
         if self.table:
-            self.parent.tinydb.purge_table(self.tablename)
+            self.parent._drop_collection(self.tablename)
+            self.table = None
             return True
         else:
             return False
@@ -174,6 +1090,7 @@ class TinyMongoCollection(object):
         else:
             return self.insert_one(docs, *args, **kwargs)
 
+    @_write_locked
     def insert_one(self, doc, *args, **kwargs):
         """
         Inserts one document into the collection
@@ -181,262 +1098,232 @@ class TinyMongoCollection(object):
         :param doc: the document
         :return: InsertOneResult
         """
-        if self.table is None:
-            self.build_table()
-
         if not isinstance(doc, dict):
             raise ValueError(u'"doc" must be a dict')
 
-        _id = doc[u'_id'] = doc.get('_id') or generate_id()
-
-        bypass_document_validation = kwargs.get('bypass_document_validation')
-        if bypass_document_validation is True:
-            # insert doc without validation of duplicated `_id`
-            eid = self.table.insert(doc)
-        else:
-            existing = self.find_one({'_id': _id})
-            if existing is None:
-                eid = self.table.insert(doc)
-            else:
-                raise DuplicateKeyError(
-                    u'_id:{0} already exists in collection:{1}'.format(
-                        _id, self.tablename
-                    )
-                )
+        check = kwargs.get('bypass_document_validation') is not True
+        with self._writing() as (data, changed):
+            eids = self._insert_docs(data, changed, [doc], check)
 
-        return InsertOneResult(eid=eid, inserted_id=_id)
+        return InsertOneResult(eid=eids[0], inserted_id=doc[u'_id'])
 
+    @_write_locked
     def insert_many(self, docs, *args, **kwargs):
         """
         Inserts several documents into the collection
         :param docs: a list of documents
         :return: InsertManyResult
         """
-        if self.table is None:
-            self.build_table()
-
         if not isinstance(docs, list):
             raise ValueError(u'"insert_many" requires a list input')
 
-        bypass_document_validation = kwargs.get('bypass_document_validation')
-
-        if bypass_document_validation is not True:
-            # get all _id in once, to reduce I/O. (without projection)
-            existing = [doc['_id'] for doc in self.find({})]
-
-        _ids = list()
-        for doc in docs:
+        check = kwargs.get('bypass_document_validation') is not True
+        with self._writing() as (data, changed):
+            eids = self._insert_docs(data, changed, docs, check)
 
-            _id = doc[u'_id'] = doc.get('_id') or generate_id()
+        return InsertManyResult(
+            eids=eids,
+            inserted_ids=[doc[u'_id'] for doc in docs]
+        )
 
-            if bypass_document_validation is not True:
-                if _id in existing:
-                    raise DuplicateKeyError(
-                        u'_id:{0} already exists in collection:{1}'.format(
-                            _id, self.tablename
-                        )
-                    )
-                existing.append(_id)
+    @contextmanager
+    def _writing(self):
+        """
+        Reads the table data for a write path to change, and writes it back
+        once if any document changed
+
+        The write path changes the data and the indexes right away, through
+        `_insert_docs`, `_update_docs` and `_delete_docs`, and lists the
+        ids of the documents it added, changed or removed. The indexes are
+        built first, so the later changes of a bulk find the documents of
+        the earlier ones through them. If the write path raises after
+        changing some documents, nothing is written and the indexes are
+        rebuilt on next access.
+
+        :return: (the table data, list of the changed doc ids)
+        """
+        if self.table is None:
+            self.build_table()
 
-            _ids.append(_id)
+        self._indexes.ensure_built(self.table)
+        last_id = self.table._last_id
+        data = self.table._read()
+        changed = list()
+        try:
+            yield data, changed
+            if changed:
+                self._write_table(data, changed)
+        except BaseException:
+            if changed:
+                self.table._last_id = last_id
+                self._indexes.reset()
+            raise
+
+    def _insert_docs(self, data, changed, docs, check=True):
+        """
+        Inserts documents into the table data, see `_writing`
 
-        results = self.table.insert_multiple(docs)
+        Nothing is inserted if a document violates a unique index.
 
-        return InsertManyResult(
-            eids=[eid for eid in results],
-            inserted_ids=[inserted_id for inserted_id in _ids]
-        )
+        :param data: the table data
+        :param changed: list the ids of the new documents are added to
+        :param docs: list of the documents, given an `_id` if they lack one
+        :param check: check the unique indexes
+        :return: list of the doc ids of the new documents
+        """
+        indexes = self._indexes
+        # keys claimed by the documents of this batch, per index
+        batch = {}
+
+        for position, doc in enumerate(docs):
+            doc[u'_id'] = doc.get(u'_id') or generate_id()
+            if check:
+                # documents of the batch have no doc_id yet, number them apart
+                indexes.check(-1 - position, doc, batch)
+
+        shares_data = self._shares_data
+        eids = list()
+        for doc in docs:
+            eid = self.table._get_next_id()
+            data[eid] = Document(
+                _copy_value(doc) if shares_data else doc, eid
+            )
+            indexes.add(eid, data[eid])
+            changed.append(eid)
+            eids.append(eid)
+        return eids
 
     def parse_query(self, query):
         """
-        Creates a tinydb Query() object from the query dict
+        Compiles the query dict into a predicate over the documents
 
         :param query: object containing the dictionary representation of the
         query
-        :return: composite Query()
+        :return: function taking a document and returning True if it matches
         """
-        logger.debug(u'query to parse2: {}'.format(query))
-
-        # this should find all records
-        if query == {} or query is None:
-            return Query()._id != u'-1'  # noqa
+        logger.debug(u'query to parse: %s', query)
 
-        q = None
-        # find the final result of the generator
-        for c in self.parse_condition(query):
-            if q is None:
-                q = c
-            else:
-                q = q & c
-
-        logger.debug(u'new query item2: {}'.format(q))
-
-        return q
-
-    def parse_condition(self, query, prev_key=None, last_prev_key=None):
-        """
-        Creates a recursive generator for parsing some types of Query()
-        conditions
-
-        :param query: Query object
-        :param prev_key: The key at the next-higher level
-        :return: generator object, the last of which will be the complete
-        Query() object containing all conditions
-        """
-        # use this to determine gt/lt/eq on prev_query
-        logger.debug(u'query: {} prev_query: {}'.format(query, prev_key))
-
-        q = Query()
-        conditions = None
-
-        # deal with the {'name': value} case by injecting a previous key
-        if not prev_key:
-            temp_query = copy.deepcopy(query)
-            k, v = temp_query.popitem()
-            prev_key = k
-
-        # deal with the conditions
-        for key, value in query.items():
-            logger.debug(u'conditions: {} {}'.format(key, value))
-
-            if key == u'$gte':
-                conditions = (
-                    Q(q, prev_key) >= value
-                ) if not conditions and prev_key != "$not" \
-                else (conditions & (Q(q, prev_key) >= value)) if prev_key != "$not" \
-                else (q[last_prev_key] < value)
-            elif key == u'$gt':
-                conditions = (
-                    Q(q, prev_key) > value
-                ) if not conditions and prev_key != "$not" \
-                else (conditions & (Q(q, prev_key) > value)) if prev_key != "$not" \
-                else (q[last_prev_key] <= value)
-            elif key == u'$lte':
-                conditions = (
-                    Q(q, prev_key) <= value
-                ) if not conditions and prev_key != "$not" \
-                else (conditions & (Q(q, prev_key) <= value)) if prev_key != "$not" \
-                else (q[last_prev_key] > value)
-            elif key == u'$lt':
-                conditions = (
-                    Q(q, prev_key) < value
-                ) if not conditions and prev_key != "$not" \
-                else (conditions & (Q(q, prev_key) < value)) if prev_key != "$not" \
-                else (q[last_prev_key] >= value)
-            elif key == u'$ne':
-                conditions = (
-                    Q(q, prev_key) != value
-                ) if not conditions and prev_key != "$not" \
-                else (conditions & (Q(q, prev_key) != value))if prev_key != "$not" \
-                else (q[last_prev_key] == value)
-            elif key == u'$not':
-                if not isinstance(value, dict) and not isinstance(value, list):
-                    conditions = (
-                        Q(q, prev_key) != value
-                    ) if not conditions and prev_key != "$not" \
-                    else (conditions & (Q(q, prev_key) != value)) \
-                    if prev_key != "$not" else (q[last_prev_key] >= value)
-                else:
-                    # let the value's condition be parsed below
-                    pass
-            elif key == u'$regex':
-                value = value.replace('\\\\\\', '|||')
-                value = value.replace('\\\\', '|||')
-                regex = value.replace('\\', '')
-                regex = regex.replace('|||', '\\')
-                currCond = (where(prev_key).matches(regex))
-                conditions = currCond if not conditions else (conditions & currCond)
-            elif key in ['$and', '$or', '$in', '$all']:
-                pass
-            else:
-
-
-                # don't want to use the previous key if this is a secondary key
-                # (fixes multiple item query that includes $ codes)
-                if not isinstance(value, dict) and not isinstance(value, list):
-                    conditions = (
-                        (Q(q, key) == value) | (Q(q, key).any([value]))
-                    ) if not conditions else (conditions & ((Q(q, key) == value) | (Q(q, key).any([value]))))
-                    prev_key = key
-
-            logger.debug(u'c: {}'.format(conditions))
-            if isinstance(value, dict):
-                # yield from self.parse_condition(value, key)
-                for parse_condition in self.parse_condition(value, key, prev_key):
-                    yield parse_condition
-            elif isinstance(value, list):
-                if key == '$and':
-                    grouped_conditions = None
-                    for spec in value:
-                        for parse_condition in self.parse_condition(spec):
-                            grouped_conditions = (
-                                parse_condition
-                                if not grouped_conditions
-                                else grouped_conditions & parse_condition
-                            )
-                    yield grouped_conditions
-                elif key == '$or':
-                    grouped_conditions = None
-                    for spec in value:
-                        for parse_condition in self.parse_condition(spec):
-                            grouped_conditions = (
-                                parse_condition
-                                if not grouped_conditions
-                                else grouped_conditions | parse_condition
-                            )
-                    yield grouped_conditions
-                elif key == '$in':
-                    # use `any` to find with list, before comparing to single string
-                    grouped_conditions = Q(q, prev_key).any(value)
-                    for val in value:
-                        for parse_condition in self.parse_condition({prev_key : val}):
-                            grouped_conditions = (
-                                parse_condition
-                                if not grouped_conditions
-                                else grouped_conditions | parse_condition
-                            )
-                    yield grouped_conditions
-                elif key == '$all':
-                    yield Q(q, prev_key).all(value)
-                else:
-                    yield Q(q, prev_key).any([value])
-            else:
-                yield conditions
+        return query_cache.compile(query)
 
     def update(self, query, doc, *args, **kwargs):
         """BAckwards compatibility with update"""
+        update = self.update_one
+        if kwargs.pop(u'multi', False):
+            update = self.update_many
         if isinstance(doc, list):
             return [
-                self.update_one(query, item, *args, **kwargs)
+                update(query, item, *args, **kwargs)
                 for item in doc
             ]
         else:
-            return self.update_one(query, doc, *args, **kwargs)
+            return update(query, doc, *args, **kwargs)
 
-    def update_one(self, query, doc):
+    def update_one(self, query, doc, upsert=False, *args, **kwargs):
         """
         Updates one element of the collection
 
         :param query: dictionary representing the mongo query
-        :param doc: dictionary representing the item to be updated
+        :param doc: dictionary of update operators ($set, $unset, $inc,
+                    $push, $pull, $min, $max), or of fields to set
+        :param upsert: insert a document if none matches the query
         :return: UpdateResult
         """
-        if self.table is None:
-            self.build_table()
+        return self._update(query, doc, limit=1, upsert=upsert)
 
-        if u"$set" in doc:
-            doc = doc[u"$set"]
+    def update_many(self, query, doc, upsert=False, *args, **kwargs):
+        """
+        Updates all the elements of the collection matching the query
 
-        allcond = self.parse_query(query)
+        :param query: dictionary representing the mongo query
+        :param doc: dictionary of update operators, see `update_one`
+        :param upsert: insert a document if none matches the query
+        :return: UpdateResult
+        """
+        return self._update(query, doc, upsert=upsert)
 
-        try:
-            result = self.table.update(doc, allcond)
-        except:
-            # TODO: check table.update result
-            # check what pymongo does in that case
-            result = None
+    @_write_locked
+    def _update(self, query, doc, limit=None, upsert=False):
+        """
+        Applies an update to the documents matching a query
+
+        The table is read once and, if any document changed, written back
+        once, see `_update_docs`.
+
+        :param query: dictionary representing the mongo query
+        :param doc: dictionary of update operators
+        :param limit: update at most this many documents
+        :param upsert: insert a document if none matches the query
+        :return: UpdateResult
+        """
+        with self._writing() as (data, changed):
+            matched, modified, upserted_id = self._update_docs(
+                data, changed, query, doc, limit, upsert
+            )
+
+        if upserted_id is not None:
+            return UpdateResult(raw_result=[], upserted_id=upserted_id)
+        return UpdateResult(raw_result=matched, modified_count=modified)
+
+    def _update_docs(self, data, changed, query, doc, limit=None,
+                     upsert=False):
+        """
+        Applies an update to the documents of the table data matching a
+        query, see `_writing`
 
-        return UpdateResult(raw_result=result)
+        Nothing is updated if a document of the batch violates a unique
+        index or can not be updated. With `upsert`, when no document
+        matches, a new one is inserted: the fields of the equalities of the
+        query, updated by `doc`.
+
+        :param data: the table data
+        :param changed: list the ids of the changed documents are added to
+        :param query: dictionary representing the mongo query
+        :param doc: dictionary of update operators
+        :param limit: update at most this many documents
+        :param upsert: insert a document if none matches the query
+        :return: (doc ids of the matched documents, number of modified
+                 documents, `_id` of the upserted document or None)
+        """
+        updater = compile_update(doc)
+        allcond = self.parse_query(query)
+        plan = self._plan(query)
+
+        indexes = self._indexes
+        matches = list(
+            islice(self._iter_search(allcond, plan, data), limit or None)
+        )
+        if not matches and upsert:
+            new_doc = _upsert_doc(query, doc, updater)
+            self._insert_docs(data, changed, [new_doc])
+            return [], 0, new_doc[u'_id']
+
+        # apply and check everything before changing anything
+        updated = list()
+        batch = {}
+        for match in matches:
+            new_doc = updater(match)
+            if new_doc == match:
+                continue
+            if new_doc.get(u'_id') != match.get(u'_id'):
+                raise WriteError(
+                    u"Performing an update on the path '_id' would modify "
+                    u"the immutable field '_id'"
+                )
+            indexes.check(match.doc_id, new_doc, batch)
+            updated.append((match, new_doc))
+
+        # the values of the update operators are not copied
+        shares_data = self._shares_data
+        for match, new_doc in updated:
+            doc_id = match.doc_id
+            data[doc_id] = Document(
+                _copy_value(new_doc) if shares_data else new_doc, doc_id
+            )
+            indexes.remove(doc_id, match)
+            indexes.add(doc_id, data[doc_id])
+            changed.append(doc_id)
+
+        return [match.doc_id for match in matches], len(updated), None
 
     def find(self, filter=None, sort=None, skip=None, limit=None,
              *args, **kwargs):
@@ -449,29 +1336,32 @@ class TinyMongoCollection(object):
         if self.table is None:
             self.build_table()
 
-        if filter is None:
-            result = self.table.all()
-        else:
-            allcond = self.parse_query(filter)
+        plan = self._plan(filter)
+        allcond = self.parse_query(filter)
 
-            try:
-                result = self.table.search(allcond)
-            except (AttributeError, TypeError):
-                result = []
+        cache = None
+        if self._indexes.results is not None:
+            cache = partial(self._cached, u'find', filter)
 
         result = TinyMongoCursor(
-            result,
+            lambda: self._handed_out(self._iter_search(
+                allcond, plan, parallel=result._reads_all
+            )),
             sort=sort,
             skip=skip,
-            limit=limit
+            limit=limit,
+            plan=plan,
+            cache=cache
         )
 
         return result
 
-    def find_one(self, filter=None):
+    def find_one(self, filter=None, *args, **kwargs):
         """
         Finds one matching query element
 
+        The scan stops at the first match, unless a sort is requested.
+
         :param query: dictionary representing the mongo query
         :return: the resulting document (if found)
         """
@@ -479,16 +1369,89 @@ class TinyMongoCollection(object):
         if self.table is None:
             self.build_table()
 
-        allcond = self.parse_query(filter)
+        if _is_id_filter(filter) and not args and not kwargs:
+            doc = self._find_by_id(filter[u'_id'])
+            if doc is not None and self._shares_data:
+                doc = _copy_document(doc)
+            return doc
+
+        kwargs[u'limit'] = 1
+        for doc in self.find(filter, *args, **kwargs):
+            return doc
+        return None
 
-        return self.table.get(allcond)
+    def aggregate(self, pipeline, **kwargs):
+        """
+        Runs an aggregation pipeline over the collection
+
+        Supported stages are $match, $project, $group (with $sum, $avg,
+        $min, $max and $push), $sort, $skip, $limit, $unwind and $count.
+        The documents stream through the stages, and the $match, $sort,
+        $skip and $limit heading the pipeline run as a `find`, using the
+        indexes.
+
+        :param pipeline: list of stages
+        :return: cursor over the output documents
+        """
+        find_args, stages = compile_pipeline(pipeline)
+        docs = self.find(**find_args)
+        return TinyMongoCursor(lambda: run_pipeline(docs, stages))
 
     def remove(self, spec_or_id, multi=True, *args, **kwargs):
         """Backwards compatibility with remove"""
+        if spec_or_id is None:
+            # like pymongo, removes everything
+            spec_or_id = {}
+        if not isinstance(spec_or_id, dict):
+            spec_or_id = {u'_id': spec_or_id}
         if multi:
             return self.delete_many(spec_or_id)
         return self.delete_one(spec_or_id)
 
+    @_write_locked
+    def _delete(self, query, limit=None):
+        """
+        Removes the documents matching a query
+
+        The table is read once and written back once, whatever the number
+        of removed documents.
+
+        :param query: dictionary representing the mongo query
+        :param limit: remove at most this many documents
+        :return: list of the doc ids of the removed documents
+        """
+        with self._writing() as (data, changed):
+            return self._delete_docs(data, changed, query, limit)
+
+    def _delete_docs(self, data, changed, query, limit=None):
+        """
+        Removes the documents of the table data matching a query, see
+        `_writing`
+
+        :param data: the table data
+        :param changed: list the ids of the removed documents are added to
+        :param query: dictionary representing the mongo query
+        :param limit: remove at most this many documents
+        :return: list of the doc ids of the removed documents
+        """
+        allcond = self.parse_query(query)
+        plan = self._plan(query)
+        matches = list(
+            islice(self._iter_search(allcond, plan, data), limit or None)
+        )
+
+        indexes = self._indexes
+        for doc in matches:
+            del data[doc.doc_id]
+            indexes.remove(doc.doc_id, doc)
+            changed.append(doc.doc_id)
+
+        if query == {} and not data:
+            # need to reset TinyDB's index for docs order consistency
+            self.table._last_id = 0
+
+        return [doc.doc_id for doc in matches]
+
     def delete_one(self, query):
         """
         Deletes one document from the collection
@@ -496,10 +1459,7 @@ class TinyMongoCollection(object):
         :param query: dictionary representing the mongo query
         :return: DeleteResult
         """
-        item = self.find_one(query)
-        result = self.table.remove(where(u'_id') == item[u'_id'])
-
-        return DeleteResult(raw_result=result)
+        return DeleteResult(raw_result=self._delete(query, limit=1))
 
     def delete_many(self, query):
         """
@@ -508,114 +1468,272 @@ class TinyMongoCollection(object):
         :param query: dictionary representing the mongo query
         :return: DeleteResult
         """
-        items = self.find(query)
-        result = [
-            self.table.remove(where(u'_id') == item[u'_id'])
-            for item in items
-        ]
+        return DeleteResult(raw_result=self._delete(query))
 
-        if query == {}:
-            # need to reset TinyDB's index for docs order consistency
-            self.table._last_id = 0
+    @_write_locked
+    def bulk_write(self, requests, ordered=True, *args, **kwargs):
+        """
+        Runs a batch of write operations
+
+        The table is read once, the operations change its data and the
+        indexes one after the other, and it is written back once, at the
+        end.
+
+        :param requests: list of InsertOne, UpdateOne, UpdateMany, DeleteOne
+                         and DeleteMany operations
+        :param ordered: run the operations in order and stop at the first
+                        error, else run all of them whatever the errors
+        :return: BulkWriteResult
+        """
+        if not isinstance(requests, list):
+            raise TypeError(u'"requests" must be a list')
+        if not requests:
+            raise InvalidOperation(u'No operations to execute')
+        for request in requests:
+            if not hasattr(request, u'_execute'):
+                raise TypeError(
+                    u'{0!r} is not a valid request'.format(request)
+                )
+
+        result = {
+            u'writeErrors': [],
+            u'nInserted': 0,
+            u'nUpserted': 0,
+            u'nMatched': 0,
+            u'nModified': 0,
+            u'nRemoved': 0,
+            u'upserted': [],
+        }
+        with self._writing() as (data, changed):
+            for position, request in enumerate(requests):
+                try:
+                    request._execute(self, data, changed, result, position)
+                except WriteError as error:
+                    result[u'writeErrors'].append({
+                        u'index': position,
+                        u'code': error.code,
+                        u'errmsg': u'{0}'.format(error),
+                        u'op': request,
+                    })
+                    if ordered:
+                        break
 
-        return DeleteResult(raw_result=result)
+        if result[u'writeErrors']:
+            raise BulkWriteError(u'batch op errors occurred', 65, result)
+
+        return BulkWriteResult(result)
 
 
 class TinyMongoCursor(object):
-    """Mongo iterable cursor"""
+    """
+    Mongo iterable cursor
 
-    def __init__(self, cursordat, sort=None, skip=None, limit=None):
-        """Initialize the mongo iterable cursor with data"""
-        self.cursordat = cursordat
-        self.cursorpos = -1
+    The results are pulled lazily from the query: iterating the cursor only
+    runs the query as far as the documents it yields. They are materialized
+    into `cursordat` the first time a sort, a count or an access by index
+    needs all of them, or right away when the collection caches results.
+    """
 
-        if len(self.cursordat) == 0:
-            self.currentrec = None
+    def __init__(self, cursordat, sort=None, skip=None, limit=None,
+                 plan=None, cache=None):
+        """
+        Initialize the mongo iterable cursor with data
+
+        :param cursordat: list of documents, or function returning a new
+                          iterator over the matching documents
+        :param sort: sort specification, see `sort`
+        :param skip: number of documents to skip
+        :param limit: maximum number of documents to return
+        :param plan: QueryPlan of the query that produced the documents
+        :param cache: function called with the sort, skip and limit of the
+                      cursor and a function materializing the records,
+                      returning the records, possibly from a cache
+        """
+        if callable(cursordat):
+            self._source = cursordat
         else:
-            self.currentrec = self.cursordat[self.cursorpos]
+            docs = list(cursordat)
+            self._source = lambda: iter(docs)
+
+        self._rows = None
+        self._stream = None
+        self._buffer = deque()
+        self._batch_size = 0
+        self.cursorpos = -1
+        self.plan = plan
+        self._cache = cache
+        self._sort_specifier = None
+        self._skip = skip
+        self._limit = limit
 
         if sort:
             self.sort(sort)
 
-        self.paginate(skip, limit)
+    @property
+    def cursordat(self):
+        """All the records of the cursor, materialized on first access"""
+        if self._rows is None:
+            if self._cache is None:
+                self._rows = self._materialize()
+            else:
+                options = (self._sort_specifier, self._skip, self._limit)
+                self._rows = self._cache(options, self._materialize)
+        return self._rows
+
+    @cursordat.setter
+    def cursordat(self, value):
+        self._rows = value
+
+    def _materialize(self):
+        """Runs the query to the end, returns the list of the records"""
+        if self._sort_specifier:
+            start = self._skip or 0
+            if self._limit:
+                # only the first records are kept while reading
+                rows = heapq.nsmallest(
+                    start + self._limit,
+                    self._source(),
+                    key=self._sort_key
+                )
+                return rows[start:]
+            return self._sorted(list(self._source()))[start:]
+        return list(self._results())
+
+    @property
+    def _streaming(self):
+        """True if the records are pulled from the query as the cursor
+        moves, instead of being materialized first"""
+        return self._rows is None and not self._sort_specifier and \
+            self._cache is None
+
+    @property
+    def _reads_all(self):
+        """True if the query has to run to the end to give the records:
+        they are sorted or not limited"""
+        return bool(self._sort_specifier) or not self._limit
+
+    @property
+    def currentrec(self):
+        """The last record of the cursor"""
+        return self.cursordat[-1] if self.cursordat else None
+
+    def _results(self):
+        """Returns a new iterator over the unsorted, paginated records"""
+        start = self._skip or 0
+        stop = start + self._limit if self._limit else None
+        return islice(self._source(), start, stop)
 
     def __getitem__(self, key):
         """Gets record by index or value by key"""
-        if isinstance(key, int):
+        if isinstance(key, (int, slice)):
             return self.cursordat[key]
         return self.currentrec[key]
 
+    def __iter__(self):
+        """
+        Iterates over the records from the first one
+
+        Unless the records are already materialized, have to be sorted or
+        are cached, the query runs as the iteration goes.
+        """
+        if not self._streaming:
+            return iter(self.cursordat)
+        return self._results()
+
+    def batch_size(self, batch_size):
+        """
+        Sets how many records `next` pulls from the query at once
+
+        :param batch_size: number of records, 0 for one at a time
+        :return: the cursor
+        """
+        if not isinstance(batch_size, int) or isinstance(batch_size, bool):
+            raise TypeError(u'batch_size must be an integer')
+        if batch_size < 0:
+            raise ValueError(u'batch_size must be >= 0')
+        self._batch_size = batch_size
+        return self
+
+    def rewind(self):
+        """
+        Moves the cursor back before its first record
+        :return: the cursor
+        """
+        self.cursorpos = -1
+        self._stream = None
+        self._buffer.clear()
+        return self
+
     def paginate(self, skip, limit):
         """Paginate list of records"""
-        if not self.count() or not limit:
-            return
-        skip = skip or 0
-        pages = int(ceil(self.count() / float(limit)))
-        limits = {}
-        last = 0
-        for i in range(pages):
-            current = limit * i
-            limits[last] = current
-            last = current
-        # example with count == 62
-        # {0: 20, 20: 40, 40: 60, 60: 62}
-        if limit and limit < self.count():
-            limit = limits.get(skip, self.count())
-            self.cursordat = self.cursordat[skip: limit]
+        self._skip = skip
+        self._limit = limit
+        self._rows = None
+        self.rewind()
+
+    def skip(self, skip):
+        """
+        Skips the first records of the results
+
+        :param skip: number of records to skip
+        :return: the cursor
+        """
+        if not isinstance(skip, int) or isinstance(skip, bool):
+            raise TypeError(u'skip must be an integer')
+        if skip < 0:
+            raise ValueError(u'skip must be >= 0')
+        self.paginate(skip, self._limit)
+        return self
+
+    def limit(self, limit):
+        """
+        Limits the number of records of the results
+
+        Without a sort, the query stops as soon as enough records are found.
+
+        :param limit: maximum number of records, 0 for no limit
+        :return: the cursor
+        """
+        if not isinstance(limit, int) or isinstance(limit, bool):
+            raise TypeError(u'limit must be an integer')
+        self.paginate(self._skip, abs(limit))
+        return self
 
     def _order(self, value, is_reverse=None):
         """Parsing data to a sortable form
         By giving each data type an ID(int), and assemble with the value
         into a sortable tuple.
         """
+        # scalars first, they are the bulk of the sort keys
+        if isinstance(value, bool):
+            return (5, value)
 
-        def _dict_parser(dict_doc):
-            """ dict ordered by:
-            valueType_N -> key_N -> value_N
-            """
-            result = list()
-            for key in dict_doc:
-                data = self._order(dict_doc[key])
-                res = (data[0], key, data[1])
-                result.append(res)
-            return tuple(result)
-
-        def _list_parser(list_doc):
-            """list will iter members to compare
-            """
-            result = list()
-            for member in list_doc:
-                result.append(self._order(member))
-            return result
+        elif isinstance(value, (int, float)):
+            return (1, value)
+
+        elif isinstance(value, basestring):
+            return (2, value)
 
         # (TODO) include more data type
-        if value is None or not isinstance(value, (dict,
-                                                   list,
-                                                   basestring,
-                                                   bool,
-                                                   float,
-                                                   int)):
+        elif not isinstance(value, (dict, list)):
             # not support/sortable value type
             value = (0, None)
 
-        elif isinstance(value, bool):
-            value = (5, value)
-
-        elif isinstance(value, (int, float)):
-            value = (1, value)
-
-        elif isinstance(value, basestring):
-            value = (2, value)
-
         elif isinstance(value, dict):
-            value = (3, _dict_parser(value))
+            # dict ordered by: valueType_N -> key_N -> value_N
+            result = list()
+            for key in value:
+                data = self._order(value[key])
+                result.append((data[0], key, data[1]))
+            value = (3, tuple(result))
 
         elif isinstance(value, list):
             if len(value) == 0:
                 # [] less then None
                 value = [(-1, [])]
             else:
-                value = _list_parser(value)
+                # list will iter members to compare
+                value = [self._order(member) for member in value]
 
             if is_reverse is not None:
                 # list will firstly compare with other doc by it's smallest
@@ -673,106 +1791,165 @@ class TinyMongoCursor(object):
             raise ValueError('Wrong input, pass a field name and a direction,'
                              ' or pass a list of (key, direction) pairs.')
 
-        # sorting
-
-        _cursordat = self.cursordat
-
-        total = len(_cursordat)
-        pre_sect_stack = list()
-        for pair in sort_specifier:
-
-            is_reverse = bool(1-pair[1])
-            value_stack = list()
-            for index, data in enumerate(_cursordat):
+        self._sort_specifier = sort_specifier
+        # split the dotted names once, not for every record
+        self._sort_paths = [
+            (field.split('.'), bool(1 - direction))
+            for field, direction in sort_specifier
+        ]
+        self._rows = None
+        self.rewind()
 
-                # get field value
+        return self
 
-                not_found = None
-                for key in pair[0].split('.'):
-                    not_found = True
+    def _sort_field(self, data, path, is_reverse):
+        """
+        Gets the value of a (dotted) field the way MongoDB sorts by it
 
-                    if isinstance(data, dict) and key in data:
-                        data = copy.deepcopy(data[key])
+        :param data: the record
+        :param path: the dotted field name, split on the dots
+        :param is_reverse: True for a descending sort
+        :return: the field value, None if not found
+        """
+        not_found = None
+        for key in path:
+            not_found = True
+
+            if isinstance(data, dict) and key in data:
+                data = data[key]
+                not_found = False
+
+            elif isinstance(data, list):
+                if not is_reverse and len(data) == 1:
+                    # MongoDB treat [{data}] as {data}
+                    # when finding fields
+                    if isinstance(data[0], dict) and key in data[0]:
+                        data = data[0][key]
                         not_found = False
 
-                    elif isinstance(data, list):
-                        if not is_reverse and len(data) == 1:
-                            # MongoDB treat [{data}] as {data}
-                            # when finding fields
-                            if isinstance(data[0], dict) and key in data[0]:
-                                data = copy.deepcopy(data[0][key])
-                                not_found = False
-
-                        elif is_reverse:
-                            # MongoDB will keep finding field in reverse mode
-                            for _d in data:
-                                if isinstance(_d, dict) and key in _d:
-                                    data = copy.deepcopy(_d[key])
-                                    not_found = False
-                                    break
-
-                    if not_found:
-                        break
-
-                # parsing data for sorting
-
-                if not_found:
-                    # treat no match as None
-                    data = None
-
-                value = self._order(data, is_reverse)
-
-                # read previous section
-                pre_sect = pre_sect_stack[index] if pre_sect_stack else 0
-                # inverse if in reverse mode
-                # for keeping order as ASCENDING after sort
-                pre_sect = (total - pre_sect) if is_reverse else pre_sect
-                _ind = (total - index) if is_reverse else index
-
-                value_stack.append((pre_sect, value, _ind))
+                elif is_reverse:
+                    # MongoDB will keep finding field in reverse mode
+                    for _d in data:
+                        if isinstance(_d, dict) and key in _d:
+                            data = _d[key]
+                            not_found = False
+                            break
 
-            # sorting cursor data
+            if not_found:
+                break
 
-            value_stack.sort(reverse=is_reverse)
+        if not_found:
+            # treat no match as None
+            return None
+        return data
 
-            ordereddat = list()
-            sect_stack = list()
-            sect_id = -1
-            last_dat = None
-            for dat in value_stack:
-                # restore if in reverse mode
-                _ind = (total - dat[-1]) if is_reverse else dat[-1]
-                ordereddat.append(_cursordat[_ind])
-
-                # define section
-                # maintain the sorting result in next level sorting
-                if not dat[1] == last_dat:
-                    sect_id += 1
-                sect_stack.append(sect_id)
-                last_dat = dat[1]
+    def _sort_key(self, data, invert=True):
+        """
+        Builds the composite sort key of a record
 
-            # save result for next level sorting
-            _cursordat = ordereddat
-            pre_sect_stack = sect_stack
+        :param data: the record
+        :param invert: wrap the values of descending fields so that they
+                       compare in reverse
+        :return: tuple with the `_order` value of each sort field
+        """
+        key = list()
+        for path, is_reverse in self._sort_paths:
+            value = self._order(
+                self._sort_field(data, path, is_reverse), is_reverse
+            )
+            key.append(_Descending(value) if is_reverse and invert else value)
+        return tuple(key)
+
+    def _sorted(self, _cursordat):
+        """
+        Sorts records according to the sort specification of the cursor
 
-        # done
+        The composite key of each record is computed once and the records
+        are sorted in a single stable pass, equal records keep their order.
 
-        self.cursordat = _cursordat
+        :param _cursordat: list of records
+        :return: new sorted list of records
+        """
+        if all(direction == -1 for _, direction in self._sort_specifier):
+            # no need to invert each value, the whole order is reversed
+            return sorted(
+                _cursordat,
+                key=lambda data: self._sort_key(data, invert=False),
+                reverse=True
+            )
+        return sorted(_cursordat, key=self._sort_key)
+
+    def explain(self):
+        """
+        Describes how the query of the cursor was run, like MongoDB does
 
-        return self
+        :return: dict with the `queryPlanner` (the `winningPlan` and the
+                 `rejectedPlans`) and the `executionStats`
+        """
+        # runs the query if the cursor did not yet
+        n_returned = self.count()
+
+        plan = self.plan
+        if plan is None:
+            plan = QueryPlan(None)
+            plan.docs_examined = plan.n_returned = n_returned
+
+        winning = plan.describe()
+        if self._sort_specifier:
+            winning = {
+                u'stage': u'SORT',
+                u'sortPattern': dict(self._sort_specifier),
+                u'inputStage': winning,
+            }
+        if self._skip:
+            winning = {
+                u'stage': u'SKIP',
+                u'skipAmount': self._skip,
+                u'inputStage': winning,
+            }
+        if self._limit:
+            winning = {
+                u'stage': u'LIMIT',
+                u'limitAmount': self._limit,
+                u'inputStage': winning,
+            }
+
+        execution_stats = plan.execution_stats
+        execution_stats[u'nReturned'] = n_returned
+
+        return {
+            u'queryPlanner': {
+                u'plannerVersion': 1,
+                u'parsedQuery': plan.query or {},
+                u'winningPlan': winning,
+                u'rejectedPlans': [
+                    rejected.describe() for rejected in plan.rejected
+                ],
+            },
+            u'executionStats': execution_stats,
+        }
+
+    def _fill(self):
+        """
+        Pulls the next batch of records from the query if none is buffered
+        :return: True if a record is available
+        """
+        if not self._buffer:
+            if self._stream is None:
+                self._stream = self._results()
+            self._buffer.extend(
+                islice(self._stream, max(self._batch_size, 1))
+            )
+        return bool(self._buffer)
 
     def hasNext(self):
         """
         Returns True if the cursor has a next position, False if not
         :return:
         """
-        cursor_pos = self.cursorpos + 1
-
-        try:
-            self.cursordat[cursor_pos]
-            return True
-        except IndexError:
-            return False
+        if self._streaming:
+            return self._fill()
+        return self.cursorpos + 1 < len(self.cursordat)
 
     def next(self):
         """
@@ -780,9 +1957,19 @@ class TinyMongoCursor(object):
 
         :return:
         """
+        if self._streaming:
+            if not self._fill():
+                raise StopIteration
+            self.cursorpos += 1
+            return self._buffer.popleft()
+
+        if self.cursorpos + 1 >= len(self.cursordat):
+            raise StopIteration
         self.cursorpos += 1
         return self.cursordat[self.cursorpos]
 
+    __next__ = next
+
     def count(self, with_limit_and_skip=False):
         """
         Returns the number of records in the current cursor
@@ -792,6 +1979,45 @@ class TinyMongoCursor(object):
         return len(self.cursordat)
 
 
+def _distinct_values(values_lists):
+    """
+    Gathers the distinct values, flattening the arrays
+
+    :param values_lists: iterable of lists of the values of a field, as
+                         returned by the getters of `make_getter`
+    :return: list of the values, in the order met
+    """
+    seen = set()
+    values = list()
+    for field_values in values_lists:
+        for value in field_values:
+            items = value if isinstance(value, list) else [value]
+            for item in items:
+                item_key = index_key(item)
+                if item_key not in seen:
+                    seen.add(item_key)
+                    values.append(item)
+    return values
+
+
+class _Descending(object):
+    """Wraps a sort value to invert its ordering"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+
 class TinyGridFS(object):
     """GridFS for tinyDB"""
     def __init__(self, *args, **kwargs):
@@ -803,6 +2029,96 @@ class TinyGridFS(object):
         return self
 
 
+def _index_spec(keys):
+    """
+    Reads the (field, direction) of an index from its key specification
+
+    :param keys: a field name, or a list with one (field, direction) pair
+    :return: (field, direction) tuple
+    """
+    if isinstance(keys, basestring):
+        return keys, 1
+    if not isinstance(keys, (list, tuple)) or not keys:
+        raise TypeError(u'keys must be a field name or a list of '
+                        u'(key, direction) pairs')
+    if len(keys) > 1:
+        raise OperationFailure(u'compound indexes are not supported')
+    field, direction = keys[0]
+    if not isinstance(field, basestring) or direction not in (1, -1):
+        raise TypeError(u'bad index specification')
+    return field, direction
+
+
+def _is_id_filter(query):
+    """True if `query` is a plain equality filter on `_id`"""
+    return (
+        isinstance(query, dict) and
+        len(query) == 1 and
+        u'_id' in query and
+        not isinstance(query[u'_id'], (dict, list))
+    )
+
+
+def _upsert_doc(query, update, updater):
+    """
+    Builds the document an upsert inserts
+
+    :param query: dictionary representing the mongo query
+    :param update: dictionary of update operators, or the fields of the
+                   new document
+    :param updater: the compiled update
+    :return: the new document
+    """
+    seed = {}
+    for field, value in _equalities(query):
+        if field == u'_id' or any(key.startswith(u'$') for key in update):
+            seed[field] = value
+    if seed:
+        # dotted fields are set like $set does
+        seed = compile_update({u'$set': seed})({})
+    return updater(seed)
+
+
+def _equalities(query):
+    """Yields the (field, value) pairs of the equalities ANDed at the top
+    of a query"""
+    if not isinstance(query, dict):
+        return
+    for key, value in query.items():
+        if key == u'$and' and isinstance(value, list):
+            for spec in value:
+                for equality in _equalities(spec):
+                    yield equality
+            continue
+        if key.startswith(u'$'):
+            continue
+        if isinstance(value, dict) and any(
+                op.startswith(u'$') for op in value):
+            if u'$eq' not in value:
+                continue
+            value = value[u'$eq']
+        if not isinstance(value, REGEX_TYPE):
+            yield key, value
+
+
+def _copy_value(value):
+    """Copies the dicts and lists of a JSON like value"""
+    if isinstance(value, dict):
+        return dict((key, _copy_value(item)) for key, item in value.items())
+    elif isinstance(value, list):
+        return [_copy_value(item) for item in value]
+    return value
+
+
+def _copy_document(doc):
+    """Copies a document, faster than deepcopy, keeping its TinyDB doc_id"""
+    copied = _copy_value(doc)
+    doc_id = getattr(doc, u'doc_id', None)
+    if doc_id is None:
+        return copied
+    return Document(copied, doc_id)
+
+
 def generate_id():
     """Generate new UUID"""
     # TODO: Use six.string_type to Py3 compat
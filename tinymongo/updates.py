@@ -0,0 +1,247 @@
+"""Applies mongo update operators to documents"""
+# coding: utf-8
+
+from __future__ import absolute_import
+
+from .errors import WriteError
+from .filters import NUMBER_CLASSES, compile_query, range_type
+
+# marker of a field missing from a document
+MISSING = object()
+
+
+def compile_update(update):
+    """
+    Builds a function applying an update document
+
+    A dict without any `$` operator sets its fields, like `$set` does.
+
+    :param update: dict of update operators ($set, $unset, $inc, $push,
+                   $pull, $min, $max) to dicts of dotted fields and values
+    :return: function taking a document and returning an updated copy of
+             it, the document itself is left untouched
+    """
+    if not isinstance(update, dict):
+        raise ValueError(u'"update" must be a dict')
+    if not update:
+        raise ValueError(u'update cannot be empty')
+
+    operators = [key for key in update if key.startswith(u'$')]
+    if not operators:
+        update = {u'$set': update}
+    elif len(operators) != len(update):
+        raise ValueError(u'update only works with $ operators')
+
+    steps = list()
+    for op, fields in update.items():
+        if op not in UPDATE_OPERATORS:
+            raise WriteError(u"Unknown modifier: {0}".format(op))
+        if not isinstance(fields, dict):
+            raise WriteError(
+                u'Modifiers operate on fields but we found type {0} '
+                u'instead'.format(type(fields).__name__)
+            )
+        apply, check, create = UPDATE_OPERATORS[op]
+        for field, value in fields.items():
+            if check is not None:
+                value = check(field, value)
+            steps.append((apply, field.split(u'.'), value, create))
+
+    def updater(doc):
+        new_doc = dict(doc)
+        for apply, parts, value, create in steps:
+            container = _container(new_doc, parts, create)
+            if container is not None:
+                apply(container, _key(container, parts[-1]), value)
+        return new_doc
+    return updater
+
+
+def _key(container, part):
+    """The key of a path component in a dict, or its index in a list"""
+    if isinstance(container, list):
+        if not part.isdigit():
+            raise WriteError(
+                u"Cannot create field '{0}' in an array".format(part)
+            )
+        return int(part)
+    return part
+
+
+def _get(container, key):
+    """Reads `key` from a dict or a list, MISSING when absent"""
+    if isinstance(container, list):
+        return container[key] if key < len(container) else MISSING
+    return container.get(key, MISSING)
+
+
+def _put(container, key, value):
+    """Writes `key` of a dict or a list, padding lists with None"""
+    if isinstance(container, list):
+        while len(container) <= key:
+            container.append(None)
+    container[key] = value
+
+
+def _container(doc, parts, create):
+    """
+    Walks down to the dict or list holding the last component of a path
+
+    The nested dicts and lists met along the way are replaced by copies,
+    so the document being updated shares nothing it changes with the
+    original one.
+
+    :param create: create the missing dicts along the path, else stop
+    :return: the dict or list, None if missing
+    """
+    container = doc
+    for part in parts[:-1]:
+        key = _key(container, part)
+        child = _get(container, key)
+        if child is MISSING:
+            if not create:
+                return None
+            child = {}
+        elif isinstance(child, (dict, list)):
+            child = type(child)(child)
+        else:
+            raise WriteError(
+                u"Cannot create field '{0}' in element {{{1}: {2!r}}}".format(
+                    parts[-1], part, child
+                )
+            )
+        _put(container, key, child)
+        container = child
+    return container
+
+
+def _less(value, other):
+    """True if `value` sorts before `other`, None first, then numbers,
+    then strings"""
+    if value is None or other is None:
+        return value is None and other is not None
+    value_type, other_type = range_type(value), range_type(other)
+    if value_type is not None and other_type is not None:
+        return (value_type, value) < (other_type, other)
+    try:
+        return value < other
+    except TypeError:
+        raise WriteError(
+            u'cannot compare {0!r} with {1!r}'.format(value, other)
+        )
+
+
+def _is_number(value):
+    """True for numbers, which booleans are not"""
+    return isinstance(value, NUMBER_CLASSES) and not isinstance(value, bool)
+
+
+def _check_number(field, value):
+    """Validates the argument of `$inc`"""
+    if not _is_number(value):
+        raise WriteError(
+            u'Cannot increment with non-numeric argument: '
+            u'{{{0}: {1!r}}}'.format(field, value)
+        )
+    return value
+
+
+def _check_push(field, value):
+    """Reads the items to append from the argument of `$push`"""
+    if isinstance(value, dict) and u'$each' in value:
+        if set(value) != set([u'$each']):
+            raise WriteError(u'$push only supports the $each modifier')
+        if not isinstance(value[u'$each'], list):
+            raise WriteError(u'The argument to $each must be an array')
+        return list(value[u'$each'])
+    return [value]
+
+
+def _check_pull(field, value):
+    """Turns the argument of `$pull` into a predicate on array items"""
+    if isinstance(value, dict):
+        if any(key.startswith(u'$') for key in value):
+            query = compile_query({u'item': value})
+            return lambda item: query({u'item': item})
+        query = compile_query(value)
+        return lambda item: isinstance(item, dict) and query(item)
+    return lambda item: item == value
+
+
+def _set(container, key, value):
+    """Sets the field"""
+    _put(container, key, value)
+
+
+def _unset(container, key, value):
+    """Removes the field"""
+    if isinstance(container, list):
+        # MongoDB keeps the array positions
+        if key < len(container):
+            container[key] = None
+    else:
+        container.pop(key, None)
+
+
+def _inc(container, key, value):
+    """Adds `value` to the field, missing counts as 0"""
+    current = _get(container, key)
+    if current is MISSING:
+        current = 0
+    elif not _is_number(current):
+        raise WriteError(
+            u'Cannot apply $inc to a value of non-numeric type. '
+            u'{{{0}: {1!r}}}'.format(key, current)
+        )
+    _put(container, key, current + value)
+
+
+def _min(container, key, value):
+    """Sets the field to `value` if that is lower"""
+    current = _get(container, key)
+    if current is MISSING or _less(value, current):
+        _put(container, key, value)
+
+
+def _max(container, key, value):
+    """Sets the field to `value` if that is greater"""
+    current = _get(container, key)
+    if current is MISSING or _less(current, value):
+        _put(container, key, value)
+
+
+def _push(container, key, items):
+    """Appends items to the array field, creating it if missing"""
+    current = _get(container, key)
+    if current is MISSING or current is None:
+        current = []
+    elif not isinstance(current, list):
+        raise WriteError(
+            u"The field '{0}' must be an array but is of type {1}".format(
+                key, type(current).__name__
+            )
+        )
+    _put(container, key, current + items)
+
+
+def _pull(container, key, matches):
+    """Removes the items of the array field matching the condition"""
+    current = _get(container, key)
+    if current is MISSING or current is None:
+        return
+    if not isinstance(current, list):
+        raise WriteError(u'Cannot apply $pull to a non-array value')
+    _put(container, key, [item for item in current if not matches(item)])
+
+
+# operator: (apply, check, create), `check` validates and prepares the
+# argument, `create` tells if missing parents of the field are created
+UPDATE_OPERATORS = {
+    u'$set': (_set, None, True),
+    u'$unset': (_unset, None, False),
+    u'$inc': (_inc, _check_number, True),
+    u'$min': (_min, None, True),
+    u'$max': (_max, None, True),
+    u'$push': (_push, _check_push, True),
+    u'$pull': (_pull, _check_pull, False),
+}